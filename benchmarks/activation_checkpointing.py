@@ -0,0 +1,314 @@
+"""Measures the memory and time trade-off of activation checkpointing for deeper processors and finer meshes.
+
+For every combination of processor depth, finest mesh level and checkpointing setting, the experiment's
+config is changed accordingly and a few training steps on random inputs run in a fresh process, so that the
+peak memory of one configuration does not hide the one of the next. The peak memory is the growth of the
+resident set size during the forward and backward pass of a training step, which is dominated by the
+activations. It is read from the high-water mark of the process after a warm-up step and after returning the
+freed memory of the allocator to the system, so this benchmark only runs on Linux with glibc. The static
+graphs are built once per mesh level before the timed runs. Next to the measurements, the estimates of
+`src.planner` are reported.
+
+Checkpointing is applied to the GNN layers of the encoder and the processor, as far as their layer type
+supports it.
+
+Example
+-------
+python -m benchmarks.activation_checkpointing experiments/baseline --depths 2 4 8 --mesh-levels 2 3 \\
+    --checkpoint-every 0 1 2 --repeats 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from src.config import ExperimentConfig, GraphLayerType
+from src.constants import FileNames
+from src.data.data_configs import get_dataset_metadata
+from src.planner import plan_experiment
+from src.sweep import apply_overrides
+from src.utils import load_from_json_file
+
+_RESULT_PREFIX = "CHECKPOINTING_RESULT "
+
+_CHECKPOINTED_LAYER_TYPES = [GraphLayerType.ConvGCN.value, GraphLayerType.GATConv.value]
+
+
+def _memory_status_bytes(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                # The values are in kilobytes
+                return int(line.split()[1]) * 1024
+
+    raise RuntimeError(f"{field} is not reported in /proc/self/status")
+
+
+def _reset_peak_memory():
+    import ctypes
+
+    # The allocator keeps freed memory, which would be reused by the activations without being counted
+    ctypes.CDLL("libc.so.6").malloc_trim(0)
+    # Resets the high-water mark VmHWM to the current resident set size
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+
+
+def _checkpointing_run(config_dict: Dict[str, Any], graph_cache_dir: str, repeats: int):
+    """Runs in the fresh process and prints the peak memory growth and the durations of the training steps."""
+    import torch
+    import torch.nn as nn
+
+    from src.main import load_model_from_experiment_config
+
+    experiment_config = ExperimentConfig(**config_dict)
+    dataset_metadata = get_dataset_metadata(
+        experiment_config.data.dataset_name,
+        data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+    )
+    model = load_model_from_experiment_config(
+        experiment_config=experiment_config,
+        device=torch.device("cpu"),
+        dataset_metadata=dataset_metadata,
+        graph_cache_dir=graph_cache_dir,
+    )
+    model.train()
+    optimiser = torch.optim.Adam(model.parameters(), lr=experiment_config.learning_rate)
+    loss_fn = nn.MSELoss()
+
+    num_grid_nodes = dataset_metadata.num_latitudes * dataset_metadata.num_longitudes
+    X = torch.randn(
+        1,
+        num_grid_nodes,
+        experiment_config.data.obs_window_used * experiment_config.data.num_features_used,
+    )
+    y = torch.randn(num_grid_nodes, experiment_config.data.num_features_used)
+
+    def _step():
+        optimiser.zero_grad()
+        loss_fn(model(X=X, attention_threshold=0.0), y).backward()
+        optimiser.step()
+
+    # The warm-up step allocates the gradients, the Adam state and the workspaces of the kernels
+    _step()
+    _reset_peak_memory()
+    rss_before = _memory_status_bytes("VmRSS")
+    loss_fn(model(X=X, attention_threshold=0.0), y).backward()
+    peak_memory = _memory_status_bytes("VmHWM") - rss_before
+
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _step()
+        durations.append(time.perf_counter() - start)
+
+    result = {
+        "peak_memory_bytes": peak_memory,
+        "median_step_seconds": statistics.median(durations),
+    }
+    print(_RESULT_PREFIX + json.dumps(result))
+
+
+def _run_in_fresh_process(config_dict: Dict[str, Any], graph_cache_dir: str, repeats: int) -> Dict[str, Any]:
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config_file:
+        json.dump(config_dict, config_file)
+
+    try:
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.activation_checkpointing",
+                config_file.name,
+                "--run",
+                "--graph-cache-dir",
+                graph_cache_dir,
+                "--repeats",
+                str(repeats),
+            ],
+            capture_output=True,
+            text=True,
+        )
+    finally:
+        os.remove(config_file.name)
+
+    if completed.returncode != 0:
+        raise RuntimeError(f"The checkpointing run failed:\n{completed.stderr}")
+
+    for line in completed.stdout.splitlines():
+        if line.startswith(_RESULT_PREFIX):
+            return json.loads(line[len(_RESULT_PREFIX) :])
+
+    raise RuntimeError(f"The checkpointing run did not report a result:\n{completed.stdout}")
+
+
+def _overrides(
+    config_dict: Dict[str, Any], depth: int, mesh_level: int, checkpoint_every: int
+) -> Dict[str, Any]:
+    processor = config_dict["pipeline"]["processor"]["gcn"]
+    width = processor["hidden_dims"][0] if processor.get("hidden_dims") else processor["output_dim"]
+    mesh_levels = [level for level in config_dict["graph"]["mesh_levels"] if level < mesh_level]
+
+    overrides = {
+        "pipeline.processor.gcn.hidden_dims": [width] * depth,
+        "graph.mesh_levels": mesh_levels + [mesh_level],
+    }
+    for stage in ["encoder", "processor"]:
+        if config_dict["pipeline"][stage]["gcn"]["layer_type"] in _CHECKPOINTED_LAYER_TYPES:
+            overrides[f"pipeline.{stage}.gcn.checkpoint_every_n_layers"] = checkpoint_every or None
+
+    return overrides
+
+
+def run_checkpointing_benchmark(
+    experiment_dir: str,
+    depths: List[int],
+    mesh_levels: List[int],
+    checkpoint_every: List[int],
+    repeats: int = 5,
+    graph_cache_dir: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Measures the peak memory and the training step time of every combination of the settings.
+
+    Parameters
+    ----------
+    experiment_dir : str
+        The experiment directory that contains the config.json file.
+    depths : List[int]
+        The numbers of hidden GNN layers of the processor. They all have the width of the configured first
+        hidden layer.
+    mesh_levels : List[int]
+        The finest mesh levels. The configured coarser levels are kept.
+    checkpoint_every : List[int]
+        The values of `checkpoint_every_n_layers` to compare, where 0 disables checkpointing.
+    repeats : int
+        The number of timed training steps of every configuration.
+    graph_cache_dir : Optional[str]
+        The graph cache to load the static graphs from. Defaults to a temporary directory.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        Per configuration the measured peak memory and median step time, their ratio to the run without
+        checkpointing, and the planner's estimates of the activation memory and of the FLOPs.
+    """
+    config_dict = load_from_json_file(os.path.join(experiment_dir, FileNames.EXPERIMENT_CONFIG))
+    base_config = ExperimentConfig(**config_dict)
+    dataset_metadata = get_dataset_metadata(
+        base_config.data.dataset_name,
+        data_path=os.path.join("data", "datasets", base_config.data.dataset_name),
+    )
+
+    results = []
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        graph_cache_dir = graph_cache_dir or temporary_dir
+
+        for mesh_level in mesh_levels:
+            for depth in depths:
+                baseline = None
+                for every_n_layers in checkpoint_every:
+                    run_config = apply_overrides(
+                        config_dict, _overrides(config_dict, depth, mesh_level, every_n_layers)
+                    )
+                    # Makes sure the graphs are cached before the first measured run of the mesh level
+                    if not results or results[-1]["mesh_level"] != mesh_level:
+                        _run_in_fresh_process(run_config, graph_cache_dir, repeats=1)
+
+                    measured = _run_in_fresh_process(run_config, graph_cache_dir, repeats)
+                    plan = plan_experiment(ExperimentConfig(**run_config), dataset_metadata)
+                    baseline = baseline or measured
+
+                    results.append(
+                        {
+                            "mesh_level": mesh_level,
+                            "depth": depth,
+                            "checkpoint_every_n_layers": every_n_layers,
+                            **measured,
+                            "memory_ratio": measured["peak_memory_bytes"]
+                            / max(baseline["peak_memory_bytes"], 1),
+                            "time_ratio": measured["median_step_seconds"] / baseline["median_step_seconds"],
+                            "planned_activation_bytes": plan["activation_bytes"],
+                            "planned_peak_training_bytes": plan["peak_training_bytes"],
+                            "planned_flops": plan["forward_flops"] + plan["backward_flops"],
+                        }
+                    )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the memory and time trade-off of activation checkpointing."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file.",
+    )
+    parser.add_argument("--depths", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--mesh-levels", type=int, nargs="+", default=[2, 3])
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2],
+        help="The values of checkpoint_every_n_layers, 0 disables checkpointing. The first is the baseline.",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=float,
+        default=None,
+        help="Marks the configurations whose measured peak memory fits into the budget.",
+    )
+    parser.add_argument("--graph-cache-dir", default=None)
+    parser.add_argument("--output", default=None, help="Saves the results as JSON.")
+    # Used for the measured runs in the fresh processes, where the positional argument is the run's config
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        _checkpointing_run(
+            load_from_json_file(args.experiment_directory), args.graph_cache_dir, args.repeats
+        )
+        return
+
+    results = run_checkpointing_benchmark(
+        args.experiment_directory,
+        depths=args.depths,
+        mesh_levels=args.mesh_levels,
+        checkpoint_every=args.checkpoint_every,
+        repeats=args.repeats,
+        graph_cache_dir=args.graph_cache_dir,
+    )
+
+    print(
+        f"{'mesh':>4} {'depth':>5} {'every':>5} {'peak (MB)':>10} {'step (ms)':>10} {'memory':>7} "
+        f"{'time':>6} {'planned act. (MB)':>18}"
+        + (f" {'fits':>5}" if args.memory_budget_mb else "")
+    )
+    for result in results:
+        peak_mb = result["peak_memory_bytes"] / 2**20
+        line = (
+            f"{result['mesh_level']:>4} {result['depth']:>5} {result['checkpoint_every_n_layers'] or '-':>5} "
+            f"{peak_mb:>10.1f} {result['median_step_seconds'] * 1000:>10.1f} "
+            f"{result['memory_ratio']:>6.2f}x {result['time_ratio']:>5.2f}x "
+            f"{result['planned_activation_bytes'] / 2**20:>18.1f}"
+        )
+        if args.memory_budget_mb:
+            line += f" {'yes' if peak_mb <= args.memory_budget_mb else 'no':>5}"
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Checkpointing results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
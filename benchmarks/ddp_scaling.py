@@ -0,0 +1,206 @@
+"""Measures how the training throughput scales with the number of data-parallel CPU ranks on one node.
+
+Example
+-------
+python -m benchmarks.ddp_scaling experiments/baseline --max-ranks 8 --num-epochs 2
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim import Adam
+from torch.utils.data.distributed import DistributedSampler
+
+from src.config import ExperimentConfig
+from src.constants import FileNames
+from src.data.dataloader import create_dataloader, load_train_and_test_datasets
+from src.distributed import (
+    barrier,
+    get_world_size,
+    is_distributed,
+    is_main_process,
+    launch,
+    set_sampler_epoch,
+)
+from src.main import load_model_from_experiment_config, set_random_seeds
+from src.utils import load_from_json_file
+
+
+def _benchmark_worker(
+    experiment_config: ExperimentConfig,
+    graph_cache_dir: str,
+    num_epochs: int,
+    result_path: str,
+):
+    device = torch.device("cpu")
+    set_random_seeds(seed=experiment_config.random_seed)
+
+    train_dataset, _, _, dataset_metadata = load_train_and_test_datasets(
+        data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+        data_config=experiment_config.data,
+        use_shared_cache=experiment_config.shared_dataset_cache,
+    )
+    train_sampler = (
+        DistributedSampler(train_dataset, shuffle=True, drop_last=True)
+        if is_distributed()
+        else None
+    )
+    train_dataloader = create_dataloader(
+        train_dataset,
+        experiment_config=experiment_config,
+        device=device,
+        shuffle=True,
+        sampler=train_sampler,
+    )
+
+    # The graphs are built by the first run only, all later runs load them from the cache
+    model = load_model_from_experiment_config(
+        experiment_config=experiment_config,
+        device=device,
+        dataset_metadata=dataset_metadata,
+        graph_cache_dir=graph_cache_dir,
+    )
+    if is_distributed():
+        model = DistributedDataParallel(model)
+
+    optimiser = Adam(params=model.parameters(), lr=experiment_config.learning_rate)
+    loss_fn = nn.MSELoss()
+
+    epoch_times = []
+    for epoch in range(num_epochs):
+        set_sampler_epoch(train_dataloader, epoch)
+        barrier()
+        start = time.perf_counter()
+
+        model.train()
+        for X, y in train_dataloader:
+            y = y.squeeze(0)
+            if len(y.shape) == 3:
+                y = y.squeeze(-2)
+
+            optimiser.zero_grad()
+            loss_fn(model(X=X, attention_threshold=0.0), y).backward()
+            optimiser.step()
+
+        # The slowest rank determines the epoch time
+        barrier()
+        epoch_times.append(time.perf_counter() - start)
+
+    if is_main_process():
+        # Samples per second over all ranks, the first epoch is skipped as warm-up if possible
+        timed_epochs = epoch_times[1:] or epoch_times
+        epoch_time = sum(timed_epochs) / len(timed_epochs)
+        with open(result_path, "w") as outfile:
+            json.dump(
+                {
+                    "num_ranks": get_world_size(),
+                    "threads_per_rank": torch.get_num_threads(),
+                    "epoch_time": epoch_time,
+                    # Every rank trains on a shard of the same size
+                    "samples_per_second": len(train_dataloader)
+                    * experiment_config.batch_size
+                    * get_world_size()
+                    / epoch_time,
+                },
+                outfile,
+            )
+
+
+def run_scaling_benchmark(
+    experiment_config: ExperimentConfig,
+    rank_counts: List[int],
+    num_epochs: int = 2,
+) -> List[Dict[str, float]]:
+    """Trains the model of the experiment for a few epochs with each number of ranks and reports the epoch
+    time, the throughput, the speedup and the parallel efficiency relative to the first number of ranks.
+
+    Parameters
+    ----------
+    experiment_config : ExperimentConfig
+        The experiment to benchmark.
+    rank_counts : List[int]
+        The numbers of ranks to benchmark.
+    num_epochs : int
+        The number of epochs to train for each number of ranks.
+
+    Returns
+    -------
+    List[Dict[str, float]]
+        The results for every number of ranks.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        graph_cache_dir = os.path.join(tmp_dir, "graph_cache")
+        for num_ranks in rank_counts:
+            result_path = os.path.join(tmp_dir, f"result_{num_ranks}.json")
+            launch(
+                _benchmark_worker,
+                args=(experiment_config, graph_cache_dir, num_epochs, result_path),
+                nproc_per_node=num_ranks,
+            )
+            with open(result_path, "r") as infile:
+                results.append(json.load(infile))
+
+    base = results[0]
+    for result in results:
+        result["speedup"] = result["samples_per_second"] / base["samples_per_second"]
+        result["efficiency"] = result["speedup"] * base["num_ranks"] / result["num_ranks"]
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks data-parallel training with 1 to N ranks on this node."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file.",
+    )
+    parser.add_argument("--max-ranks", type=int, default=os.cpu_count())
+    parser.add_argument("--num-epochs", type=int, default=2)
+    parser.add_argument(
+        "--output", default=None, help="Optionally write the results to this JSON file."
+    )
+    args = parser.parse_args()
+
+    experiment_config = ExperimentConfig(
+        **load_from_json_file(
+            os.path.join(args.experiment_directory, FileNames.EXPERIMENT_CONFIG)
+        )
+    )
+    # Powers of two up to the maximum number of ranks, and the maximum itself
+    rank_counts = sorted(
+        {2**i for i in range(args.max_ranks.bit_length()) if 2**i <= args.max_ranks}
+        | {args.max_ranks}
+    )
+
+    results = run_scaling_benchmark(
+        experiment_config=experiment_config,
+        rank_counts=rank_counts,
+        num_epochs=args.num_epochs,
+    )
+
+    print(
+        f"{'ranks':>6} {'threads':>8} {'epoch time (s)':>15} {'samples/s':>10} {'speedup':>8} {'efficiency':>11}"
+    )
+    for result in results:
+        print(
+            f"{result['num_ranks']:>6} {result['threads_per_rank']:>8} {result['epoch_time']:>15.3f} "
+            f"{result['samples_per_second']:>10.2f} {result['speedup']:>8.2f} {result['efficiency']:>11.2f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
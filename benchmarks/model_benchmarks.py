@@ -0,0 +1,432 @@
+"""Benchmarks the cost of the model for every layer type, product graph type, mesh level and grid resolution.
+
+Everything runs on synthetic inputs, so no dataset is needed. For every case the graph construction, a single
+forward pass, a forward and backward pass and an autoregressive rollout are timed.
+
+Example
+-------
+python -m benchmarks.model_benchmarks run --output benchmark_results.json
+python -m benchmarks.model_benchmarks run --layer-types conv_gat --mesh-levels 3 4 --grids 64x32
+python -m benchmarks.model_benchmarks compare baseline_results.json benchmark_results.json --threshold 0.1
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.config import (
+    DataConfig,
+    GraphBuildingConfig,
+    GraphLayerType,
+    PipelineConfig,
+    ProductGraphType,
+)
+from src.models import WeatherPrediction
+
+
+METRICS = ["graph_construction", "forward", "forward_backward", "rollout"]
+
+NUM_FEATURES = 12
+OBS_WINDOW = 2
+
+# The product graph is built as a dense matrix over all grid nodes and timesteps
+MAX_DENSE_PRODUCT_GRAPH_NODES = 4096
+
+
+def _graph_block(layer_type: GraphLayerType, hidden_dims: List[int], output_dim: int) -> Dict[str, Any]:
+    if layer_type == GraphLayerType.SimpleConv:
+        return {"layer_type": layer_type}
+
+    graph_block = {
+        "layer_type": layer_type,
+        "hidden_dims": hidden_dims,
+        "output_dim": output_dim,
+        "use_layer_norm": True,
+        "layer_norm_mode": "node",
+    }
+    if layer_type in (GraphLayerType.GATConv, GraphLayerType.SparseGATConv):
+        graph_block["gat_props"] = {"num_heads": 1, "sparsity_thresholds": [0.0, 0.33]}
+    if layer_type == GraphLayerType.SparseGATConv:
+        # SparseGAT only supports a single layer
+        graph_block["hidden_dims"] = []
+
+    return graph_block
+
+
+def build_pipeline_config(
+    layer_type: GraphLayerType, product_graph_type: Optional[ProductGraphType]
+) -> PipelineConfig:
+    """The architecture of the baseline experiment with the given processor layer and product graph."""
+    pipeline = {
+        "encoder": {
+            "mlp": {"mlp_hidden_dims": [48, 48], "output_dim": 64, "use_layer_norm": True, "layer_norm_mode": "node"},
+            "gcn": {"layer_type": GraphLayerType.ConvGCN, "hidden_dims": [64, 64], "output_dim": 64},
+        },
+        "processor": {"gcn": _graph_block(layer_type, hidden_dims=[64, 64], output_dim=64)},
+        "decoder": {
+            "mlp": {"mlp_hidden_dims": [64, 64], "output_dim": 64, "use_layer_norm": False},
+            "gcn": {"layer_type": GraphLayerType.ConvGCN, "hidden_dims": [48, 48], "output_dim": NUM_FEATURES},
+        },
+    }
+    if product_graph_type is not None:
+        pipeline["product_graph"] = {
+            "model": {
+                "gcn": {
+                    "layer_type": GraphLayerType.ConvGCN,
+                    "hidden_dims": [NUM_FEATURES, NUM_FEATURES],
+                    "output_dim": NUM_FEATURES,
+                    "use_layer_norm": True,
+                    "layer_norm_mode": "node",
+                }
+            },
+            "num_k": 4,
+            "self_loop": True,
+            "type": product_graph_type,
+        }
+
+    return PipelineConfig(**pipeline)
+
+
+def _parse_grid(grid: str) -> Tuple[int, int]:
+    num_longitudes, num_latitudes = (int(size) for size in grid.split("x"))
+    return num_longitudes, num_latitudes
+
+
+def _time(fn: Callable, repeats: int, warmup: int = 1) -> Dict[str, float]:
+    for _ in range(warmup):
+        fn()
+
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+
+    return {"median": statistics.median(durations), "min": min(durations)}
+
+
+def benchmark_case(
+    layer_type: GraphLayerType,
+    product_graph_type: Optional[ProductGraphType],
+    mesh_level: int,
+    grid: str,
+    repeats: int = 5,
+    rollout_steps: int = 20,
+) -> Dict[str, Any]:
+    """Times the graph construction, a forward pass, a forward and backward pass and a rollout of one
+    model configuration on random inputs. All times are in seconds."""
+    num_longitudes, num_latitudes = _parse_grid(grid)
+    cordinates = (
+        np.linspace(start=-90, stop=90, num=num_latitudes, endpoint=True),
+        np.linspace(start=0, stop=360, num=num_longitudes, endpoint=False),
+    )
+    graph_config = GraphBuildingConfig(
+        grid2mesh_edge_creation="radius",
+        mesh2grid_edge_creation="contained",
+        grid2mesh_radius_query=0.5,
+        mesh_levels=sorted({max(0, mesh_level - 2), mesh_level}),
+    )
+    pipeline_config = build_pipeline_config(layer_type, product_graph_type)
+    data_config = DataConfig(
+        dataset_name="synthetic",
+        num_features_used=NUM_FEATURES,
+        obs_window_used=OBS_WINDOW,
+        pred_window_used=1,
+        want_feats_flattened=True,
+    )
+
+    torch.manual_seed(0)
+    model = WeatherPrediction(
+        cordinates=cordinates,
+        graph_config=graph_config,
+        pipeline_config=pipeline_config,
+        data_config=data_config,
+        device=torch.device("cpu"),
+    )
+    graph_construction = _time(
+        lambda: model._create_static_graphs(
+            cordinates=cordinates,
+            graph_config=graph_config,
+            pipeline_config=pipeline_config,
+        ),
+        repeats=1,
+        warmup=0,
+    )
+
+    X = torch.randn(1, num_longitudes * num_latitudes, OBS_WINDOW * NUM_FEATURES)
+    y = torch.randn(num_longitudes * num_latitudes, NUM_FEATURES)
+    loss_fn = nn.MSELoss()
+
+    def forward():
+        with torch.no_grad():
+            model(X=X, attention_threshold=0.0)
+
+    def forward_backward():
+        model.zero_grad()
+        loss_fn(model(X=X, attention_threshold=0.0), y).backward()
+
+    def rollout():
+        with torch.no_grad():
+            model.rollout(X=X, num_steps=rollout_steps)
+
+    model.eval()
+    forward_time = _time(forward, repeats=repeats)
+    rollout_time = _time(rollout, repeats=max(1, repeats // 2))
+    model.train()
+    forward_backward_time = _time(forward_backward, repeats=repeats)
+
+    return {
+        "graph_construction": graph_construction,
+        "forward": forward_time,
+        "forward_backward": forward_backward_time,
+        "rollout": rollout_time,
+        "num_edges": model.num_edges_per_graph(),
+        "num_parameters": sum(parameter.numel() for parameter in model.parameters()),
+    }
+
+
+def _case_name(params: Dict[str, Any]) -> str:
+    return "{layer_type}|{product_graph}|mesh{mesh_level}|{grid}".format(
+        layer_type=params["layer_type"],
+        product_graph=params["product_graph"] or "none",
+        mesh_level=params["mesh_level"],
+        grid=params["grid"],
+    )
+
+
+def build_cases(
+    layer_types: List[GraphLayerType],
+    product_graph_types: List[ProductGraphType],
+    mesh_levels: List[int],
+    grids: List[str],
+    product_graph_mesh_level: int,
+) -> List[Dict[str, Any]]:
+    """Every processor layer type on every mesh level and grid, and every product graph type on every grid
+    with the GCN processor on a fixed mesh level."""
+    cases = [
+        {"layer_type": layer_type.value, "product_graph": None, "mesh_level": mesh_level, "grid": grid}
+        for layer_type in layer_types
+        for mesh_level in mesh_levels
+        for grid in grids
+    ]
+    cases += [
+        {
+            "layer_type": GraphLayerType.ConvGCN.value,
+            "product_graph": product_graph_type.value,
+            "mesh_level": product_graph_mesh_level,
+            "grid": grid,
+        }
+        for product_graph_type in product_graph_types
+        for grid in grids
+    ]
+    return cases
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def run_benchmarks(
+    cases: List[Dict[str, Any]], repeats: int = 5, rollout_steps: int = 20
+) -> Dict[str, Any]:
+    results = []
+    for params in cases:
+        name = _case_name(params)
+        num_longitudes, num_latitudes = _parse_grid(params["grid"])
+        if (
+            params["product_graph"] is not None
+            and num_longitudes * num_latitudes * OBS_WINDOW > MAX_DENSE_PRODUCT_GRAPH_NODES
+        ):
+            print(f"{name}: skipped, the dense product graph would be too large")
+            results.append({"name": name, "params": params, "status": "skipped"})
+            continue
+
+        print(f"{name}: running")
+        try:
+            timings = benchmark_case(
+                layer_type=GraphLayerType(params["layer_type"]),
+                product_graph_type=None
+                if params["product_graph"] is None
+                else ProductGraphType(params["product_graph"]),
+                mesh_level=params["mesh_level"],
+                grid=params["grid"],
+                repeats=repeats,
+                rollout_steps=rollout_steps,
+            )
+        except Exception as e:
+            print(f"{name}: failed with {e!r}")
+            results.append({"name": name, "params": params, "status": f"failed: {e!r}"})
+            continue
+
+        results.append({"name": name, "params": params, "status": "ok", **timings})
+        print(
+            "    "
+            + ", ".join(f"{metric} {timings[metric]['median']:.4f}s" for metric in METRICS)
+        )
+
+    return {
+        "metadata": {**_metadata(), "repeats": repeats, "rollout_steps": rollout_steps},
+        "results": results,
+    }
+
+
+def compare_results(
+    baseline: Dict[str, Any],
+    candidate: Dict[str, Any],
+    threshold: float = 0.1,
+    min_difference: float = 1e-3,
+) -> List[Dict[str, Any]]:
+    """Compares the median times of two benchmark runs case by case. A metric regressed if the candidate
+    is more than `threshold` slower than the baseline, and improved if it is more than `threshold` faster.
+    Differences below `min_difference` seconds are treated as noise."""
+    baseline_results = {
+        result["name"]: result for result in baseline["results"] if result["status"] == "ok"
+    }
+
+    comparisons = []
+    for result in candidate["results"]:
+        if result["status"] != "ok" or result["name"] not in baseline_results:
+            continue
+
+        for metric in METRICS:
+            base_time = baseline_results[result["name"]][metric]["median"]
+            new_time = result[metric]["median"]
+            ratio = new_time / base_time if base_time > 0 else float("inf")
+            if abs(new_time - base_time) < min_difference:
+                status = ""
+            elif ratio > 1 + threshold:
+                status = "REGRESSION"
+            elif ratio < 1 - threshold:
+                status = "improved"
+            else:
+                status = ""
+
+            comparisons.append(
+                {
+                    "name": result["name"],
+                    "metric": metric,
+                    "baseline": base_time,
+                    "candidate": new_time,
+                    "ratio": ratio,
+                    "status": status,
+                }
+            )
+
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Weather Prediction model.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Runs the benchmarks.")
+    run_parser.add_argument(
+        "--layer-types",
+        nargs="+",
+        type=GraphLayerType,
+        default=list(GraphLayerType),
+    )
+    run_parser.add_argument(
+        "--product-graph-types",
+        nargs="*",
+        type=ProductGraphType,
+        default=list(ProductGraphType),
+    )
+    run_parser.add_argument("--mesh-levels", nargs="+", type=int, default=[2, 3, 4, 5, 6])
+    run_parser.add_argument("--grids", nargs="+", default=["32x16", "64x32", "128x64"])
+    run_parser.add_argument(
+        "--product-graph-mesh-level",
+        type=int,
+        default=3,
+        help="The mesh level of the product graph cases.",
+    )
+    run_parser.add_argument("--repeats", type=int, default=5)
+    run_parser.add_argument("--rollout-steps", type=int, default=20)
+    run_parser.add_argument("--output", default="benchmark_results.json")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compares two benchmark runs and flags regressions."
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="The relative slowdown that counts as a regression.",
+    )
+    compare_parser.add_argument(
+        "--min-difference",
+        type=float,
+        default=1e-3,
+        help="Differences below this many seconds are ignored.",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        cases = build_cases(
+            layer_types=args.layer_types,
+            product_graph_types=args.product_graph_types,
+            mesh_levels=args.mesh_levels,
+            grids=args.grids,
+            product_graph_mesh_level=args.product_graph_mesh_level,
+        )
+        results = run_benchmarks(
+            cases, repeats=args.repeats, rollout_steps=args.rollout_steps
+        )
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Benchmark results saved to {args.output}")
+
+    else:
+        with open(args.baseline, "r") as infile:
+            baseline = json.load(infile)
+        with open(args.candidate, "r") as infile:
+            candidate = json.load(infile)
+
+        comparisons = compare_results(
+            baseline,
+            candidate,
+            threshold=args.threshold,
+            min_difference=args.min_difference,
+        )
+        print(f"{'case':<45} {'metric':<20} {'baseline (s)':>13} {'candidate (s)':>14} {'ratio':>7}")
+        for comparison in comparisons:
+            print(
+                f"{comparison['name']:<45} {comparison['metric']:<20} {comparison['baseline']:>13.4f} "
+                f"{comparison['candidate']:>14.4f} {comparison['ratio']:>7.2f} {comparison['status']}"
+            )
+
+        num_regressions = sum(comparison["status"] == "REGRESSION" for comparison in comparisons)
+        print(f"{num_regressions} regressions with a threshold of {args.threshold:.0%}")
+        sys.exit(1 if num_regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Compares bfloat16 autocast with float32 for a trained model on CPU.
+
+For both precisions, the RMSE of every variable is computed on a split of the dataset, and the throughput of
+the forward pass and of a training step (forward, backward and optimiser step) is measured on its samples.
+The training steps run on a copy of the model, so the trained weights are not changed.
+
+Example
+-------
+python -m benchmarks.precision "<path-to-experinment-directory>" --split test --max-samples 50
+"""
+
+import argparse
+import copy
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+import torch
+import torch.nn as nn
+
+from src.config import Precision
+from src.models import WeatherPrediction
+from src.precision import autocast
+
+
+def _split_rmse(
+    model: WeatherPrediction, dataset, num_samples: int, precision: Precision
+) -> Dict[str, Any]:
+    squared_error = torch.zeros(model.num_features, dtype=torch.float64)
+    predictions = []
+    with torch.no_grad(), autocast(precision, "cpu"):
+        for i in range(num_samples):
+            X, y = dataset[i]
+            prediction = model(X=X.unsqueeze(0).float(), attention_threshold=0.0)
+            y = y.reshape(y.shape[0], -1)[:, : model.num_features]
+            squared_error += ((prediction.double() - y.double()) ** 2).sum(dim=0)
+            predictions.append(prediction)
+
+    num_values = num_samples * model._num_grid_nodes
+    return {"rmse": (squared_error / num_values).sqrt(), "predictions": predictions}
+
+
+def _throughput(
+    model: WeatherPrediction, dataset, num_samples: int, precision: Precision, train: bool
+) -> float:
+    """The samples per second of the forward pass, or of a training step if `train` is set."""
+    loss_fn = nn.MSELoss()
+    optimiser = torch.optim.Adam(model.parameters(), lr=1e-5) if train else None
+    model.train(train)
+
+    def _step(X: torch.Tensor, y: torch.Tensor):
+        if not train:
+            with torch.no_grad(), autocast(precision, "cpu"):
+                model(X=X, attention_threshold=0.0)
+            return
+
+        optimiser.zero_grad()
+        with autocast(precision, "cpu"):
+            outs = model(X=X, attention_threshold=0.0)
+        # The loss is computed in float32, outside of autocast
+        loss_fn(outs, y).backward()
+        optimiser.step()
+
+    samples = []
+    for i in range(num_samples):
+        X, y = dataset[i]
+        y = y.reshape(y.shape[0], -1)[:, : model.num_features].float()
+        samples.append((X.unsqueeze(0).float(), y))
+
+    # Warm up
+    _step(*samples[0])
+
+    start = time.perf_counter()
+    for X, y in samples:
+        _step(X, y)
+
+    return num_samples / (time.perf_counter() - start)
+
+
+def compare_precisions(
+    model: WeatherPrediction, dataset, max_samples: Optional[int] = None
+) -> Dict[str, Any]:
+    """Compares the accuracy and the throughput of bfloat16 autocast with float32.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model on CPU.
+    dataset
+        The split to evaluate on, with samples of the form (X, y).
+    max_samples : Optional[int]
+        Only uses the first samples of the split.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Per variable the RMSE of both precisions and the RMSE between their forecasts, and per precision
+        the forward and training step throughput in samples per second.
+    """
+    num_samples = len(dataset) if max_samples is None else min(max_samples, len(dataset))
+
+    accuracy = {
+        precision: _split_rmse(model, dataset, num_samples, precision)
+        for precision in (Precision.FP32, Precision.BF16)
+    }
+    drift_squared_error = sum(
+        ((bf16 - fp32).double() ** 2).sum(dim=0)
+        for fp32, bf16 in zip(
+            accuracy[Precision.FP32]["predictions"], accuracy[Precision.BF16]["predictions"]
+        )
+    )
+    drift = (drift_squared_error / (num_samples * model._num_grid_nodes)).sqrt()
+
+    throughput = {}
+    for precision in (Precision.FP32, Precision.BF16):
+        throughput[precision.value] = {
+            "forward_samples_per_second": _throughput(
+                model, dataset, num_samples, precision, train=False
+            ),
+            "train_samples_per_second": _throughput(
+                copy.deepcopy(model), dataset, num_samples, precision, train=True
+            ),
+        }
+    model.eval()
+
+    return {
+        "num_samples": num_samples,
+        "variables": {
+            f"feature_{i}": {
+                "fp32_rmse": accuracy[Precision.FP32]["rmse"][i].item(),
+                "bf16_rmse": accuracy[Precision.BF16]["rmse"][i].item(),
+                "drift_rmse": drift[i].item(),
+            }
+            for i in range(model.num_features)
+        },
+        "throughput": throughput,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the accuracy and throughput of bfloat16 autocast with float32 on CPU."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument("--split", choices=["train", "val", "test"], default="test")
+    parser.add_argument("--max-samples", type=int, default=None)
+    parser.add_argument("--output", default=None, help="Saves the results as JSON.")
+    args = parser.parse_args()
+
+    from src.data.dataloader import load_train_and_test_datasets
+    from src.predict import load_trained_model
+
+    model, experiment_config, _ = load_trained_model(
+        args.experiment_directory, device=torch.device("cpu"), checkpoint_path=args.checkpoint
+    )
+    splits = load_train_and_test_datasets(
+        data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+        data_config=experiment_config.data,
+    )
+    dataset = splits[["train", "val", "test"].index(args.split)]
+
+    results = compare_precisions(model, dataset, max_samples=args.max_samples)
+
+    print(f"{'variable':<12} {'fp32 RMSE':>10} {'bf16 RMSE':>10} {'drift RMSE':>11}")
+    for name, result in results["variables"].items():
+        print(
+            f"{name:<12} {result['fp32_rmse']:>10.5f} {result['bf16_rmse']:>10.5f} {result['drift_rmse']:>11.5f}"
+        )
+
+    print(f"{'precision':<10} {'forward (samples/s)':>20} {'train step (samples/s)':>23}")
+    for precision, result in results["throughput"].items():
+        print(
+            f"{precision:<10} {result['forward_samples_per_second']:>20.2f} "
+            f"{result['train_samples_per_second']:>23.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Precision results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
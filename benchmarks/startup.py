@@ -0,0 +1,193 @@
+"""Measures the cold start of the model, from starting the interpreter to the first forecast.
+
+Every repeat runs in a fresh process, which imports the modules, loads the model with its static graphs
+from the graph cache and runs one forward pass. The graphs are built once before the timed runs, since
+building them is a one-off cost. The run fails if the median cold start exceeds the budget.
+
+This module only imports the standard library at the top, so that the imports of a run are timed as well.
+
+Example
+-------
+python -m benchmarks.startup experiments/baseline --repeats 5 --budget-seconds 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+
+# The budget for the median time from starting the interpreter to the first forecast, in seconds
+DEFAULT_BUDGET_SECONDS = 10.0
+
+PHASES = ["interpreter", "imports", "model", "first_forecast"]
+
+_RESULT_PREFIX = "STARTUP_RESULT "
+
+
+def _startup_run(experiment_dir: str, graph_cache_dir: str, process_start: float):
+    """Runs in the fresh process and prints the duration of every phase."""
+    start = time.time()
+
+    import torch
+
+    from src.config import ExperimentConfig
+    from src.constants import FileNames
+    from src.data.data_configs import get_dataset_metadata
+    from src.main import load_model_from_experiment_config
+    from src.utils import load_from_json_file
+
+    imported = time.time()
+
+    experiment_config = ExperimentConfig(
+        **load_from_json_file(os.path.join(experiment_dir, FileNames.EXPERIMENT_CONFIG))
+    )
+    dataset_metadata = get_dataset_metadata(
+        experiment_config.data.dataset_name,
+        data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+    )
+    model = load_model_from_experiment_config(
+        experiment_config=experiment_config,
+        device=torch.device("cpu"),
+        dataset_metadata=dataset_metadata,
+        graph_cache_dir=graph_cache_dir,
+    )
+    model.eval()
+    loaded = time.time()
+
+    num_grid_nodes = dataset_metadata.num_latitudes * dataset_metadata.num_longitudes
+    X = torch.zeros(
+        1,
+        num_grid_nodes,
+        experiment_config.data.obs_window_used * experiment_config.data.num_features_used,
+    )
+    with torch.no_grad():
+        model(X=X, attention_threshold=0.0)
+    forecasted = time.time()
+
+    result = {
+        "interpreter": start - process_start,
+        "imports": imported - start,
+        "model": loaded - imported,
+        "first_forecast": forecasted - loaded,
+        "total": forecasted - process_start,
+    }
+    print(_RESULT_PREFIX + json.dumps(result))
+
+
+def _run_in_fresh_process(experiment_dir: str, graph_cache_dir: str) -> Dict[str, float]:
+    # Wall clock time, since the start has to be comparable between the two processes
+    process_start = time.time()
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.startup",
+            experiment_dir,
+            "--run",
+            "--graph-cache-dir",
+            graph_cache_dir,
+            "--process-start",
+            repr(process_start),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"The startup run failed:\n{completed.stderr}")
+
+    for line in completed.stdout.splitlines():
+        if line.startswith(_RESULT_PREFIX):
+            return json.loads(line[len(_RESULT_PREFIX) :])
+
+    raise RuntimeError(f"The startup run did not report a result:\n{completed.stdout}")
+
+
+def run_startup_benchmark(
+    experiment_dir: str, repeats: int = 5, graph_cache_dir: str = None
+) -> Dict[str, Any]:
+    """Measures the cold start of the experiment's model in `repeats` fresh processes.
+
+    Parameters
+    ----------
+    experiment_dir : str
+        The experiment directory that contains the config.json file.
+    repeats : int
+        The number of timed runs.
+    graph_cache_dir : str
+        The graph cache to load the static graphs from. Defaults to a temporary directory.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The median and the maximum of every phase and of the total, and the individual runs.
+    """
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        graph_cache_dir = graph_cache_dir or temporary_dir
+
+        # Makes sure the graphs are cached
+        _run_in_fresh_process(experiment_dir, graph_cache_dir)
+
+        runs = [_run_in_fresh_process(experiment_dir, graph_cache_dir) for _ in range(repeats)]
+
+    return {
+        "median": {phase: statistics.median(run[phase] for run in runs) for phase in PHASES + ["total"]},
+        "max": {phase: max(run[phase] for run in runs) for phase in PHASES + ["total"]},
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the time from starting the interpreter to the first forecast."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file.",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--budget-seconds",
+        type=float,
+        default=DEFAULT_BUDGET_SECONDS,
+        help="Fails if the median cold start takes longer.",
+    )
+    parser.add_argument("--graph-cache-dir", default=None)
+    parser.add_argument("--output", default=None, help="Saves the results as JSON.")
+    # Used for the timed runs in the fresh processes
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--process-start", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        _startup_run(args.experiment_directory, args.graph_cache_dir, args.process_start)
+        return
+
+    results = run_startup_benchmark(
+        args.experiment_directory, repeats=args.repeats, graph_cache_dir=args.graph_cache_dir
+    )
+    results["budget_seconds"] = args.budget_seconds
+
+    print(f"{'phase':<16} {'median (s)':>11} {'max (s)':>9}")
+    for phase in PHASES + ["total"]:
+        print(f"{phase:<16} {results['median'][phase]:>11.3f} {results['max'][phase]:>9.3f}")
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Startup results saved to {args.output}")
+
+    within_budget = results["median"]["total"] <= args.budget_seconds
+    print(
+        f"Cold start of {results['median']['total']:.2f}s is "
+        f"{'within' if within_budget else 'over'} the budget of {args.budget_seconds:.2f}s"
+    )
+    sys.exit(0 if within_budget else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,481 @@
+"""
+Parallel ingestion of a multi-year ERA5 subset into a sharded, normalised dataset.
+
+The requested years (and optionally variables) are split into independent jobs which run in a
+process pool, each worker with a bounded memory budget. Every job writes a raw shard and the
+statistics needed for normalisation. The shards of a year are then merged and normalised with the
+statistics of all years, so all shards share one normalisation manifest.
+
+example:
+python -m data.ingestion gs://weatherbench2/datasets/era5/1959-2022-6h-64x32_equiangular_with_poles_conservative.zarr data/datasets/era5_64x32_2005_2010 --years 2005 2006 2007 2008 2009 2010 --variables 10m_u_component_of_wind 10m_v_component_of_wind 2m_temperature --workers 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import xarray as xr
+
+from .data_loading import (
+    get_xarray_dataset,
+    get_selected_variables,
+    get_selected_time_range,
+    write_dataset_to_netcdf,
+    read_dataset_from_netcdf,
+)
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+RAW_SHARDS_DIR = "raw"
+SHARDS_DIR = "shards"
+
+# Dimensions that are reduced for the normalisation statistics, all others (e.g. level) are kept
+_STATISTICS_DIMS = ("time", "longitude", "latitude")
+
+
+def _init_worker(memory_limit_bytes: Optional[int]):
+    """
+    Limits the memory of the worker process and makes dask compute in the worker's own thread,
+    so the number of workers defines the parallelism.
+    """
+    import dask
+
+    if memory_limit_bytes:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit_bytes, memory_limit_bytes))
+
+    dask.config.set(scheduler="synchronous")
+
+
+def _time_chunk_size(dataset: xr.Dataset, memory_limit_bytes: Optional[int]) -> int:
+    """
+    Get the number of time steps per chunk such that a few chunks fit in the memory budget
+
+    params:
+    dataset:
+        xarray.Dataset: the lazily opened dataset of a job
+    memory_limit_bytes:
+        int: the memory budget of the worker
+
+    returns:
+    chunk_size:
+        int: the number of time steps per chunk
+    """
+    if not memory_limit_bytes:
+        return 48
+
+    bytes_per_time_step = dataset.nbytes / max(dataset.sizes["time"], 1)
+    # Leave room for the input chunk, the intermediate results and the output buffer
+    return max(1, int(memory_limit_bytes / (4 * bytes_per_time_step)))
+
+
+def _ingest_job(
+    url: str,
+    year: int,
+    variables: List[str],
+    levels: Optional[List[int]],
+    raw_shard_path: str,
+    memory_limit_bytes: Optional[int],
+) -> Dict:
+    """
+    Select a year and a group of variables, write them to a raw shard and compute the
+    statistics needed for the normalisation
+
+    returns:
+    job_result:
+        dict: the path of the raw shard, the statistics and the wall time of the job
+    """
+    start = time.perf_counter()
+
+    dataset = get_xarray_dataset(url)
+    dataset = get_selected_variables(dataset, variables)
+    dataset = get_selected_time_range(dataset, f"{year}-01-01", f"{year}-12-31")
+    if levels is not None and "level" in dataset.dims:
+        dataset = dataset.sel(level=levels)
+
+    dataset = dataset.chunk({"time": _time_chunk_size(dataset, memory_limit_bytes)})
+    write_dataset_to_netcdf(dataset, raw_shard_path)
+
+    # Compute the statistics from the written shard instead of reading the source twice.
+    # They are accumulated in float64 and centred per job, so merging them stays accurate.
+    shard = read_dataset_from_netcdf(
+        raw_shard_path, chunk_size=_time_chunk_size(dataset, memory_limit_bytes)
+    ).astype(np.float64)
+    mean = shard.mean(dim=_STATISTICS_DIMS).compute()
+    statistics = {
+        "count": shard.count(dim=_STATISTICS_DIMS).compute(),
+        "mean": mean,
+        "sum_of_squared_deviations": ((shard - mean) ** 2)
+        .sum(dim=_STATISTICS_DIMS)
+        .compute(),
+    }
+    shard.close()
+
+    return {
+        "year": year,
+        "variables": variables,
+        "raw_shard_path": raw_shard_path,
+        "statistics": statistics,
+        "wall_time": time.perf_counter() - start,
+    }
+
+
+def _merge_statistics(job_results: List[Dict]) -> Dict[str, xr.Dataset]:
+    """
+    Combine the statistics of all jobs into the mean and the standard deviation of every variable,
+    using the pairwise update of Chan et al. for the means and the sums of squared deviations
+
+    returns:
+    statistics:
+        dict: the mean and std as xarray.Dataset with a variable for every ingested variable
+    """
+    totals = {}
+    for job_result in job_results:
+        job_statistics = job_result["statistics"]
+        for variable in job_statistics["mean"].data_vars:
+            count = job_statistics["count"][variable]
+            mean = job_statistics["mean"][variable]
+            m2 = job_statistics["sum_of_squared_deviations"][variable]
+
+            if variable not in totals:
+                totals[variable] = (count, mean, m2)
+                continue
+
+            total_count, total_mean, total_m2 = totals[variable]
+            merged_count = total_count + count
+            delta = mean - total_mean
+            totals[variable] = (
+                merged_count,
+                total_mean + delta * count / merged_count,
+                total_m2 + m2 + delta**2 * total_count * count / merged_count,
+            )
+
+    variables = sorted(totals)
+    mean = xr.Dataset({variable: totals[variable][1] for variable in variables})
+    std = xr.Dataset(
+        {
+            variable: np.sqrt(totals[variable][2] / totals[variable][0])
+            for variable in variables
+        }
+    )
+
+    return {"mean": mean, "std": std}
+
+
+def _merge_and_normalise_year(
+    year: int,
+    raw_shard_paths: List[str],
+    shard_path: str,
+    mean: xr.Dataset,
+    std: xr.Dataset,
+    memory_limit_bytes: Optional[int],
+) -> Dict:
+    """
+    Merge the raw shards of the variable groups of a year into one normalised shard
+
+    returns:
+    job_result:
+        dict: the year, the path of the shard, its number of time steps and the wall time
+    """
+    start = time.perf_counter()
+
+    raw_shards = [read_dataset_from_netcdf(path) for path in raw_shard_paths]
+    dataset = xr.merge(raw_shards)
+    dataset = dataset.chunk({"time": _time_chunk_size(dataset, memory_limit_bytes)})
+    # The statistics are float64, the shards keep the precision of the source
+    dataset = ((dataset - mean) / std).astype(np.float32)
+
+    write_dataset_to_netcdf(dataset, shard_path)
+    num_time_steps = dataset.sizes["time"]
+
+    for raw_shard in raw_shards:
+        raw_shard.close()
+
+    return {
+        "year": year,
+        "path": shard_path,
+        "num_time_steps": num_time_steps,
+        "wall_time": time.perf_counter() - start,
+    }
+
+
+def _statistics_to_json(statistics: xr.Dataset) -> Dict:
+    return {variable: statistics[variable].values.tolist() for variable in statistics.data_vars}
+
+
+def ingest_dataset(
+    url: str,
+    output_dir: str,
+    years: List[int],
+    variables: List[str],
+    levels: Optional[List[int]] = None,
+    split_variables: bool = False,
+    num_workers: int = 4,
+    memory_per_worker_gb: Optional[float] = None,
+):
+    """
+    Ingest the selected years and variables in parallel into a sharded dataset with one shard per year
+    and a manifest with the normalisation statistics
+
+    params:
+    url:
+        string: the url of the zarr dataset
+    output_dir:
+        string: the directory to write the shards and the manifest to
+    years:
+        list: the years to ingest, every year is at least one job
+    variables:
+        list: the variables to ingest
+    levels:
+        list: the pressure levels to keep for variables with levels, all if None
+    split_variables:
+        bool: whether to also split the variables into one job per variable
+    num_workers:
+        int: the number of worker processes
+    memory_per_worker_gb:
+        float: the memory budget of every worker, unbounded if None
+
+    returns:
+    manifest:
+        dict: the manifest of the sharded dataset
+
+    example:
+    manifest = ingest_dataset(url, 'data/datasets/era5_2005_2010', years=[2005, 2006], variables=['2m_temperature'])
+    """
+    start = time.perf_counter()
+
+    memory_limit_bytes = (
+        int(memory_per_worker_gb * 1024**3) if memory_per_worker_gb else None
+    )
+    variable_groups = [[variable] for variable in variables] if split_variables else [variables]
+
+    raw_shards_dir = os.path.join(output_dir, RAW_SHARDS_DIR)
+    shards_dir = os.path.join(output_dir, SHARDS_DIR)
+    os.makedirs(raw_shards_dir, exist_ok=True)
+    os.makedirs(shards_dir, exist_ok=True)
+
+    # Spawn the workers as forking a process that has used gcsfs or dask threads is not safe
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(memory_limit_bytes,),
+    ) as executor:
+
+        ingest_futures = [
+            executor.submit(
+                _ingest_job,
+                url=url,
+                year=year,
+                variables=group,
+                levels=levels,
+                raw_shard_path=os.path.join(
+                    raw_shards_dir, f"{year}_{group_index:03d}.nc"
+                ),
+                memory_limit_bytes=memory_limit_bytes,
+            )
+            for year in years
+            for group_index, group in enumerate(variable_groups)
+        ]
+        ingest_results = [future.result() for future in ingest_futures]
+
+        print("Raw shards written, merging the normalisation statistics")
+        statistics = _merge_statistics(ingest_results)
+
+        merge_futures = [
+            executor.submit(
+                _merge_and_normalise_year,
+                year=year,
+                raw_shard_paths=[
+                    result["raw_shard_path"]
+                    for result in ingest_results
+                    if result["year"] == year
+                ],
+                shard_path=os.path.join(shards_dir, f"{year}.nc"),
+                mean=statistics["mean"],
+                std=statistics["std"],
+                memory_limit_bytes=memory_limit_bytes,
+            )
+            for year in years
+        ]
+        merge_results = [future.result() for future in merge_futures]
+
+    shutil.rmtree(raw_shards_dir)
+
+    wall_time = time.perf_counter() - start
+    job_time = sum(result["wall_time"] for result in ingest_results + merge_results)
+
+    manifest = {
+        "url": url,
+        "variables": variables,
+        "levels": levels,
+        "shards": [
+            {
+                "year": result["year"],
+                "path": os.path.relpath(result["path"], output_dir),
+                "num_time_steps": result["num_time_steps"],
+            }
+            for result in merge_results
+        ],
+        "normalisation": {
+            "mean": _statistics_to_json(statistics["mean"]),
+            "std": _statistics_to_json(statistics["std"]),
+        },
+        "num_workers": num_workers,
+        "wall_time": wall_time,
+        "serial_job_time": job_time,
+    }
+
+    with open(os.path.join(output_dir, MANIFEST_FILE_NAME), "w") as outfile:
+        json.dump(manifest, outfile, indent=2)
+
+    print(
+        f"Ingested {len(years)} years with {num_workers} workers in {wall_time:.1f}s, "
+        f"the jobs took {job_time:.1f}s in total ({job_time / wall_time:.2f} jobs running in parallel on average)"
+    )
+
+    return manifest
+
+
+def load_manifest(dataset_dir: str) -> Dict:
+    """
+    Load the manifest of a sharded dataset
+
+    params:
+    dataset_dir:
+        string: the directory of the sharded dataset
+
+    returns:
+    manifest:
+        dict: the manifest with the shards and the normalisation statistics
+    """
+    with open(os.path.join(dataset_dir, MANIFEST_FILE_NAME), "r") as infile:
+        return json.load(infile)
+
+
+def open_sharded_dataset(dataset_dir: str, chunk_size: int = 48):
+    """
+    Open all the shards of a sharded dataset as one lazy xarray dataset
+
+    params:
+    dataset_dir:
+        string: the directory of the sharded dataset
+    chunk_size:
+        int: the number of time steps per chunk
+
+    returns:
+    dataset:
+        xarray.Dataset: the normalised dataset over all years
+    """
+    manifest = load_manifest(dataset_dir)
+    shard_paths = [os.path.join(dataset_dir, shard["path"]) for shard in manifest["shards"]]
+    return xr.open_mfdataset(
+        shard_paths, combine="by_coords", chunks={"time": chunk_size}
+    )
+
+
+def benchmark_ingestion(
+    url: str,
+    years: List[int],
+    variables: List[str],
+    worker_counts: List[int],
+    **ingest_kwargs,
+) -> List[Dict]:
+    """
+    Run the ingestion with different numbers of workers and report the wall-clock speedup
+    against the first worker count
+
+    returns:
+    results:
+        list: the wall time and the speedup for every worker count
+    """
+    results = []
+    for num_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as output_dir:
+            manifest = ingest_dataset(
+                url=url,
+                output_dir=output_dir,
+                years=years,
+                variables=variables,
+                num_workers=num_workers,
+                **ingest_kwargs,
+            )
+        results.append({"num_workers": num_workers, "wall_time": manifest["wall_time"]})
+
+    baseline = results[0]["wall_time"]
+    print(f"{'workers':>8} {'wall time (s)':>14} {'speedup':>8}")
+    for result in results:
+        result["speedup"] = baseline / result["wall_time"]
+        print(
+            f"{result['num_workers']:>8} {result['wall_time']:>14.1f} {result['speedup']:>8.2f}"
+        )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ingests years of a zarr dataset in parallel into a sharded, normalised dataset."
+    )
+    parser.add_argument("url")
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help="The directory of the sharded dataset, not needed with --benchmark-workers.",
+    )
+    parser.add_argument("--years", type=int, nargs="+", required=True)
+    parser.add_argument("--variables", nargs="+", required=True)
+    parser.add_argument("--levels", type=int, nargs="+", default=None)
+    parser.add_argument(
+        "--split-variables",
+        action="store_true",
+        help="Ingest every variable of a year in its own job.",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--memory-per-worker-gb", type=float, default=None)
+    parser.add_argument(
+        "--benchmark-workers",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Run the ingestion once for every worker count and report the speedup instead.",
+    )
+    args = parser.parse_args()
+    if args.output_dir is None and not args.benchmark_workers:
+        parser.error("the output_dir is required unless --benchmark-workers is given")
+
+    ingest_kwargs = dict(
+        levels=args.levels,
+        split_variables=args.split_variables,
+        memory_per_worker_gb=args.memory_per_worker_gb,
+    )
+
+    if args.benchmark_workers:
+        benchmark_ingestion(
+            url=args.url,
+            years=args.years,
+            variables=args.variables,
+            worker_counts=args.benchmark_workers,
+            **ingest_kwargs,
+        )
+    else:
+        ingest_dataset(
+            url=args.url,
+            output_dir=args.output_dir,
+            years=args.years,
+            variables=args.variables,
+            num_workers=args.workers,
+            **ingest_kwargs,
+        )
+
+
+if __name__ == "__main__":
+    main()
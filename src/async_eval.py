@@ -0,0 +1,271 @@
+"""Evaluates weight snapshots in a separate worker process while the training loop continues."""
+
+import copy
+import os
+import queue
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from src.config import ExperimentConfig
+from src.data.dataloader import create_evaluation_subset, load_train_and_test_datasets
+from src.distributed import unwrap_model
+from src.throughput import ThroughputMeter
+from src.verification import StreamingMetrics, climatology_from_dataset, create_grid_metrics
+
+
+class EvalResult:
+    """The losses of the model after `epoch` epochs and the metrics of every variable on the test set.
+    `weights` are the evaluated weights, they are only valid until the result is released."""
+
+    def __init__(
+        self,
+        epoch: int,
+        val_loss: float,
+        test_loss: float,
+        throughput: Optional[Dict[str, Any]] = None,
+        weights: Optional[Dict[str, torch.Tensor]] = None,
+        slot: Optional[int] = None,
+        test_metrics: Optional[StreamingMetrics] = None,
+    ):
+        self.epoch = epoch
+        self.val_loss = val_loss
+        self.test_loss = test_loss
+        self.throughput = throughput
+        self.weights = weights
+        self.slot = slot
+        self.test_metrics = test_metrics
+
+
+def _evaluation_worker(
+    model: nn.Module,
+    slots: List[Dict[str, torch.Tensor]],
+    requests: mp.Queue,
+    results: mp.Queue,
+    experiment_config: ExperimentConfig,
+    data_path: str,
+    device,
+    num_threads: int,
+):
+    # Imported here since the training logic itself uses the evaluator
+    from src.train import test
+
+    torch.set_num_threads(num_threads)
+
+    # With the shared dataset cache this attaches to the data of the training process instead of loading it again
+    train_dataset, val_dataset, test_dataset, _ = load_train_and_test_datasets(
+        data_path=data_path,
+        data_config=experiment_config.data,
+        use_shared_cache=experiment_config.shared_dataset_cache,
+    )
+    val_dataloader, test_dataloader = (
+        DataLoader(
+            create_evaluation_subset(
+                dataset,
+                subset_size=experiment_config.eval_subset_size,
+                seed=experiment_config.random_seed,
+            ),
+            batch_size=experiment_config.batch_size,
+            shuffle=False,
+        )
+        for dataset in (val_dataset, test_dataset)
+    )
+    loss_fn = nn.MSELoss()
+    num_features = experiment_config.data.num_features_used
+    climatology = climatology_from_dataset(
+        train_dataset,
+        num_grid_nodes=len(model._grid_lat) * len(model._grid_lon),
+        num_features=num_features,
+    )
+
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+
+        epoch, slot, processing_graph = request
+        model.load_state_dict(slots[slot])
+        if processing_graph is not None:
+            model.processing_graph = processing_graph.to(device)
+
+        throughput = ThroughputMeter()
+        test_metrics = create_grid_metrics(
+            model, num_features=num_features, climatology=climatology, device=device
+        )
+        val_loss = test(
+            model=model,
+            test_dataloader=val_dataloader,
+            loss_fn=loss_fn,
+            device=device,
+            throughput=throughput,
+            precision=experiment_config.precision,
+        )
+        test_loss = test(
+            model=model,
+            test_dataloader=test_dataloader,
+            loss_fn=loss_fn,
+            device=device,
+            throughput=throughput,
+            precision=experiment_config.precision,
+            metrics=test_metrics,
+        )
+        results.put((epoch, slot, val_loss, test_loss, throughput.summary(), test_metrics))
+
+
+class AsyncEvaluator:
+    """Evaluates the model on the validation and the test set in a separate process, concurrently with the
+    next training epochs.
+
+    The weights are handed over through two snapshot buffers in shared memory. While the worker evaluates
+    one snapshot, the training loop can already publish the next one into the other buffer. A buffer stays
+    reserved until its result was collected and released, so the weights of the best epoch can still be
+    saved after they were evaluated.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The model that is trained. The worker evaluates a copy of it.
+    experiment_config : ExperimentConfig
+        The experiment config with the data and the evaluation settings.
+    data_path : str
+        The directory of the dataset.
+    device
+        The device the worker evaluates on.
+    """
+
+    NUM_SLOTS = 2
+
+    def __init__(
+        self,
+        model: nn.Module,
+        experiment_config: ExperimentConfig,
+        data_path: str,
+        device,
+    ):
+        model = unwrap_model(model)
+        self.device = device
+
+        self._slots = [
+            {
+                name: torch.empty_like(tensor, device="cpu").share_memory_()
+                for name, tensor in model.state_dict().items()
+            }
+            for _ in range(self.NUM_SLOTS)
+        ]
+        self._free_slots = list(range(self.NUM_SLOTS))
+        self._num_pending = 0
+
+        num_threads = experiment_config.eval_num_threads or max(
+            1, (os.cpu_count() or 1) // 4
+        )
+
+        context = mp.get_context("spawn")
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        # The worker gets its own copy, sharing the storage would let it overwrite the trained weights
+        self._process = context.Process(
+            target=_evaluation_worker,
+            args=(
+                copy.deepcopy(model).eval(),
+                self._slots,
+                self._requests,
+                self._results,
+                experiment_config,
+                data_path,
+                device,
+                num_threads,
+            ),
+            daemon=True,
+        )
+        self._process.start()
+
+    def has_free_slot(self) -> bool:
+        return len(self._free_slots) > 0
+
+    @property
+    def num_pending(self) -> int:
+        return self._num_pending
+
+    def submit(self, model: nn.Module, epoch: int):
+        """Copies the current weights into a free snapshot buffer and queues them for evaluation. Collect and
+        release results first if no buffer is free."""
+        if not self._free_slots:
+            raise RuntimeError("No free snapshot buffer, results have to be collected and released first.")
+
+        model = unwrap_model(model)
+        slot = self._free_slots.pop(0)
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                self._slots[slot][name].copy_(tensor)
+
+        # SparseGAT prunes the processing graph, which is not part of the state dict
+        processing_graph = None
+        if getattr(model, "using_sparse_gat", False):
+            processing_graph = model.processing_graph.detach().cpu().clone()
+
+        self._requests.put((epoch, slot, processing_graph))
+        self._num_pending += 1
+
+    def _get_result(self, block: bool):
+        while True:
+            try:
+                return self._results.get(timeout=1.0 if block else 0.01)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(
+                        f"The evaluation worker exited unexpectedly with code {self._process.exitcode}."
+                    )
+                if not block:
+                    return None
+
+    def collect(self, wait: bool = False, wait_all: bool = False) -> List[EvalResult]:
+        """Returns the results that are ready, in the order they were submitted.
+
+        Parameters
+        ----------
+        wait : bool
+            Blocks until at least one result is ready if any evaluation is pending.
+        wait_all : bool
+            Blocks until all pending evaluations are finished.
+
+        Returns
+        -------
+        List[EvalResult]
+            The results, each of which has to be released after it was processed.
+        """
+        collected = []
+        while self._num_pending > 0:
+            block = wait_all or (wait and not collected)
+            result = self._get_result(block=block)
+            if result is None:
+                break
+
+            epoch, slot, val_loss, test_loss, throughput, test_metrics = result
+            self._num_pending -= 1
+            collected.append(
+                EvalResult(
+                    epoch=epoch,
+                    val_loss=val_loss,
+                    test_loss=test_loss,
+                    throughput=throughput,
+                    weights=self._slots[slot],
+                    slot=slot,
+                    test_metrics=test_metrics,
+                )
+            )
+
+        return collected
+
+    def release(self, result: EvalResult):
+        """Makes the snapshot buffer of a processed result available for the next weights."""
+        if result.slot is not None:
+            self._free_slots.append(result.slot)
+            result.weights, result.slot = None, None
+
+    def close(self):
+        if self._process.is_alive():
+            self._requests.put(None)
+        self._process.join()
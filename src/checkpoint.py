@@ -0,0 +1,193 @@
+"""Asynchronous, atomic checkpointing of the full training state to resume interrupted runs."""
+
+import copy
+import glob
+import os
+import queue
+import random
+import re
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+from torch.optim import Optimizer
+
+from src.constants import FolderNames
+from src.utils import atomic_torch_save
+
+
+_CHECKPOINT_PATTERN = re.compile(r"checkpoint_epoch_(\d+)\.pt$")
+
+
+def _snapshot(obj: Any) -> Any:
+    """Copies a (nested) state so it can be written while training continues to update the original."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def get_rng_states() -> Dict[str, Any]:
+    rng_states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_states["cuda"] = torch.cuda.get_rng_state_all()
+
+    return rng_states
+
+
+def set_rng_states(rng_states: Dict[str, Any]):
+    random.setstate(rng_states["python"])
+    np.random.set_state(rng_states["numpy"])
+    torch.set_rng_state(rng_states["torch"])
+    if "cuda" in rng_states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_states["cuda"])
+
+
+def get_checkpoint_dir(results_save_dir: str) -> str:
+    return os.path.join(results_save_dir, FolderNames.CHECKPOINTS)
+
+
+def find_latest_checkpoint(checkpoint_dir: str) -> Optional[str]:
+    """Returns the path of the checkpoint with the highest epoch in the directory, or None if there is none."""
+    checkpoints = []
+    for path in glob.glob(os.path.join(checkpoint_dir, "checkpoint_epoch_*.pt")):
+        match = _CHECKPOINT_PATTERN.search(path)
+        if match:
+            checkpoints.append((int(match.group(1)), path))
+
+    if not checkpoints:
+        return None
+
+    return max(checkpoints)[1]
+
+
+def load_checkpoint(checkpoint_path: str, device) -> Dict[str, Any]:
+    # The checkpoint contains the python and numpy RNG states, which are not plain tensors
+    return torch.load(checkpoint_path, map_location=device, weights_only=False)
+
+
+def restore_training_state(
+    checkpoint: Dict[str, Any], model: torch.nn.Module, optimiser: Optimizer, device
+):
+    """Restores the model, the optimiser and the RNG states from a full training checkpoint."""
+    if hasattr(model, "check_state_dict_layout"):
+        model.check_state_dict_layout(checkpoint["model"])
+    model.load_state_dict(checkpoint["model"])
+    if checkpoint.get("processing_graph") is not None:
+        # SparseGAT prunes the processing graph during training, which is not part of the state dict
+        model.processing_graph = checkpoint["processing_graph"].to(device)
+
+    optimiser.load_state_dict(checkpoint["optimiser"])
+    set_rng_states(checkpoint["rng_states"])
+
+
+class CheckpointManager:
+    """Saves checkpoints on a background thread so that serialising does not block the training loop.
+
+    The state is copied when it is handed over, so the training loop can continue updating the model
+    right away. Every file is written atomically. Only the last `num_to_keep` full training checkpoints
+    are kept, other files like the best model are simply overwritten.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        The directory for the periodic full training checkpoints.
+    num_to_keep : int
+        The number of full training checkpoints to keep.
+    """
+
+    def __init__(self, checkpoint_dir: str, num_to_keep: int = 3):
+        self.checkpoint_dir = checkpoint_dir
+        self.num_to_keep = num_to_keep
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # Bounded, so that a slow disk holds back training instead of piling up snapshots in memory
+        self._queue = queue.Queue(maxsize=2)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            state, path, is_training_checkpoint = item
+            try:
+                atomic_torch_save(state, path)
+                if is_training_checkpoint:
+                    self._remove_old_checkpoints()
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _remove_old_checkpoints(self):
+        checkpoints = sorted(
+            (int(match.group(1)), path)
+            for path in glob.glob(os.path.join(self.checkpoint_dir, "checkpoint_epoch_*.pt"))
+            if (match := _CHECKPOINT_PATTERN.search(path))
+        )
+        for _, path in checkpoints[: -self.num_to_keep]:
+            os.remove(path)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed.") from error
+
+    def save(self, state: Dict[str, Any], path: str):
+        """Saves a state, e.g. the state dict of the best model, to the given path."""
+        self._raise_if_failed()
+        self._queue.put((_snapshot(state), path, False))
+
+    def save_training_checkpoint(self, state: Dict[str, Any], epoch: int):
+        """Saves the full training state after the given epoch and removes the oldest checkpoints."""
+        self._raise_if_failed()
+        path = os.path.join(self.checkpoint_dir, f"checkpoint_epoch_{epoch:06d}.pt")
+        self._queue.put((_snapshot(state), path, True))
+
+    def wait(self):
+        """Blocks until all pending checkpoints are written."""
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+
+def build_training_checkpoint(
+    model: torch.nn.Module,
+    optimiser: Optimizer,
+    epoch: int,
+    best_val_loss: float,
+    patience_counter: int,
+    training_results: Dict[str, Any],
+    metrics_step: int = 0,
+) -> Dict[str, Any]:
+    """Collects everything needed to resume training after the given epoch. `metrics_step` is the step the
+    metrics logger continues at."""
+    return {
+        "epoch": epoch,
+        "model": model.state_dict(),
+        "processing_graph": getattr(model, "processing_graph", None),
+        "optimiser": optimiser.state_dict(),
+        "best_val_loss": best_val_loss,
+        "patience_counter": patience_counter,
+        "training_results": training_results,
+        "metrics_step": metrics_step,
+        "rng_states": get_rng_states(),
+    }
+
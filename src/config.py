@@ -1,7 +1,7 @@
 """Defines the configuration for an experiment."""
 
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, field_validator
+from typing import Any, Dict, Optional, List, Union
 from enum import Enum
 
 
@@ -42,6 +42,21 @@ class DatasetNames(str, Enum):
     _64x32_12f_2y_2obs_1pred_uns = "64x32_12f_2y_2obs_1pred_uns"
 
 
+class MetricsBackend(str, Enum):
+    """The backends the training metrics can be logged to."""
+
+    JSONL = "jsonl"
+    SQLITE = "sqlite"
+    WANDB = "wandb"
+
+
+class Precision(str, Enum):
+    """The precisions the model can be trained and run in."""
+
+    FP32 = "fp32"
+    BF16 = "bf16"
+
+
 class GraphBuildingConfig(BaseModel):
     """This defines the parameters for building the graph.
 
@@ -124,6 +139,10 @@ class GraphBlock(BaseModel):
         Whether to use layer norm or not. Applied after every GNN layer. 
     layer_norm_mode: Optional[str]
          The mode of the layer norm. Can be either "node" or "graph".
+    checkpoint_every_n_layers: Optional[int]
+        Activation checkpointing while training. Only the inputs of every group of this many GNN layers
+        are kept for the backward pass, everything else is recomputed. Trades compute for memory on deep
+        blocks and fine meshes. Only for conv_gcn and conv_gat. At least 1, or None to disable it.
     """
     layer_type: GraphLayerType
     gat_props: Optional[GATProps] = None
@@ -131,6 +150,16 @@ class GraphBlock(BaseModel):
     output_dim: Optional[int] = None
     use_layer_norm: Optional[bool] = None
     layer_norm_mode: Optional[str] = None
+    checkpoint_every_n_layers: Optional[int] = None
+
+    @field_validator("checkpoint_every_n_layers")
+    @classmethod
+    def _check_checkpoint_every_n_layers(cls, value: Optional[int]) -> Optional[int]:
+        if value is not None and value < 1:
+            raise ValueError(
+                "checkpoint_every_n_layers has to be at least 1, or null to disable checkpointing"
+            )
+        return value
 
 
 class ModelConfig(BaseModel):
@@ -181,13 +210,45 @@ class PipelineConfig(BaseModel):
 
 
 class DataConfig(BaseModel):
-    dataset_name: DatasetNames
+    # Generated datasets (see src/data/synthetic.py) are referred to by their name
+    dataset_name: Union[DatasetNames, str]
     num_features_used: int
     obs_window_used: int
     pred_window_used: int
     want_feats_flattened: bool
 
 
+class ProfilingConfig(BaseModel):
+    """Defines the built-in profiling of the training stages, see src/profiling.py.
+
+    enabled: bool
+        Whether the stages are timed. The timing regions cost close to nothing when this is off.
+    record_function: bool
+        Whether every region is also marked with torch.profiler.record_function.
+    chrome_trace: bool
+        Whether the individual regions are exported in the Chrome trace format.
+    max_trace_events: int
+        The maximum number of regions kept for the trace.
+    """
+    enabled: bool = False
+    record_function: bool = False
+    chrome_trace: bool = True
+    max_trace_events: int = 1_000_000
+
+
+class MetricsConfig(BaseModel):
+    """Defines where the training metrics are logged to, see src/metrics.py.
+
+    backends: List[MetricsBackend]
+        The backends the metrics are written to from a background thread. The local backends write to
+        `metrics.jsonl` and `metrics.sqlite` in the experiment directory.
+    max_queue_size: int
+        The maximum number of records waiting to be written, later ones are dropped.
+    """
+    backends: List[MetricsBackend] = [MetricsBackend.JSONL]
+    max_queue_size: int = 10_000
+
+
 class ExperimentConfig(BaseModel):
     batch_size: int = 1
     learning_rate: float = 1e-5
@@ -198,6 +259,70 @@ class ExperimentConfig(BaseModel):
     graph: GraphBuildingConfig
     pipeline: PipelineConfig
     data: DataConfig
+    num_workers: int = 0
+    prefetch_batches: int = 2
+    pin_memory: bool = True
+    shared_dataset_cache: bool = False
+    checkpoint_every_n_epochs: int = 10
+    checkpoints_to_keep: int = 3
+    graph_cache_dir: Optional[str] = None
+    async_eval: bool = False
+    eval_every_n_epochs: int = 1
+    eval_subset_size: Optional[int] = None
+    eval_num_threads: Optional[int] = None
+    initial_train_eval: bool = True
+    profiling: ProfilingConfig = ProfilingConfig()
+    # With bf16 the forward passes run under bfloat16 autocast, see src.precision
+    precision: Precision = Precision.FP32
+    print_model_summary: bool = False
+    metrics: MetricsConfig = MetricsConfig()
     wandb_log: bool = True
     wandb_name: Optional[str] = None
-    wandb_key: str = "3a59363c20cd4fdf2b95dfd7a9cd72398d15321e"
+    wandb_entity: str = "graphml-group4"
+    wandb_project: str = "weather-prediction"
+    # Falls back to the WANDB_API_KEY environment variable
+    wandb_key: Optional[str] = None
+
+    @field_validator("checkpoint_every_n_epochs")
+    @classmethod
+    def _check_checkpoint_every_n_epochs(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("checkpoint_every_n_epochs has to be at least 1")
+        return value
+
+    @field_validator("eval_every_n_epochs")
+    @classmethod
+    def _check_eval_every_n_epochs(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("eval_every_n_epochs has to be at least 1")
+        return value
+
+
+class SweepConfig(BaseModel):
+    """Defines a sweep of experiments that are derived from a base experiment.
+
+    Overrides use dotted keys into the experiment config, e.g. `graph.mesh_levels` or
+    `pipeline.processor.gcn.gat_props.sparsity_thresholds`.
+
+    base_experiment: str
+        The experiment directory with the config.json all runs are derived from.
+    overrides: Dict[str, Any]
+        Overrides applied to every run.
+    grid: Dict[str, List[Any]]
+        Every combination of the values is run.
+    runs: List[Dict[str, Any]]
+        A list of overrides, each combined with every combination of the grid.
+    num_parallel_runs: int
+        The number of runs executed at the same time.
+    threads_per_run: Optional[int]
+        The number of threads of every run. Defaults to an even split of the cores.
+    max_planned_memory_gb: Optional[float]
+        Runs whose estimated peak training memory exceeds this are skipped, see `src.planner`.
+    """
+    base_experiment: str
+    overrides: Dict[str, Any] = {}
+    grid: Dict[str, List[Any]] = {}
+    runs: List[Dict[str, Any]] = []
+    num_parallel_runs: int = 1
+    threads_per_run: Optional[int] = None
+    max_planned_memory_gb: Optional[float] = None
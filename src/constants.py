@@ -1,6 +1,9 @@
 """Defines the constants in the codebase."""
 class FolderNames:
     RESULTS = ""
+    CHECKPOINTS = "checkpoints"
+    GRAPH_CACHE = "graph_cache"
+    SWEEP_RUNS = "runs"
 
 
 class FileNames:
@@ -11,3 +14,15 @@ class FileNames:
     TEST_Y = "y_test.pt"
     SAVED_MODEL = "best_model.pth"
     SAVED_RESULTS = "results.json"
+    DATASET_METADATA = "metadata.json"
+    PROFILE = "profile.json"
+    PROFILE_TRACE = "profile_trace.json"
+    METRICS_JSONL = "metrics.jsonl"
+    METRICS_SQLITE = "metrics.sqlite"
+    SWEEP_CONFIG = "sweep.json"
+    SWEEP_RESULTS_TABLE = "sweep_results.csv"
+    SWEEP_RESULTS = "sweep_results.json"
+    TEST_ERROR_MAPS = "test_error_maps.npz"
+    HINDCAST_SUMMARY = "hindcast_summary.json"
+    HINDCAST_SAMPLES = "sampled_forecasts.zarr"
+    HINDCAST_ERROR_MAPS = "error_maps.zarr"
@@ -0,0 +1,354 @@
+"""Detects candidate tropical cyclone centers in forecasts of the model.
+
+A grid cell is a candidate center if the mean sea-level pressure has a local minimum there, the cyclonic
+relative vorticity computed from the low-level u and v winds has a maximum above a threshold near it, the
+wind speed near it is strong enough and, optionally, the upper-level temperature shows a warm core. Every
+criterion is computed with neighbourhood filters over whole fields at once, so a rollout of any number of
+initial times and lead times is processed in one call. The longitudes wrap around, so centers on the
+meridian at the edge of the grid are found like any other.
+
+The fields have the shape [..., latitude, longitude, variable] and are in physical units, pressures in Pa,
+winds in m/s and temperatures in K. Forecasts of the model of the shape [..., grid, variable] are reshaped
+with `grid_to_lat_lon`. The command line reads a de-normalised forecast store written by `src.predict` or
+`src.hindcast` and writes the candidates to a CSV file.
+
+Example
+-------
+python -m src.cyclone_detection forecasts.zarr cyclone_candidates.csv --warm-core-variable temperature_500
+python -m src.cyclone_detection hindcast_2010/sampled_forecasts.zarr cyclone_candidates.csv --max-pressure 100800 --min-wind-speed 8 --warm-core-variable none
+"""
+
+import argparse
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+EARTH_RADIUS = 6.371e6
+
+
+def grid_to_lat_lon(forecasts: torch.Tensor, num_latitudes: int, num_longitudes: int) -> torch.Tensor:
+    """Reshapes forecasts of the shape [..., grid, variable], with the grid nodes ordered longitude-major
+    like the training data, to [..., latitude, longitude, variable]."""
+    forecasts = forecasts.reshape(*forecasts.shape[:-2], num_longitudes, num_latitudes, forecasts.shape[-1])
+
+    return forecasts.transpose(-3, -2)
+
+
+def _wrap_longitudes(field: torch.Tensor, radius: int, fill_value: float) -> torch.Tensor:
+    """Pads [batch, latitude, longitude] fields by `radius` cells, periodically along the longitudes and with
+    `fill_value` beyond the poles."""
+    if radius == 0:
+        return field
+    field = torch.cat([field[..., -radius:], field, field[..., :radius]], dim=-1)
+
+    return F.pad(field, (0, 0, radius, radius), value=fill_value)
+
+
+def _neighbourhood_max(field: torch.Tensor, radius: int) -> torch.Tensor:
+    padded = _wrap_longitudes(field, radius, fill_value=-float("inf"))
+
+    return F.max_pool2d(padded[:, None], kernel_size=2 * radius + 1, stride=1)[:, 0]
+
+
+def _neighbourhood_mean(field: torch.Tensor, radius: int) -> torch.Tensor:
+    padded = _wrap_longitudes(field, radius, fill_value=0.0)
+    # Cells beyond the poles do not count towards the mean
+    counts = _wrap_longitudes(torch.ones_like(field), radius, fill_value=0.0)
+    kernel_size = 2 * radius + 1
+
+    return (
+        F.avg_pool2d(padded[:, None], kernel_size=kernel_size, stride=1)
+        / F.avg_pool2d(counts[:, None], kernel_size=kernel_size, stride=1)
+    )[:, 0]
+
+
+class CycloneDetector:
+    """Finds candidate tropical cyclone centers in fields on a global latitude-longitude grid.
+
+    Parameters
+    ----------
+    latitudes : np.ndarray
+        The latitudes of the grid in degrees, in either order.
+    longitudes : np.ndarray
+        The evenly spaced longitudes of the grid in degrees, which cover the globe.
+    variable_names : List[str]
+        The names of the variables of the fields, e.g. the ones of a forecast store.
+    pressure_variable, u_variable, v_variable : str
+        The mean sea-level pressure and the low-level winds the vorticity is computed from.
+    warm_core_variable : Optional[str]
+        The upper-level temperature of the warm core check. None disables the check.
+    minimum_radius : int
+        The half width in cells of the neighbourhood the pressure has to be minimal in.
+    search_radius : int
+        The half width in cells of the neighbourhood of a pressure minimum that is searched for the maximum
+        of the vorticity, of the wind speed and of the temperature.
+    warm_core_radius : int
+        The half width in cells of the surroundings the temperature of the warm core is compared to.
+    max_pressure : float
+        The highest pressure of a center in Pa.
+    min_vorticity : float
+        The lowest maximum of the cyclonic relative vorticity near a center in 1/s. The default suits
+        coarse grids, where the vorticity of cyclones is smoothed out.
+    min_wind_speed : float
+        The lowest maximum of the wind speed near a center in m/s.
+    min_warm_core_anomaly : float
+        How much warmer in K the center has to be than its surroundings.
+    max_latitude : float
+        The highest absolute latitude of a center in degrees.
+    """
+
+    def __init__(
+        self,
+        latitudes: np.ndarray,
+        longitudes: np.ndarray,
+        variable_names: List[str],
+        pressure_variable: str = "mean_sea_level_pressure",
+        u_variable: str = "10m_u_component_of_wind",
+        v_variable: str = "10m_v_component_of_wind",
+        warm_core_variable: Optional[str] = "temperature_500",
+        minimum_radius: int = 1,
+        search_radius: int = 1,
+        warm_core_radius: int = 3,
+        max_pressure: float = 100500.0,
+        min_vorticity: float = 1e-5,
+        min_wind_speed: float = 10.0,
+        min_warm_core_anomaly: float = 0.5,
+        max_latitude: float = 40.0,
+    ):
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        spacing = np.diff(longitudes)
+        if not np.allclose(spacing, spacing[0]) or not np.isclose(spacing[0] * len(longitudes), 360.0):
+            raise ValueError("The longitudes have to be evenly spaced and cover the globe.")
+        if max(minimum_radius, search_radius, warm_core_radius) >= len(longitudes):
+            raise ValueError("The neighbourhoods have to be smaller than the number of longitudes.")
+
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = longitudes
+        self.longitude_spacing = np.deg2rad(spacing[0])
+
+        def feature_index(name: str) -> int:
+            if name not in variable_names:
+                raise ValueError(f"The variable {name} is not one of {list(variable_names)}.")
+            return list(variable_names).index(name)
+
+        self.pressure_index = feature_index(pressure_variable)
+        self.u_index = feature_index(u_variable)
+        self.v_index = feature_index(v_variable)
+        self.warm_core_index = (
+            feature_index(warm_core_variable) if warm_core_variable is not None else None
+        )
+
+        self.minimum_radius = minimum_radius
+        self.search_radius = search_radius
+        self.warm_core_radius = warm_core_radius
+        self.max_pressure = max_pressure
+        self.min_vorticity = min_vorticity
+        self.min_wind_speed = min_wind_speed
+        self.min_warm_core_anomaly = min_warm_core_anomaly
+        self.max_latitude = max_latitude
+
+    def cyclonic_vorticity(self, u: torch.Tensor, v: torch.Tensor) -> torch.Tensor:
+        """The relative vorticity of [batch, latitude, longitude] winds in spherical coordinates, with the
+        sign flipped on the southern hemisphere so that cyclones are positive. It is 0 at the poles."""
+        latitudes = torch.from_numpy(np.deg2rad(self.latitudes)).to(u)
+        cos_latitudes = latitudes.cos()[:, None]
+
+        # Central differences, which wrap around along the longitudes
+        dv_dlongitude = (v.roll(-1, dims=-1) - v.roll(1, dims=-1)) / (2 * self.longitude_spacing)
+        (du_dlatitude,) = torch.gradient(u, spacing=(latitudes,), dim=-2)
+
+        vorticity = (
+            dv_dlongitude / cos_latitudes.clamp(min=1e-6) - du_dlatitude + u * latitudes.tan()[:, None]
+        ) / EARTH_RADIUS
+        vorticity = torch.where(cos_latitudes > 1e-6, vorticity, torch.zeros_like(vorticity))
+
+        return vorticity * latitudes.sign()[:, None]
+
+    def detect(
+        self,
+        fields: Union[np.ndarray, torch.Tensor],
+        mean: Optional[np.ndarray] = None,
+        std: Optional[np.ndarray] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Finds the candidate centers in all fields at once.
+
+        Parameters
+        ----------
+        fields : Union[np.ndarray, torch.Tensor]
+            Fields of the shape [..., latitude, longitude, variable], e.g. [time, latitude, longitude,
+            variable] of one rollout or [initial time, lead, latitude, longitude, variable] of several.
+        mean, std : Optional[np.ndarray]
+            The normalisation statistics of every variable if the fields are normalised.
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            Per candidate the indices of the leading dimensions in `index`, of the shape
+            [candidate, leading dimensions], the indices and coordinates of the center, its pressure, and
+            the maxima of the cyclonic vorticity and the wind speed and the warm core anomaly near it.
+        """
+        fields = torch.as_tensor(fields).float()
+        leading_shape = fields.shape[:-3]
+        num_latitudes, num_longitudes = fields.shape[-3:-1]
+        if (num_latitudes, num_longitudes) != (len(self.latitudes), len(self.longitudes)):
+            raise ValueError(
+                f"The fields are on a {num_latitudes}x{num_longitudes} grid, the detector on a "
+                f"{len(self.latitudes)}x{len(self.longitudes)} grid."
+            )
+        fields = fields.reshape(-1, num_latitudes, num_longitudes, fields.shape[-1])
+        if mean is not None and std is not None:
+            fields = fields * torch.as_tensor(std).to(fields) + torch.as_tensor(mean).to(fields)
+
+        pressure = fields[..., self.pressure_index]
+        u, v = fields[..., self.u_index], fields[..., self.v_index]
+
+        # Local minima of the pressure, where flat neighbourhoods do not count as minima
+        neighbourhood_min = -_neighbourhood_max(-pressure, self.minimum_radius)
+        neighbourhood_max = _neighbourhood_max(pressure, self.minimum_radius)
+        candidates = (
+            (pressure <= neighbourhood_min)
+            & (pressure < neighbourhood_max)
+            & (pressure <= self.max_pressure)
+        )
+        latitude_mask = torch.from_numpy(np.abs(self.latitudes) <= self.max_latitude)
+        candidates &= latitude_mask.to(candidates.device)[:, None]
+
+        vorticity = _neighbourhood_max(self.cyclonic_vorticity(u, v), self.search_radius)
+        wind_speed = _neighbourhood_max(torch.sqrt(u**2 + v**2), self.search_radius)
+        candidates &= (vorticity >= self.min_vorticity) & (wind_speed >= self.min_wind_speed)
+
+        warm_core_anomaly = torch.full_like(pressure, float("nan"))
+        if self.warm_core_index is not None:
+            temperature = fields[..., self.warm_core_index]
+            warm_core_anomaly = _neighbourhood_max(temperature, self.search_radius) - _neighbourhood_mean(
+                temperature, self.warm_core_radius
+            )
+            candidates &= warm_core_anomaly >= self.min_warm_core_anomaly
+
+        # Minima within `minimum_radius` of each other have the same pressure and are one center, of which
+        # only the first one in the flattened grid is kept
+        flat_index = torch.arange(
+            num_latitudes * num_longitudes, dtype=torch.float64, device=pressure.device
+        ).view(num_latitudes, num_longitudes)
+        candidate_index = torch.where(candidates, -flat_index, -float("inf"))
+        candidates &= candidate_index >= _neighbourhood_max(candidate_index, self.minimum_radius)
+
+        field_indices, latitude_indices, longitude_indices = (
+            indices.cpu() for indices in candidates.nonzero(as_tuple=True)
+        )
+        index = np.zeros((len(field_indices), len(leading_shape)), dtype=np.int64)
+        if leading_shape:
+            index[:] = np.stack(np.unravel_index(field_indices.numpy(), leading_shape), axis=-1)
+
+        def at_centers(field: torch.Tensor) -> np.ndarray:
+            return field.cpu()[field_indices, latitude_indices, longitude_indices].numpy()
+
+        return {
+            "index": index,
+            "latitude_index": latitude_indices.numpy(),
+            "longitude_index": longitude_indices.numpy(),
+            "latitude": self.latitudes[latitude_indices.numpy()],
+            "longitude": self.longitudes[longitude_indices.numpy()],
+            "pressure": at_centers(pressure),
+            "vorticity": at_centers(vorticity),
+            "wind_speed": at_centers(wind_speed),
+            "warm_core_anomaly": at_centers(warm_core_anomaly),
+        }
+
+
+def detect_in_forecast_store(store_path: str, detector_kwargs: Dict[str, Any], batch_size: int = 8):
+    """Detects the candidate centers in every forecast of a store written by `src.predict` or
+    `src.hindcast`, reading `batch_size` initial times at once. Returns them as a pandas DataFrame."""
+    import pandas as pd
+    import xarray as xr
+
+    forecasts = xr.open_zarr(store_path)["forecast"]
+    if forecasts.attrs.get("normalised", 0):
+        raise ValueError(
+            "The forecasts are normalised, write them with the normalisation manifest of the dataset."
+        )
+    forecasts = forecasts.transpose("time", "lead", "latitude", "longitude", "variable")
+
+    detector = CycloneDetector(
+        latitudes=forecasts.latitude.values,
+        longitudes=forecasts.longitude.values,
+        variable_names=[str(name) for name in forecasts["variable"].values],
+        **detector_kwargs,
+    )
+
+    init_times, leads = forecasts.time.values, forecasts.lead.values
+    tables = []
+    for batch_start in range(0, len(init_times), batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        detections = detector.detect(forecasts.isel(time=batch).values)
+
+        # The indices of the leading dimensions of the batch, [initial time, lead]
+        init_indices, lead_indices = detections.pop("index").T
+        table = pd.DataFrame(
+            {
+                "init_time": init_times[batch_start + init_indices],
+                "lead": leads[lead_indices],
+                **detections,
+            }
+        )
+        # The leads of the stores of the training splits are numbers of timesteps
+        if np.issubdtype(leads.dtype, np.timedelta64):
+            table.insert(2, "valid_time", table["init_time"] + table["lead"])
+        tables.append(table)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Detects candidate tropical cyclone centers in the forecasts of a zarr store."
+    )
+    parser.add_argument("forecast_store", help="A de-normalised forecast store written by src.predict.")
+    parser.add_argument("output", help="The CSV file to write the candidates to.")
+    parser.add_argument("--pressure-variable", default="mean_sea_level_pressure")
+    parser.add_argument("--u-variable", default="10m_u_component_of_wind")
+    parser.add_argument("--v-variable", default="10m_v_component_of_wind")
+    parser.add_argument(
+        "--warm-core-variable",
+        default="temperature_500",
+        help="The upper-level temperature of the warm core check, none disables the check.",
+    )
+    parser.add_argument("--minimum-radius", type=int, default=1)
+    parser.add_argument("--search-radius", type=int, default=1)
+    parser.add_argument("--warm-core-radius", type=int, default=3)
+    parser.add_argument("--max-pressure", type=float, default=100500.0, help="In Pa.")
+    parser.add_argument("--min-vorticity", type=float, default=1e-5, help="In 1/s.")
+    parser.add_argument("--min-wind-speed", type=float, default=10.0, help="In m/s.")
+    parser.add_argument("--min-warm-core-anomaly", type=float, default=0.5, help="In K.")
+    parser.add_argument("--max-latitude", type=float, default=40.0)
+    parser.add_argument("--batch-size", type=int, default=8, help="The initial times read at once.")
+    args = parser.parse_args()
+
+    candidates = detect_in_forecast_store(
+        args.forecast_store,
+        detector_kwargs={
+            "pressure_variable": args.pressure_variable,
+            "u_variable": args.u_variable,
+            "v_variable": args.v_variable,
+            "warm_core_variable": (
+                None if args.warm_core_variable.lower() == "none" else args.warm_core_variable
+            ),
+            "minimum_radius": args.minimum_radius,
+            "search_radius": args.search_radius,
+            "warm_core_radius": args.warm_core_radius,
+            "max_pressure": args.max_pressure,
+            "min_vorticity": args.min_vorticity,
+            "min_wind_speed": args.min_wind_speed,
+            "min_warm_core_anomaly": args.min_warm_core_anomaly,
+            "max_latitude": args.max_latitude,
+        },
+        batch_size=args.batch_size,
+    )
+    candidates.to_csv(args.output, index=False)
+    print(f"{len(candidates)} candidate centers saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
+import os
+from typing import Any, Dict, Optional, Union
+
 from src.config import DatasetNames
+from src.constants import FileNames
+from src.utils import load_from_json_file, save_to_json_file
 
 
 class DatasetMetadata:
@@ -18,8 +23,54 @@ class DatasetMetadata:
         self.obs_window = obs_window
         self.pred_window = pred_window
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "flattened": self.flattened,
+            "num_latitudes": self.num_latitudes,
+            "num_longitudes": self.num_longitudes,
+            "num_features": self.num_features,
+            "obs_window": self.obs_window,
+            "pred_window": self.pred_window,
+        }
+
+    @classmethod
+    def from_dict(cls, metadata_dict: Dict[str, Any]) -> "DatasetMetadata":
+        return cls(**metadata_dict)
+
+
+# Metadata of datasets that are not part of DatasetNames, e.g. generated synthetic datasets
+_REGISTERED_DATASET_METADATA: Dict[str, DatasetMetadata] = {}
+
+
+def register_dataset_metadata(
+    dataset_name: str,
+    dataset_metadata: DatasetMetadata,
+    data_path: Optional[str] = None,
+):
+    """Registers the metadata of a dataset that is not one of the DatasetNames.
 
-def get_dataset_metadata(dataset_name: DatasetNames) -> DatasetMetadata:
+    Parameters
+    ----------
+    dataset_name : str
+        The name of the dataset, as used in the DataConfig.
+    dataset_metadata : DatasetMetadata
+        The metadata of the dataset.
+    data_path : Optional[str]
+        If passed, the metadata is also written to the dataset directory so that it can be
+        found by other processes.
+    """
+    _REGISTERED_DATASET_METADATA[str(dataset_name)] = dataset_metadata
+
+    if data_path is not None:
+        save_to_json_file(
+            data_dict=dataset_metadata.to_dict(),
+            save_path=os.path.join(data_path, FileNames.DATASET_METADATA),
+        )
+
+
+def get_dataset_metadata(
+    dataset_name: Union[DatasetNames, str], data_path: Optional[str] = None
+) -> DatasetMetadata:
     if dataset_name == DatasetNames._64x32_10f_5y_3obs:
         return DatasetMetadata(
             flattened=True,
@@ -47,5 +98,15 @@ def get_dataset_metadata(dataset_name: DatasetNames) -> DatasetMetadata:
             obs_window=2,
             pred_window=1,
         )
+    elif str(dataset_name) in _REGISTERED_DATASET_METADATA:
+        return _REGISTERED_DATASET_METADATA[str(dataset_name)]
+    elif data_path is not None and os.path.exists(
+        os.path.join(data_path, FileNames.DATASET_METADATA)
+    ):
+        dataset_metadata = DatasetMetadata.from_dict(
+            load_from_json_file(os.path.join(data_path, FileNames.DATASET_METADATA))
+        )
+        _REGISTERED_DATASET_METADATA[str(dataset_name)] = dataset_metadata
+        return dataset_metadata
     else:
         raise NotImplementedError(f"Dataset {dataset_name} is not supported.")
@@ -1,16 +1,40 @@
 import os
-from src.config import DataConfig
+from typing import Dict, Optional, Union
+from src.config import DataConfig, ExperimentConfig
 from src.constants import FileNames
 import torch
-from data.data_loading import WeatherDataset
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset
 from src.data.data_configs import DatasetMetadata, get_dataset_metadata
+from src.data.prefetch import PrefetchLoader
+from src.data.shared_cache import dataset_cache_key, load_shared_tensors
+
+
+def select_input_window(
+    X: torch.Tensor, data_config: DataConfig, dataset_metadata: DatasetMetadata
+) -> torch.Tensor:
+    """Selects the features and the last timesteps of the observation window the model uses from input
+    samples of the shape stored in the dataset, in the layout the model was trained with."""
+    X = X.reshape(
+        -1,
+        dataset_metadata.num_longitudes * dataset_metadata.num_latitudes,
+        dataset_metadata.obs_window,
+        dataset_metadata.num_features,
+    )
+    X = X[
+        :,
+        :,
+        (dataset_metadata.obs_window - data_config.obs_window_used) :,
+        : data_config.num_features_used,
+    ]
+    if data_config.want_feats_flattened:
+        X = X.reshape(X.shape[0], X.shape[1], -1)
 
+    return X
 
-def load_train_and_test_datasets(data_path: str, data_config: DataConfig):
 
-    dataset_metadata: DatasetMetadata = get_dataset_metadata(
-        dataset_name=data_config.dataset_name
-    )
+def _load_selected_tensors(
+    data_path: str, data_config: DataConfig, dataset_metadata: DatasetMetadata
+) -> Dict[str, torch.Tensor]:
 
     feats_flattened = dataset_metadata.flattened
 
@@ -97,6 +121,41 @@ def load_train_and_test_datasets(data_path: str, data_config: DataConfig):
             -1, grid_dimension_size, pred_window_used * num_features_used
         )
 
+    return {
+        "X_train": X_train,
+        "y_train": y_train,
+        "X_test": X_test,
+        "y_test": y_test,
+    }
+
+
+def load_train_and_test_datasets(
+    data_path: str, data_config: DataConfig, use_shared_cache: bool = False
+):
+
+    dataset_metadata: DatasetMetadata = get_dataset_metadata(
+        dataset_name=data_config.dataset_name, data_path=data_path
+    )
+
+    def load_fn():
+        return _load_selected_tensors(
+            data_path=data_path,
+            data_config=data_config,
+            dataset_metadata=dataset_metadata,
+        )
+
+    # Processes on the same node that use the same data share one copy in shared memory
+    if use_shared_cache:
+        tensors = load_shared_tensors(
+            key=dataset_cache_key(data_path=data_path, data_config=data_config),
+            load_fn=load_fn,
+        )
+    else:
+        tensors = load_fn()
+
+    X_train, y_train = tensors["X_train"], tensors["y_train"]
+    X_test, y_test = tensors["X_test"], tensors["y_test"]
+
     # Create the validation set from the test set
     # We will use the last 50% of the test set as the validation set
     test_size = X_test.shape[0]
@@ -107,8 +166,73 @@ def load_train_and_test_datasets(data_path: str, data_config: DataConfig):
     X_test = X_test[val_size:]
     y_test = y_test[val_size:]
 
+    # Imported here since the data loading module pulls in xarray and dask_ml
+    from data.data_loading import WeatherDataset
+
     train_dataset = WeatherDataset(X=X_train, y=y_train)
     val_dataset = WeatherDataset(X=X_val, y=y_val)
     test_dataset = WeatherDataset(X=X_test, y=y_test)
 
     return train_dataset, val_dataset, test_dataset, dataset_metadata
+
+
+def create_evaluation_subset(
+    dataset: Dataset, subset_size: Optional[int], seed: Optional[int] = 42
+) -> Dataset:
+    """Returns a fixed random subset of an evaluation split, so that the losses of different epochs are
+    computed on the same samples. The dataset is returned as it is if it is not larger than the subset."""
+    if subset_size is None or subset_size >= len(dataset):
+        return dataset
+
+    generator = torch.Generator().manual_seed(seed or 0)
+    indices = torch.randperm(len(dataset), generator=generator)[:subset_size]
+    return Subset(dataset, indices.sort().values.tolist())
+
+
+def create_dataloader(
+    dataset: Dataset,
+    experiment_config: ExperimentConfig,
+    device: torch.device,
+    shuffle: bool,
+    sampler: Optional[Sampler] = None,
+) -> Union[DataLoader, PrefetchLoader]:
+    """Creates the DataLoader for a dataset split based on the experiment config. If prefetching is enabled
+    the DataLoader is wrapped in a PrefetchLoader which prepares the next batches in the background.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset split to load.
+    experiment_config : ExperimentConfig
+        The experiment config with the batch size and the data loading settings.
+    device : torch.device
+        The device the model is trained on.
+    shuffle : bool
+        Whether to shuffle the dataset every epoch. Ignored if a sampler is passed.
+    sampler : Optional[Sampler]
+        An optional sampler that defines the order of the samples.
+
+    Returns
+    -------
+    Union[DataLoader, PrefetchLoader]
+        The loader to iterate over the batches of the split.
+    """
+
+    dataloader = DataLoader(
+        dataset,
+        batch_size=experiment_config.batch_size,
+        shuffle=shuffle if sampler is None else False,
+        sampler=sampler,
+        num_workers=experiment_config.num_workers,
+        persistent_workers=experiment_config.num_workers > 0,
+    )
+
+    if experiment_config.prefetch_batches > 0:
+        return PrefetchLoader(
+            dataloader=dataloader,
+            device=device,
+            num_prefetch=experiment_config.prefetch_batches,
+            pin_memory=experiment_config.pin_memory,
+        )
+
+    return dataloader
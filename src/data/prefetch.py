@@ -0,0 +1,194 @@
+"""Background prefetching of batches into pinned, preallocated staging buffers."""
+
+import queue
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import torch
+from torch.utils.data import DataLoader
+
+
+_END_OF_EPOCH = object()
+
+
+class _ProducerFailure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class PrefetchLoader:
+    """Wraps a DataLoader so that the next `num_prefetch` batches are prepared on a
+    background thread while the model is busy with the current one.
+
+    When pinning is enabled (only possible with CUDA), every batch is copied into one of a
+    fixed ring of preallocated page-locked buffers, so the host to device copy can run
+    asynchronously and no pinned memory is allocated per batch. On CPU only machines the
+    batches are handed over as produced by the DataLoader as staging them would only add a copy.
+
+    The time the training loop spends blocked on data is recorded for every pass over the
+    loader and can be read from `last_epoch_wait_time` and `epoch_wait_times`.
+
+    Parameters
+    ----------
+    dataloader : DataLoader
+        The DataLoader to prefetch from. Its workers (if any) keep doing the loading and
+        collation, this class only overlaps it with the consumer.
+    device : torch.device
+        The device the batches are moved to before they are yielded.
+    num_prefetch : int
+        The number of batches that are prepared ahead of the consumer.
+    pin_memory : bool
+        Whether to stage batches in pinned memory. Ignored if CUDA is not available.
+    """
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        device: torch.device,
+        num_prefetch: int = 2,
+        pin_memory: bool = True,
+    ):
+        if num_prefetch < 1:
+            raise ValueError(f"num_prefetch should be at least 1, got {num_prefetch}.")
+
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        # One slot for each prefetched batch, one for the batch being consumed and one that
+        # is released but whose asynchronous copy to the device might still be in flight.
+        self._num_slots = num_prefetch + 2
+        self._buffers: List[Optional[List[torch.Tensor]]] = [None] * self._num_slots
+        self._copy_events: List[Optional[torch.cuda.Event]] = [None] * self._num_slots
+
+        self.epoch_wait_times: List[float] = []
+        self.last_epoch_wait_time = 0.0
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    @property
+    def batch_size(self):
+        return self.dataloader.batch_size
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _stage(self, slot: int, batch: Sequence[torch.Tensor]) -> List[torch.Tensor]:
+        """Copies the batch into the preallocated pinned buffers of the given slot."""
+        if self._copy_events[slot] is not None:
+            # Do not overwrite the buffer while it is still being copied to the device
+            self._copy_events[slot].synchronize()
+
+        buffers = self._buffers[slot]
+        if buffers is None or len(buffers) != len(batch):
+            buffers = [None] * len(batch)
+
+        staged = []
+        for i, tensor in enumerate(batch):
+            buffer = buffers[i]
+            # The last batch of an epoch can be smaller, so the buffer only has to be large enough
+            if (
+                buffer is None
+                or buffer.dtype != tensor.dtype
+                or buffer.shape[1:] != tensor.shape[1:]
+                or buffer.shape[0] < tensor.shape[0]
+            ):
+                buffer = torch.empty(
+                    tensor.shape, dtype=tensor.dtype, pin_memory=self.pin_memory
+                )
+                buffers[i] = buffer
+
+            view = buffer[: tensor.shape[0]]
+            view.copy_(tensor)
+            staged.append(view)
+
+        self._buffers[slot] = buffers
+        return staged
+
+    def _produce(
+        self,
+        free_slots: queue.Queue,
+        ready_batches: queue.Queue,
+        stop: threading.Event,
+    ):
+        try:
+            for batch in self.dataloader:
+                slot = free_slots.get()
+                if stop.is_set():
+                    return
+
+                if self.pin_memory:
+                    batch = self._stage(slot=slot, batch=batch)
+
+                ready_batches.put((slot, batch))
+
+            ready_batches.put(_END_OF_EPOCH)
+
+        except BaseException as e:
+            ready_batches.put(_ProducerFailure(e))
+
+    def __iter__(self):
+        free_slots = queue.Queue()
+        for slot in range(self._num_slots):
+            free_slots.put(slot)
+
+        # The producer needs a free slot for every batch, so the free slots bound how far ahead it runs
+        ready_batches = queue.Queue()
+        stop = threading.Event()
+
+        producer = threading.Thread(
+            target=self._produce,
+            args=(free_slots, ready_batches, stop),
+            daemon=True,
+        )
+        producer.start()
+
+        wait_time = 0.0
+        slots_in_flight = []
+
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                item = ready_batches.get()
+                wait_time += time.perf_counter() - wait_start
+
+                if item is _END_OF_EPOCH:
+                    break
+                if isinstance(item, _ProducerFailure):
+                    raise item.exception
+
+                slot, batch = item
+                batch = [
+                    tensor.to(self.device, non_blocking=self.pin_memory)
+                    for tensor in batch
+                ]
+                if self.pin_memory and self.device.type == "cuda":
+                    event = torch.cuda.Event()
+                    event.record()
+                    self._copy_events[slot] = event
+
+                # The consumer is done with the previous batch once it asks for the next one.
+                # Release it one step late since its device copy could still be running.
+                slots_in_flight.append(slot)
+                if len(slots_in_flight) > 1:
+                    free_slots.put(slots_in_flight.pop(0))
+
+                yield batch
+
+        finally:
+            stop.set()
+            # Unblock the producer in case it is waiting for a free slot
+            for _ in range(self._num_slots):
+                free_slots.put(0)
+            producer.join()
+
+            self.last_epoch_wait_time = wait_time
+            self.epoch_wait_times.append(wait_time)
@@ -0,0 +1,234 @@
+"""Shares loaded dataset tensors between the training processes on a node through POSIX shared memory."""
+
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import warnings
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, util
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+
+from src.config import DataConfig
+
+
+# The registry and the lock of every cache entry live next to the shared memory segments if possible
+_REGISTRY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_REGISTRY_PREFIX = "cyclone_tracking_cache_"
+
+# Entries this process is attached to, by key
+_ATTACHED: Dict[str, Dict[str, torch.Tensor]] = {}
+_ATTACHED_SEGMENTS: Dict[str, List[SharedMemory]] = {}
+
+
+def dataset_cache_key(data_path: str, data_config: DataConfig) -> str:
+    """Returns the key of a dataset in the cache. Two processes share the tensors if they load the same
+    dataset with the same feature and window selection."""
+    selection = {
+        "data_path": os.path.abspath(data_path),
+        "dataset_name": str(data_config.dataset_name),
+        "num_features_used": data_config.num_features_used,
+        "obs_window_used": data_config.obs_window_used,
+        "pred_window_used": data_config.pred_window_used,
+        "want_feats_flattened": data_config.want_feats_flattened,
+    }
+    return hashlib.sha1(json.dumps(selection, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _registry_path(key: str) -> str:
+    return os.path.join(_REGISTRY_DIR, f"{_REGISTRY_PREFIX}{key}.json")
+
+
+@contextmanager
+def _locked(key: str):
+    """Holds an exclusive lock on the cache entry across processes."""
+    lock_path = os.path.join(_REGISTRY_DIR, f"{_REGISTRY_PREFIX}{key}.lock")
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _untrack(segment: SharedMemory):
+    # The resource tracker would unlink the segment when the process that created or attached to it
+    # exits, while other processes still use it. The cache does its own reference counting instead.
+    resource_tracker.unregister(segment._name, "shared_memory")
+
+
+def _unlink_segments(registry: Dict):
+    for entry in registry["tensors"].values():
+        try:
+            segment = SharedMemory(name=entry["segment"])
+        except FileNotFoundError:
+            continue
+        segment.close()
+        # This also removes the segment from the resource tracker again
+        segment.unlink()
+
+
+def _read_registry(key: str):
+    registry_path = _registry_path(key)
+    if not os.path.exists(registry_path):
+        return None
+
+    with open(registry_path, "r") as infile:
+        registry = json.load(infile)
+
+    # Processes that died without releasing the entry do not count as users
+    registry["pids"] = [pid for pid in registry["pids"] if _is_alive(pid)]
+    if not registry["pids"]:
+        _unlink_segments(registry)
+        os.remove(registry_path)
+        return None
+
+    return registry
+
+
+def _write_registry(key: str, registry: Dict):
+    registry_path = _registry_path(key)
+    with open(registry_path + ".tmp", "w") as outfile:
+        json.dump(registry, outfile)
+    os.replace(registry_path + ".tmp", registry_path)
+
+
+def _create_segments(key: str, tensors: Dict[str, torch.Tensor]) -> Dict:
+    registry = {"tensors": {}, "pids": []}
+    try:
+        for name, tensor in tensors.items():
+            array = tensor.contiguous().numpy()
+            segment = SharedMemory(
+                name=f"{_REGISTRY_PREFIX}{key}_{name}",
+                create=True,
+                size=max(array.nbytes, 1),
+            )
+            _untrack(segment)
+            registry["tensors"][name] = {
+                "segment": segment.name,
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+            }
+
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            segment.close()
+    except BaseException:
+        # The segments are untracked, so they would outlive this process and block the names of a retry
+        _unlink_segments(registry)
+        raise
+
+    return registry
+
+
+def _attach_segments(key: str, registry: Dict) -> Dict[str, torch.Tensor]:
+    tensors = {}
+    segments = []
+    for name, entry in registry["tensors"].items():
+        segment = SharedMemory(name=entry["segment"])
+        _untrack(segment)
+        segments.append(segment)
+
+        array = np.ndarray(
+            tuple(entry["shape"]), dtype=np.dtype(entry["dtype"]), buffer=segment.buf
+        )
+        array.flags.writeable = False
+        with warnings.catch_warnings():
+            # torch warns that it does not support read-only arrays, the tensors must not be written to
+            warnings.simplefilter("ignore", UserWarning)
+            tensors[name] = torch.from_numpy(array)
+
+    _ATTACHED_SEGMENTS[key] = segments
+    return tensors
+
+
+def load_shared_tensors(
+    key: str, load_fn: Callable[[], Dict[str, torch.Tensor]]
+) -> Dict[str, torch.Tensor]:
+    """Returns the tensors of a cache entry, backed by shared memory. The first process calls `load_fn` and
+    copies its tensors into shared memory, later processes attach to them without copying. Processes are
+    detached when they exit and the shared memory is freed once the last process using it has detached.
+
+    The returned tensors must be treated as read-only since they are shared with other processes.
+
+    Parameters
+    ----------
+    key : str
+        The key of the cache entry, see `dataset_cache_key`.
+    load_fn : Callable[[], Dict[str, torch.Tensor]]
+        Loads the tensors if they are not in the cache yet.
+
+    Returns
+    -------
+    Dict[str, torch.Tensor]
+        The tensors of the cache entry by name.
+    """
+    if key in _ATTACHED:
+        return _ATTACHED[key]
+
+    with _locked(key):
+        registry = _read_registry(key)
+
+        if registry is None:
+            print(f"Dataset {key} is not in the shared memory cache yet, loading it")
+            registry = _create_segments(key=key, tensors=load_fn())
+        else:
+            print(
+                f"Attaching to dataset {key} in the shared memory cache, used by {len(registry['pids'])} processes"
+            )
+
+        tensors = _attach_segments(key=key, registry=registry)
+        registry["pids"].append(os.getpid())
+        _write_registry(key=key, registry=registry)
+
+    _ATTACHED[key] = tensors
+    return tensors
+
+
+def release_shared_tensors(key: str):
+    """Detaches this process from a cache entry and frees the shared memory if no other process uses it.
+    This is called automatically for all entries when the process exits."""
+    if key not in _ATTACHED:
+        return
+
+    # The segments stay mapped as tensors handed out before might still use them, unlinking below only
+    # removes their names. The memory is returned once every process has unmapped them.
+    del _ATTACHED[key]
+
+    with _locked(key):
+        registry = _read_registry(key)
+        if registry is None:
+            return
+
+        registry["pids"] = [pid for pid in registry["pids"] if pid != os.getpid()]
+        if registry["pids"]:
+            _write_registry(key=key, registry=registry)
+        else:
+            _unlink_segments(registry)
+            os.remove(_registry_path(key))
+
+
+@atexit.register
+def _release_all():
+    for key in list(_ATTACHED):
+        release_shared_tensors(key)
+
+
+# Child processes of multiprocessing, e.g. spawned ranks or pool workers, exit without running the atexit
+# handlers, but they do run the multiprocessing finalizers
+util.Finalize(None, _release_all, exitpriority=0)
@@ -0,0 +1,311 @@
+"""Generates synthetic ERA5-like datasets in the format of the project for offline benchmarking.
+
+Example
+-------
+python -m src.data.synthetic 128x64_33f_synthetic --num-longitudes 128 --num-latitudes 64 --num-features 33
+"""
+
+import argparse
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+
+from src.constants import FileNames
+from src.data.data_configs import DatasetMetadata, register_dataset_metadata
+
+
+def _latitude_smoothing_matrix(lats: np.ndarray, length_scale: float) -> np.ndarray:
+    """Returns a row normalised gaussian kernel of shape [num_latitudes, num_latitudes] along the meridians."""
+    distances = lats[:, None] - lats[None, :]
+    kernel = np.exp(-0.5 * (distances / length_scale) ** 2)
+    return (kernel / kernel.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def _longitude_spectral_filter(
+    lats: np.ndarray, num_longitudes: int, length_scale: float
+) -> np.ndarray:
+    """Returns the gaussian filter response of shape [num_latitudes, num_wavenumbers] in longitudinal
+    Fourier space. The filter widens towards the poles so that the correlation length is the same in
+    distance along every latitude circle."""
+    wavenumbers = np.fft.rfftfreq(num_longitudes, d=1.0 / num_longitudes)
+    cos_lats = np.clip(np.cos(np.deg2rad(lats)), 0.05, None)
+    length_scale_radians = np.deg2rad(length_scale) / cos_lats
+    return np.exp(
+        -0.5 * (wavenumbers[None, :] * length_scale_radians[:, None]) ** 2
+    ).astype(np.float32)
+
+
+class _SmoothFieldGenerator:
+    """Generates a time series of smooth latent fields of shape [num_latents, num_latitudes, num_longitudes].
+
+    Every step the previous state is advected zonally (easterlies in the tropics, westerlies in the
+    mid-latitudes) and relaxed towards new spatially correlated noise, i.e. an AR(1) process in time.
+    """
+
+    def __init__(
+        self,
+        num_latents: int,
+        lats: np.ndarray,
+        num_longitudes: int,
+        correlation_length: float,
+        temporal_correlation: float,
+        advection_speed: float,
+        rng: np.random.Generator,
+    ):
+        self._num_latents = num_latents
+        self._num_latitudes = lats.shape[0]
+        self._num_longitudes = num_longitudes
+        self._rho = temporal_correlation
+        self._rng = rng
+
+        self._lat_kernel = _latitude_smoothing_matrix(lats, correlation_length)
+        self._lon_filter = _longitude_spectral_filter(
+            lats, num_longitudes, correlation_length
+        )
+
+        # The zonal shift per step in radians for every latitude
+        shift = np.deg2rad(advection_speed) * -np.cos(np.deg2rad(3 * lats))
+        wavenumbers = np.fft.rfftfreq(num_longitudes, d=1.0 / num_longitudes)
+        self._advection = np.exp(-1j * wavenumbers[None, :] * shift[:, None]).astype(
+            np.complex64
+        )
+
+        self._state = self._noise()
+
+    def _noise(self) -> np.ndarray:
+        noise = self._rng.standard_normal(
+            (self._num_latents, self._num_latitudes, self._num_longitudes),
+            dtype=np.float32,
+        )
+        noise = np.fft.irfft(
+            np.fft.rfft(noise, axis=-1) * self._lon_filter,
+            n=self._num_longitudes,
+            axis=-1,
+        )
+        noise = np.einsum("ij,fjk->fik", self._lat_kernel, noise)
+        return (noise / noise.std(axis=(1, 2), keepdims=True)).astype(np.float32)
+
+    def step(self) -> np.ndarray:
+        advected = np.fft.irfft(
+            np.fft.rfft(self._state, axis=-1) * self._advection,
+            n=self._num_longitudes,
+            axis=-1,
+        )
+        self._state = (
+            self._rho * advected + np.sqrt(1 - self._rho**2) * self._noise()
+        ).astype(np.float32)
+        return self._state
+
+
+def _generate_split(
+    generator: _SmoothFieldGenerator,
+    mixing: np.ndarray,
+    num_samples: int,
+    obs_window: int,
+    pred_window: int,
+    num_features: int,
+    num_latitudes: int,
+    num_longitudes: int,
+):
+    """Generates X of shape [num_samples, num_longitudes, num_latitudes, obs_window, num_features] and y of
+    shape [num_samples, num_longitudes, num_latitudes, pred_window, num_features] from non-overlapping windows."""
+
+    X = np.empty(
+        (num_samples, num_longitudes, num_latitudes, obs_window, num_features),
+        dtype=np.float32,
+    )
+    y = np.empty(
+        (num_samples, num_longitudes, num_latitudes, pred_window, num_features),
+        dtype=np.float32,
+    )
+
+    for sample in range(num_samples):
+        for t in range(obs_window + pred_window):
+            # [num_latents, lat, lon] -> [lon, lat, num_features]
+            features = np.einsum("lij,lf->jif", generator.step(), mixing)
+
+            if t < obs_window:
+                X[sample, :, :, t] = features
+            else:
+                y[sample, :, :, t - obs_window] = features
+
+    return X, y
+
+
+def generate_synthetic_dataset(
+    dataset_name: str,
+    num_latitudes: int = 32,
+    num_longitudes: int = 64,
+    num_features: int = 33,
+    obs_window: int = 5,
+    pred_window: int = 1,
+    num_train_samples: int = 64,
+    num_test_samples: int = 16,
+    flattened: bool = False,
+    correlation_length: float = 15.0,
+    temporal_correlation: float = 0.9,
+    advection_speed: float = 5.0,
+    num_latent_fields: Optional[int] = None,
+    seed: int = 42,
+    datasets_dir: str = os.path.join("data", "datasets"),
+) -> DatasetMetadata:
+    """Generates a synthetic dataset with smooth, spatially and temporally correlated fields and saves it in the
+    same format as the ERA5 datasets, i.e. `X_train.pt`, `y_train.pt`, `X_test.pt` and `y_test.pt` in
+    `<datasets_dir>/<dataset_name>`. The metadata of the dataset is registered and written next to the data, so
+    it can be used in a DataConfig like any other dataset.
+
+    Every feature is a random mix of a few latent fields, so the features are correlated like the variables
+    and pressure levels of ERA5 are. The features are normalised to zero mean and unit variance.
+
+    Parameters
+    ----------
+    dataset_name : str
+        The name of the dataset, used as the name of the directory.
+    num_latitudes : int
+        The number of latitudes in the grid.
+    num_longitudes : int
+        The number of longitudes in the grid.
+    num_features : int
+        The number of features per grid node and timestep.
+    obs_window : int
+        The number of timesteps in the observation window.
+    pred_window : int
+        The number of timesteps in the prediction window.
+    num_train_samples : int
+        The number of samples in the train split.
+    num_test_samples : int
+        The number of samples in the test split. Half of it will be used for validation.
+    flattened : bool
+        Whether to store the timesteps and the features flattened in one dimension.
+    correlation_length : float
+        The spatial correlation length of the fields in degrees.
+    temporal_correlation : float
+        The correlation between consecutive timesteps in [0, 1).
+    advection_speed : float
+        The maximum zonal advection of the fields in degrees per timestep.
+    num_latent_fields : Optional[int]
+        The number of latent fields the features are mixed from. Defaults to a third of the features.
+    seed : int
+        The random seed.
+    datasets_dir : str
+        The directory where all the datasets are stored.
+
+    Returns
+    -------
+    DatasetMetadata
+        The metadata of the generated dataset.
+    """
+
+    rng = np.random.default_rng(seed)
+    lats = np.linspace(start=-90, stop=90, num=num_latitudes, endpoint=True)
+
+    num_latent_fields = num_latent_fields or max(1, num_features // 3)
+    mixing = rng.standard_normal((num_latent_fields, num_features)).astype(np.float32)
+    mixing /= np.linalg.norm(mixing, axis=0, keepdims=True)
+
+    generator = _SmoothFieldGenerator(
+        num_latents=num_latent_fields,
+        lats=lats,
+        num_longitudes=num_longitudes,
+        correlation_length=correlation_length,
+        temporal_correlation=temporal_correlation,
+        advection_speed=advection_speed,
+        rng=rng,
+    )
+
+    # Burn in so the first sample is drawn from the stationary distribution
+    for _ in range(int(np.ceil(1 / (1 - temporal_correlation)))):
+        generator.step()
+
+    split_kwargs = dict(
+        generator=generator,
+        mixing=mixing,
+        obs_window=obs_window,
+        pred_window=pred_window,
+        num_features=num_features,
+        num_latitudes=num_latitudes,
+        num_longitudes=num_longitudes,
+    )
+    # The test split follows the train split in time like it would for a real dataset
+    X_train, y_train = _generate_split(num_samples=num_train_samples, **split_kwargs)
+    X_test, y_test = _generate_split(num_samples=num_test_samples, **split_kwargs)
+
+    # Normalise every feature with the statistics of the train split
+    mean = X_train.mean(axis=(0, 1, 2, 3))
+    std = X_train.std(axis=(0, 1, 2, 3))
+    for array in (X_train, y_train, X_test, y_test):
+        array -= mean
+        array /= std
+
+    if flattened:
+        X_train, y_train, X_test, y_test = (
+            array.reshape(*array.shape[:3], -1)
+            for array in (X_train, y_train, X_test, y_test)
+        )
+
+    data_path = os.path.join(datasets_dir, dataset_name)
+    os.makedirs(data_path, exist_ok=True)
+
+    torch.save(torch.from_numpy(X_train), os.path.join(data_path, FileNames.TRAIN_X))
+    torch.save(torch.from_numpy(y_train), os.path.join(data_path, FileNames.TRAIN_Y))
+    torch.save(torch.from_numpy(X_test), os.path.join(data_path, FileNames.TEST_X))
+    torch.save(torch.from_numpy(y_test), os.path.join(data_path, FileNames.TEST_Y))
+
+    dataset_metadata = DatasetMetadata(
+        flattened=flattened,
+        num_latitudes=num_latitudes,
+        num_longitudes=num_longitudes,
+        num_features=num_features,
+        obs_window=obs_window,
+        pred_window=pred_window,
+    )
+    register_dataset_metadata(
+        dataset_name=dataset_name,
+        dataset_metadata=dataset_metadata,
+        data_path=data_path,
+    )
+
+    return dataset_metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic ERA5-like dataset in data/datasets/<dataset_name>."
+    )
+    parser.add_argument("dataset_name")
+    parser.add_argument("--num-latitudes", type=int, default=32)
+    parser.add_argument("--num-longitudes", type=int, default=64)
+    parser.add_argument("--num-features", type=int, default=33)
+    parser.add_argument("--obs-window", type=int, default=5)
+    parser.add_argument("--pred-window", type=int, default=1)
+    parser.add_argument("--num-train-samples", type=int, default=64)
+    parser.add_argument("--num-test-samples", type=int, default=16)
+    parser.add_argument("--flattened", action="store_true")
+    parser.add_argument("--correlation-length", type=float, default=15.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--datasets-dir", default=os.path.join("data", "datasets"))
+    args = parser.parse_args()
+
+    generate_synthetic_dataset(
+        dataset_name=args.dataset_name,
+        num_latitudes=args.num_latitudes,
+        num_longitudes=args.num_longitudes,
+        num_features=args.num_features,
+        obs_window=args.obs_window,
+        pred_window=args.pred_window,
+        num_train_samples=args.num_train_samples,
+        num_test_samples=args.num_test_samples,
+        flattened=args.flattened,
+        correlation_length=args.correlation_length,
+        seed=args.seed,
+        datasets_dir=args.datasets_dir,
+    )
+    print(
+        f"Synthetic dataset saved to {os.path.join(args.datasets_dir, args.dataset_name)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
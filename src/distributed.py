@@ -0,0 +1,233 @@
+"""Multi-process data-parallel training on CPU nodes with torch.distributed and the gloo backend."""
+
+import os
+import socket
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, Sampler
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def launched_with_torchrun() -> bool:
+    """Whether the process was started by torchrun, which sets the rank and the world size in the environment."""
+    return "RANK" in os.environ and "WORLD_SIZE" in os.environ
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """Returns the model without the DistributedDataParallel wrapper, e.g. to save or load its state dict."""
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def all_reduce_sum(values: Sequence[float]) -> List[float]:
+    """Sums the values over all ranks. Without a process group the values are returned as they are."""
+    if not is_distributed():
+        return list(values)
+
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_reduce_max(values: Sequence[float]) -> List[float]:
+    """Takes the maximum of the values over all ranks."""
+    if not is_distributed():
+        return list(values)
+
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return tensor.tolist()
+
+
+def average_over_ranks(total: float, count: int) -> float:
+    """Averages a quantity that was summed over `count` batches on every rank over all batches of all ranks."""
+    total, count = all_reduce_sum([total, count])
+    return total / count
+
+
+def broadcast_from_main(value: Any) -> Any:
+    """Sends a picklable value from rank 0 to all other ranks, so that every rank takes the same decision."""
+    if not is_distributed():
+        return value
+
+    objects = [value]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+class ShardedEvalSampler(Sampler):
+    """Splits a dataset into disjoint, strided shards for evaluation without shuffling or padding.
+
+    Unlike the DistributedSampler no sample is repeated to even out the shards, so that the losses
+    reduced over all ranks are the exact losses over the dataset.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset to shard.
+    num_replicas : Optional[int]
+        The number of ranks. Defaults to the world size.
+    rank : Optional[int]
+        The rank of this process. Defaults to the rank in the process group.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        self.num_samples_total = len(dataset)
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.rank, self.num_samples_total, self.num_replicas))
+
+    def __len__(self) -> int:
+        return len(range(self.rank, self.num_samples_total, self.num_replicas))
+
+
+def set_sampler_epoch(dataloader, epoch: int):
+    """Reshuffles the shards of a DistributedSampler, which only shuffles differently if told the epoch."""
+    sampler = getattr(dataloader, "sampler", None)
+    if hasattr(sampler, "set_epoch"):
+        sampler.set_epoch(epoch)
+
+
+def threads_per_rank(world_size: int) -> int:
+    """Splits the cores of the node evenly between the ranks so that they do not oversubscribe the CPU."""
+    return max(1, (os.cpu_count() or 1) // world_size)
+
+
+def init_distributed(
+    rank: int,
+    world_size: int,
+    master_addr: str = "127.0.0.1",
+    master_port: Optional[int] = None,
+    num_threads: Optional[int] = None,
+):
+    """Joins the gloo process group and limits the intra-op threads of this rank.
+
+    Parameters
+    ----------
+    rank : int
+        The rank of this process.
+    world_size : int
+        The number of processes.
+    master_addr : str
+        The address of rank 0.
+    master_port : Optional[int]
+        The port of rank 0. If not passed, MASTER_PORT has to be set in the environment.
+    num_threads : Optional[int]
+        The number of intra-op threads for this rank. Defaults to an even split of the cores.
+    """
+    os.environ.setdefault("MASTER_ADDR", master_addr)
+    if master_port is not None:
+        os.environ["MASTER_PORT"] = str(master_port)
+
+    torch.set_num_threads(num_threads or threads_per_rank(world_size))
+
+    dist.init_process_group(backend="gloo", rank=rank, world_size=world_size)
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def _find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _spawned_worker(
+    rank: int,
+    world_size: int,
+    master_port: int,
+    num_threads: Optional[int],
+    fn: Callable,
+    args: tuple,
+):
+    init_distributed(
+        rank=rank,
+        world_size=world_size,
+        master_port=master_port,
+        num_threads=num_threads,
+    )
+    try:
+        fn(*args)
+    finally:
+        cleanup_distributed()
+
+
+def launch(
+    fn: Callable,
+    args: tuple = (),
+    nproc_per_node: int = 1,
+    num_threads: Optional[int] = None,
+):
+    """Runs `fn(*args)` in `nproc_per_node` processes on this node that form one gloo process group.
+
+    If the process was started by torchrun the process group is created from the environment instead
+    and `fn` runs in this process only. With a single process `fn` runs without a process group.
+
+    Parameters
+    ----------
+    fn : Callable
+        The function every rank runs. It has to be picklable, i.e. defined at module level.
+    args : tuple
+        The arguments passed to `fn`.
+    nproc_per_node : int
+        The number of processes to start.
+    num_threads : Optional[int]
+        The number of intra-op threads per rank. Defaults to an even split of the cores.
+    """
+    if launched_with_torchrun():
+        world_size = int(os.environ["WORLD_SIZE"])
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        init_distributed(
+            rank=int(os.environ["RANK"]),
+            world_size=world_size,
+            num_threads=num_threads or threads_per_rank(local_world_size),
+        )
+        try:
+            return fn(*args)
+        finally:
+            cleanup_distributed()
+
+    if nproc_per_node <= 1:
+        return fn(*args)
+
+    mp.spawn(
+        _spawned_worker,
+        args=(nproc_per_node, _find_free_port(), num_threads, fn, args),
+        nprocs=nproc_per_node,
+        join=True,
+    )
+
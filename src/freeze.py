@@ -0,0 +1,442 @@
+"""Exports a trained model as a frozen inference module with the static graphs baked in.
+
+At inference the graphs never change, yet the eager model dispatches over its layer types, rebuilds the
+mesh node inputs and normalises the GCN edges on every call. The frozen module precomputes all of that
+once: the edge indices, the GCN edge weights, the in-degrees of the mean aggregation and the static node
+features are registered as buffers, and every layer is a plain torch module with the graph bound to it.
+The module is then compiled with TorchScript and frozen, or with `torch.compile` for static shapes.
+
+Example
+-------
+python -m src.freeze "<path-to-experinment-directory>" --output frozen_model.pt --repeats 20
+"""
+
+import argparse
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch_geometric.nn import GATConv, GCNConv, LayerNorm, SimpleConv
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_geometric.utils import add_self_loops, remove_self_loops
+
+from src.models import GraphLayer, Model, SparseGATConv, WeatherPrediction
+
+
+FROZEN_MODEL_FILE = "frozen_model.pt"
+
+COMPILE_MODES = ["script", "compile"]
+
+
+class FrozenGCNConv(nn.Module):
+    """A GCNConv on a fixed graph, with the normalised edge weights precomputed."""
+
+    def __init__(self, conv: GCNConv, edge_index: torch.Tensor, num_nodes: int):
+        super().__init__()
+        edge_weight = None
+        if conv.normalize:
+            edge_index, edge_weight = gcn_norm(
+                edge_index,
+                None,
+                num_nodes,
+                improved=conv.improved,
+                add_self_loops=conv.add_self_loops,
+                flow=conv.flow,
+            )
+        if edge_weight is None:
+            edge_weight = torch.ones(edge_index.shape[1], device=edge_index.device)
+
+        self.weight = nn.Parameter(conv.lin.weight.detach().clone())
+        self.bias = nn.Parameter(
+            conv.bias.detach().clone()
+            if conv.bias is not None
+            else torch.zeros(conv.out_channels, device=edge_index.device)
+        )
+        self.register_buffer("source", edge_index[0].clone())
+        self.register_buffer("target", edge_index[1].clone())
+        self.register_buffer("edge_weight", edge_weight.unsqueeze(-1).clone())
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        return self.forward_edges(X, self.source, self.target, self.edge_weight, X.shape[0])
+
+    def forward_edges(
+        self,
+        X: torch.Tensor,
+        source: torch.Tensor,
+        target: torch.Tensor,
+        edge_weight: torch.Tensor,
+        num_targets: int,
+    ) -> torch.Tensor:
+        """Aggregates the messages of the given edges into `num_targets` nodes, e.g. for a part of the graph.
+        `source` indexes the rows of X and `target` the rows of the output."""
+        X = F.linear(X, self.weight)
+        out = torch.zeros(num_targets, X.shape[1], dtype=X.dtype, device=X.device).index_add_(
+            0, target, X[source] * edge_weight
+        )
+        return out + self.bias
+
+
+class FrozenGATConv(nn.Module):
+    """A GATConv on a fixed graph, with the self loops added once. The attention depends on the input, so
+    it is still computed on every call."""
+
+    def __init__(self, conv: GATConv, edge_index: torch.Tensor, num_nodes: int):
+        super().__init__()
+        if conv.lin is None or conv.lin_edge is not None or conv.res is not None:
+            raise NotImplementedError("Only GATConv layers with shared weights can be frozen.")
+
+        if conv.add_self_loops:
+            edge_index, _ = remove_self_loops(edge_index)
+            edge_index, _ = add_self_loops(edge_index, num_nodes=num_nodes)
+
+        self.heads = conv.heads
+        self.out_channels = conv.out_channels
+        self.concat = conv.concat
+        self.negative_slope = conv.negative_slope
+
+        self.weight = nn.Parameter(conv.lin.weight.detach().clone())
+        self.att_src = nn.Parameter(conv.att_src.detach().clone())
+        self.att_dst = nn.Parameter(conv.att_dst.detach().clone())
+        self.bias = nn.Parameter(
+            conv.bias.detach().clone()
+            if conv.bias is not None
+            else torch.zeros(
+                conv.heads * conv.out_channels if conv.concat else conv.out_channels,
+                device=edge_index.device,
+            )
+        )
+        self.register_buffer("source", edge_index[0].clone())
+        self.register_buffer("target", edge_index[1].clone())
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        return self.forward_edges(X, self.source, self.target, self.target, X.shape[0])
+
+    def forward_edges(
+        self,
+        X: torch.Tensor,
+        source: torch.Tensor,
+        target: torch.Tensor,
+        target_input: torch.Tensor,
+        num_targets: int,
+    ) -> torch.Tensor:
+        """Aggregates the messages of the given edges into `num_targets` nodes, e.g. for a part of the graph.
+        `source` and `target_input` index the rows of X and `target` the rows of the output. All incoming
+        edges of the targets have to be given, since the attention is normalised over them."""
+        X = F.linear(X, self.weight).view(X.shape[0], self.heads, self.out_channels)
+
+        alpha = (X * self.att_src).sum(-1)[source] + (X * self.att_dst).sum(-1)[target_input]
+        alpha = F.leaky_relu(alpha, self.negative_slope)
+
+        # Softmax over the incoming edges of every node
+        expanded_target = target.unsqueeze(-1).expand_as(alpha)
+        alpha_max = torch.full(
+            (num_targets, self.heads), -float("inf"), dtype=X.dtype, device=X.device
+        ).scatter_reduce(0, expanded_target, alpha, reduce="amax", include_self=True)
+        alpha = (alpha - alpha_max[target]).exp()
+        alpha_sum = torch.zeros(num_targets, self.heads, dtype=X.dtype, device=X.device).index_add_(
+            0, target, alpha
+        )
+        alpha = alpha / (alpha_sum[target] + 1e-16)
+
+        out = torch.zeros(
+            num_targets, self.heads, self.out_channels, dtype=X.dtype, device=X.device
+        ).index_add_(0, target, X[source] * alpha.unsqueeze(-1))
+        if self.concat:
+            out = out.reshape(num_targets, self.heads * self.out_channels)
+        else:
+            out = out.mean(dim=1)
+
+        return out + self.bias
+
+
+class FrozenMeanConv(nn.Module):
+    """A SimpleConv with mean aggregation on a fixed graph, with the inverse in-degrees precomputed."""
+
+    def __init__(self, edge_index: torch.Tensor, num_nodes: int):
+        super().__init__()
+        in_degree = torch.zeros(num_nodes, device=edge_index.device).index_add_(
+            0, edge_index[1], torch.ones(edge_index.shape[1], device=edge_index.device)
+        )
+        self.register_buffer("source", edge_index[0].clone())
+        self.register_buffer("target", edge_index[1].clone())
+        self.register_buffer("inverse_degree", (1 / in_degree.clamp(min=1)).unsqueeze(-1))
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        return self.forward_edges(X, self.source, self.target, self.inverse_degree, X.shape[0])
+
+    def forward_edges(
+        self,
+        X: torch.Tensor,
+        source: torch.Tensor,
+        target: torch.Tensor,
+        inverse_degree: torch.Tensor,
+        num_targets: int,
+    ) -> torch.Tensor:
+        """Averages the messages of the given edges into `num_targets` nodes, e.g. for a part of the graph.
+        `source` indexes the rows of X, `target` and `inverse_degree` the rows of the output."""
+        out = torch.zeros(num_targets, X.shape[1], dtype=X.dtype, device=X.device).index_add_(
+            0, target, X[source]
+        )
+        return out * inverse_degree
+
+
+class FrozenLayerNorm(nn.Module):
+    """The node-wise or graph-wise layer norm of torch_geometric for a single graph."""
+
+    def __init__(self, layer_norm: LayerNorm):
+        super().__init__()
+        self.graph_mode = layer_norm.mode == "graph"
+        self.num_channels = layer_norm.in_channels
+        self.eps = layer_norm.eps
+        self.weight = nn.Parameter(layer_norm.weight.detach().clone())
+        self.bias = nn.Parameter(layer_norm.bias.detach().clone())
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        if self.graph_mode:
+            X = X - X.mean()
+            return X / (X.std(unbiased=False) + self.eps) * self.weight + self.bias
+
+        return F.layer_norm(X, [self.num_channels], self.weight, self.bias, self.eps)
+
+
+class FrozenStage(nn.Module):
+    """The MLP and graph layers of one stage as a plain sequence of layers on a fixed graph."""
+
+    def __init__(self, layers: List[nn.Module]):
+        super().__init__()
+        self.layers = nn.ModuleList(layers)
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        for layer in self.layers:
+            X = layer(X)
+        return X
+
+
+def _freeze_layer(layer: nn.Module, edge_index: torch.Tensor, num_nodes: int) -> nn.Module:
+    # SparseGATConv only prunes its graph while training, at inference it is a GATConv
+    if isinstance(layer, (SparseGATConv, GATConv)):
+        return FrozenGATConv(layer, edge_index, num_nodes)
+    if isinstance(layer, GCNConv):
+        return FrozenGCNConv(layer, edge_index, num_nodes)
+    if isinstance(layer, LayerNorm):
+        return FrozenLayerNorm(layer)
+    if isinstance(layer, (nn.Linear, nn.PReLU)):
+        return layer
+    raise NotImplementedError(f"Layer {type(layer).__name__} can not be frozen.")
+
+
+def _freeze_stage(model: Model, edge_index: torch.Tensor, num_nodes: int) -> FrozenStage:
+    layers = []
+    if model.mlp is not None:
+        layers.extend(_freeze_layer(layer, edge_index, num_nodes) for layer in model.mlp.MLP)
+
+    graph_layer: GraphLayer = model.graph_layer
+    if isinstance(graph_layer.layers, SimpleConv):
+        if graph_layer.layers.aggr != "mean":
+            raise NotImplementedError("Only SimpleConv layers with mean aggregation can be frozen.")
+        layers.append(FrozenMeanConv(edge_index, num_nodes))
+    else:
+        layers.extend(_freeze_layer(layer, edge_index, num_nodes) for layer in graph_layer.layers)
+
+    return FrozenStage(layers)
+
+
+class FrozenWeatherPrediction(nn.Module):
+    """The forward pass of `WeatherPrediction` on its static graphs, without any Python-level dispatch
+    on the layer types. The mesh node inputs never change and are precomputed as a buffer.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model. Its weights are copied, later changes to the model are not reflected.
+    """
+
+    def __init__(self, model: WeatherPrediction):
+        super().__init__()
+        self.num_grid_nodes = model._num_grid_nodes
+        self.num_product_nodes = model._num_grid_nodes * model.obs_window
+        self.num_features = model.num_features
+        self.use_product_graph = model.use_product_graph
+
+        num_nodes = model._num_grid_nodes + model._num_mesh_nodes
+        if model.use_product_graph:
+            self.product_stage = _freeze_stage(
+                model.product_graph_model, model.product_graph, self.num_product_nodes
+            )
+        else:
+            self.product_stage = FrozenStage([])
+
+        self.encoder = _freeze_stage(model.encoder, model.encoding_graph, num_nodes)
+        self.processor = _freeze_stage(model.processor, model.processing_graph, model._num_mesh_nodes)
+        self.decoder = _freeze_stage(model.decoder, model.decoding_graph, num_nodes)
+
+        input_size = model.num_features if model.use_product_graph else model.total_feature_size
+        self.register_buffer("init_grid_features", model.init_grid_features.detach().clone())
+        self.register_buffer(
+            "mesh_node_inputs",
+            torch.cat(
+                (
+                    torch.zeros(
+                        (model._num_mesh_nodes, input_size), device=model.init_mesh_features.device
+                    ),
+                    model.init_mesh_features.detach(),
+                ),
+                dim=-1,
+            ),
+        )
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        """Forecasts the next step of one sample of the shape [num_grid_nodes, obs_window * num_features]
+        or [1, num_grid_nodes, obs_window * num_features]. Returns [num_grid_nodes, num_features]."""
+        if self.use_product_graph:
+            # The product graph nodes are ordered by timestep and then by grid node
+            X = X.reshape(self.num_grid_nodes, -1, self.num_features).transpose(0, 1)
+            X = self.product_stage(X.reshape(self.num_product_nodes, self.num_features))
+            X = X[-self.num_grid_nodes :]
+        else:
+            X = X.reshape(self.num_grid_nodes, -1)
+
+        X = torch.cat((torch.cat((X, self.init_grid_features), dim=-1), self.mesh_node_inputs), dim=0)
+        X = self.encoder(X)
+
+        X = torch.cat((X[: self.num_grid_nodes], self.processor(X[self.num_grid_nodes :])), dim=0)
+
+        return self.decoder(X)[: self.num_grid_nodes]
+
+
+def freeze_model(model: WeatherPrediction, mode: str = "script") -> nn.Module:
+    """Builds the frozen inference module of a model.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model.
+    mode : str
+        `script` compiles the module with TorchScript and freezes it, so the weights become constants and
+        the module can be saved and loaded without this code. `compile` uses `torch.compile` with static
+        shapes, which can not be saved.
+
+    Returns
+    -------
+    nn.Module
+        The frozen module in evaluation mode.
+    """
+    frozen = FrozenWeatherPrediction(model).eval()
+
+    if mode == "script":
+        return torch.jit.freeze(torch.jit.script(frozen))
+    if mode == "compile":
+        return torch.compile(frozen, dynamic=False)
+
+    raise ValueError(f"Unknown mode {mode}, expected one of {COMPILE_MODES}.")
+
+
+def load_frozen_model(path: str, device=None) -> torch.jit.ScriptModule:
+    """Loads a frozen module saved by `python -m src.freeze`."""
+    return torch.jit.load(path, map_location=device)
+
+
+def _time_forward(forward, X: torch.Tensor, repeats: int) -> List[float]:
+    with torch.no_grad():
+        # Warm up, which also runs the compilation of the frozen modules
+        for _ in range(3):
+            forward(X)
+
+        durations = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            forward(X)
+            durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def compare_latency(
+    model: WeatherPrediction, frozen: Dict[str, nn.Module], X: torch.Tensor, repeats: int = 20
+) -> Dict[str, Dict[str, float]]:
+    """Times the forward pass of the eager model and of every frozen module on the same input. Returns the
+    median and the minimum latency in seconds, the speedup over eager mode and the maximum absolute
+    difference to the eager forecast."""
+    with torch.no_grad():
+        expected = model(X=X, attention_threshold=0.0)
+
+    forwards = {"eager": lambda X: model(X=X, attention_threshold=0.0)}
+    forwards.update({name: module for name, module in frozen.items()})
+
+    results = {}
+    for name, forward in forwards.items():
+        durations = _time_forward(forward, X, repeats)
+        with torch.no_grad():
+            max_difference = (forward(X) - expected).abs().max().item()
+        results[name] = {
+            "median": statistics.median(durations),
+            "min": min(durations),
+            "max_abs_difference": max_difference,
+        }
+
+    for name in results:
+        results[name]["speedup"] = results["eager"]["median"] / results[name]["median"]
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exports a trained model as a frozen inference module and compares its latency."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help=f"Where to save the TorchScript module, defaults to {FROZEN_MODEL_FILE} in the experiment directory.",
+    )
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=COMPILE_MODES,
+        default=["script"],
+        help="The frozen modules to compare against eager mode.",
+    )
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    from src.predict import load_trained_model
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    # The latency is reported on CPU, where the Python overhead is largest relative to the compute
+    model, experiment_config, _ = load_trained_model(
+        args.experiment_directory, device=torch.device("cpu"), checkpoint_path=args.checkpoint
+    )
+
+    frozen = {mode: freeze_model(model, mode=mode) for mode in args.modes}
+    if "script" in frozen:
+        output_path = args.output or os.path.join(args.experiment_directory, FROZEN_MODEL_FILE)
+        torch.jit.save(frozen["script"], output_path)
+        print(f"Frozen model saved to {output_path}")
+
+    X = torch.randn(
+        1, model._num_grid_nodes, experiment_config.data.obs_window_used * model.num_features
+    )
+    results = compare_latency(model, frozen, X, repeats=args.repeats)
+
+    print(f"{'mode':<10} {'median (ms)':>12} {'min (ms)':>10} {'speedup':>8} {'max abs diff':>13}")
+    for name, result in results.items():
+        print(
+            f"{name:<10} {result['median'] * 1000:>12.2f} {result['min'] * 1000:>10.2f} "
+            f"{result['speedup']:>8.2f} {result['max_abs_difference']:>13.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
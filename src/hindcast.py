@@ -0,0 +1,381 @@
+"""Runs a hindcast campaign, rollouts of a trained model from many start dates of a sharded dataset.
+
+The start dates are split into batches, which are forecasted by a pool of worker processes. Every worker
+loads the model with its static graphs and opens the dataset once, and runs with its share of the cores.
+The errors of every batch are reduced to sums per lead time and variable in the worker with
+`src.verification.StreamingMetrics`, so only these sums are sent back and merged, and the forecasts
+themselves are never stored. The campaign writes a summary with the latitude-weighted RMSE, bias and ACC per
+lead time and variable, in the units of the dataset, maps of the RMSE and the bias of every grid cell, and
+optionally the forecasts of every n-th start date to a zarr store. The anomalies of the ACC are relative to
+the mean of every grid cell over the whole dataset.
+
+Example
+-------
+python -m src.hindcast "<path-to-experinment-directory>" data/datasets/era5_64x32_2005_2010 hindcast_2010 --start-dates 2010-01-01T00 2010-01-02T00 --horizon 20 --workers 4
+python -m src.hindcast "<path-to-experinment-directory>" data/datasets/era5_64x32_2005_2010 hindcast_2010 --horizon 20 --stride 4 --sample-every 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from src.constants import FileNames
+from src.distributed import threads_per_rank
+from src.precision import autocast
+from src.predict import (
+    ZarrForecastWriter,
+    _normalisation_arrays,
+    _stack_features,
+    load_trained_model,
+    read_grid_states,
+)
+from src.utils import save_to_json_file
+from src.verification import StreamingMetrics
+
+
+# The model and the dataset of a worker process, loaded once by `_init_hindcast_worker`
+_worker: Dict[str, Any] = {}
+
+
+def _init_hindcast_worker(
+    experiment_dir: str,
+    sharded_dataset_dir: str,
+    checkpoint_path: Optional[str],
+    data_path: Optional[str],
+    num_threads: int,
+    latitudes: np.ndarray,
+    climatology: np.ndarray,
+):
+    # Every worker gets its share of the cores instead of all workers competing for all of them
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    torch.set_num_threads(num_threads)
+
+    from data.ingestion import load_manifest, open_sharded_dataset
+
+    model, experiment_config, _ = load_trained_model(
+        experiment_dir,
+        device=torch.device("cpu"),
+        checkpoint_path=checkpoint_path,
+        data_path=data_path,
+    )
+    _worker.update(
+        model=model,
+        experiment_config=experiment_config,
+        features=_stack_features(
+            open_sharded_dataset(sharded_dataset_dir), load_manifest(sharded_dataset_dir)
+        ),
+        latitudes=latitudes,
+        climatology=torch.from_numpy(climatology),
+    )
+
+
+def _run_hindcast_batch(
+    init_time_indices: np.ndarray, horizon: int, sampled: np.ndarray
+) -> Tuple[StreamingMetrics, np.ndarray]:
+    """Forecasts a batch of start dates in a worker. Returns the sums of the errors and the forecasts of
+    the sampled start dates of the shape [sampled, lead, grid, variable]."""
+    model = _worker["model"]
+    data_config = _worker["experiment_config"].data
+    obs_window = data_config.obs_window_used
+
+    # The observation windows and the targets of all lead times are read at once
+    time_indices = init_time_indices[:, None] + np.arange(1 - obs_window, horizon + 1)[None, :]
+    states = torch.from_numpy(
+        np.ascontiguousarray(
+            read_grid_states(_worker["features"], time_indices, model.num_features), dtype=np.float32
+        )
+    )
+    # [batch, obs_window, grid, features] -> [batch, grid, obs_window, features]
+    X = states[:, :obs_window].transpose(1, 2)
+    if data_config.want_feats_flattened:
+        X = X.reshape(X.shape[0], X.shape[1], -1)
+
+    with torch.no_grad(), autocast(_worker["experiment_config"].precision, "cpu"):
+        forecasts = model.rollout(X=X, num_steps=horizon)
+
+    errors = StreamingMetrics(
+        latitudes=_worker["latitudes"],
+        num_longitudes=states.shape[2] // len(_worker["latitudes"]),
+        num_features=model.num_features,
+        num_leads=horizon,
+        climatology=_worker["climatology"],
+    )
+    errors.update(forecasts, states[:, obs_window:])
+
+    return errors, forecasts[torch.from_numpy(sampled)].numpy()
+
+
+def run_hindcast(
+    experiment_dir: str,
+    sharded_dataset_dir: str,
+    output_dir: str,
+    start_dates: Optional[List[str]] = None,
+    horizon: int = 20,
+    stride: int = 1,
+    num_workers: int = 1,
+    threads_per_worker: Optional[int] = None,
+    batch_size: int = 8,
+    sample_every: Optional[int] = None,
+    checkpoint_path: Optional[str] = None,
+    data_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Forecasts `horizon` timesteps from every start date and writes the summary of the errors to
+    `<output_dir>/hindcast_summary.json` and the maps of the errors to `<output_dir>/error_maps.zarr`.
+
+    Parameters
+    ----------
+    experiment_dir : str
+        The experiment directory that contains the config.json file and the best model.
+    sharded_dataset_dir : str
+        A dataset written by `data.ingestion`, with the variables the model was trained on.
+    output_dir : str
+        The directory to write the summary, and the sampled forecasts, to.
+    start_dates : Optional[List[str]]
+        The initial times of the forecasts. Defaults to all times with a full observation window before
+        them and `horizon` timesteps after them.
+    horizon : int
+        The number of timesteps every forecast is rolled out for.
+    stride : int
+        Only uses every `stride`-th start date.
+    num_workers : int
+        The number of worker processes.
+    threads_per_worker : Optional[int]
+        The intra-op threads of every worker. Defaults to an even share of the cores.
+    batch_size : int
+        The number of start dates a worker forecasts at once.
+    sample_every : Optional[int]
+        Writes the forecasts of every `sample_every`-th start date to `<output_dir>/sampled_forecasts.zarr`.
+    checkpoint_path : Optional[str]
+        The weights to use instead of the best model.
+    data_path : Optional[str]
+        The directory of the training dataset.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The summary with the metrics per variable and lead time.
+    """
+    import pandas as pd
+    import xarray as xr
+
+    from data.ingestion import load_manifest, open_sharded_dataset
+
+    # Loads the model once before starting the workers, which also builds and caches the static graphs
+    model, experiment_config, _ = load_trained_model(
+        experiment_dir,
+        device=torch.device("cpu"),
+        checkpoint_path=checkpoint_path,
+        data_path=data_path,
+    )
+    num_features = model.num_features
+    obs_window = experiment_config.data.obs_window_used
+    del model
+
+    manifest = load_manifest(sharded_dataset_dir)
+    dataset = open_sharded_dataset(sharded_dataset_dir)
+    features = _stack_features(dataset, manifest)
+    if features.sizes["variable"] < num_features:
+        raise ValueError(
+            f"The model uses {num_features} features, the dataset only has {features.sizes['variable']}."
+        )
+
+    num_times = features.sizes["time"]
+    if start_dates is None:
+        init_time_indices = np.arange(obs_window - 1, num_times - horizon)
+    else:
+        init_time_indices = np.sort(dataset.indexes["time"].get_indexer(pd.to_datetime(start_dates)))
+        invalid = (init_time_indices < obs_window - 1) | (init_time_indices + horizon >= num_times)
+        if invalid.any():
+            raise ValueError(
+                f"{invalid.sum()} start dates are not in the dataset or lack a full observation window "
+                f"before them or {horizon} timesteps after them."
+            )
+    init_time_indices = init_time_indices[::stride]
+    if len(init_time_indices) == 0:
+        raise ValueError("There are no start dates to forecast from.")
+
+    times = features.time.values
+    time_step = times[1] - times[0]
+    lead_times = np.arange(1, horizon + 1) * time_step
+    variable_names = [str(name) for name in features["variable"].values[:num_features]]
+    mean, std = _normalisation_arrays(manifest, num_features)
+    latitudes = features.latitude.values
+    # [longitude, latitude, variable] -> [grid, variable], in the normalised units of the model
+    climatology = (
+        features.isel(variable=slice(0, num_features)).mean("time").values.reshape(-1, num_features)
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    sampled = np.zeros(len(init_time_indices), dtype=bool)
+    writer = None
+    if sample_every:
+        sampled[::sample_every] = True
+        writer = ZarrForecastWriter(
+            os.path.join(output_dir, FileNames.HINDCAST_SAMPLES),
+            coords={
+                "lead": lead_times,
+                "variable": np.asarray(variable_names),
+                "latitude": features.latitude.values,
+                "longitude": features.longitude.values,
+            },
+            num_longitudes=features.sizes["longitude"],
+            num_latitudes=features.sizes["latitude"],
+            attrs={"experiment": os.path.abspath(experiment_dir), "normalised": 0},
+        )
+
+    num_workers = max(1, min(num_workers, -(-len(init_time_indices) // batch_size)))
+    num_threads = threads_per_worker or threads_per_rank(num_workers)
+    print(
+        f"Forecasting {len(init_time_indices)} start dates {horizon} steps ahead with {num_workers} workers "
+        f"and {num_threads} threads each"
+    )
+
+    errors = StreamingMetrics(latitudes, features.sizes["longitude"], num_features, num_leads=horizon)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_hindcast_worker,
+        initargs=(
+            experiment_dir,
+            sharded_dataset_dir,
+            checkpoint_path,
+            data_path,
+            num_threads,
+            latitudes,
+            climatology,
+        ),
+    ) as pool:
+        batches = [
+            slice(batch_start, batch_start + batch_size)
+            for batch_start in range(0, len(init_time_indices), batch_size)
+        ]
+        futures = [
+            pool.submit(_run_hindcast_batch, init_time_indices[batch], horizon, sampled[batch])
+            for batch in batches
+        ]
+
+        # The results are collected in order, so the sampled forecasts are written sorted by time
+        for batch, future in zip(batches, futures):
+            batch_errors, sampled_forecasts = future.result()
+            errors.merge(batch_errors)
+            if writer is not None and len(sampled_forecasts):
+                writer.write(
+                    times[init_time_indices[batch][sampled[batch]]],
+                    (sampled_forecasts * std + mean).astype(np.float32),
+                )
+            print(f"Forecasts: {errors.num_forecasts}/{len(init_time_indices)}", end="\r")
+
+    duration = time.perf_counter() - start
+    print()
+
+    error_maps = errors.error_maps(scale=std)
+    xr.Dataset(
+        {
+            name: (("lead", "latitude", "longitude", "variable"), error_map.astype(np.float32))
+            for name, error_map in error_maps.items()
+        },
+        coords={
+            "lead": lead_times,
+            "latitude": latitudes,
+            "longitude": features.longitude.values,
+            "variable": np.asarray(variable_names),
+        },
+    ).to_zarr(os.path.join(output_dir, FileNames.HINDCAST_ERROR_MAPS), mode="w")
+
+    summary = {
+        "experiment": os.path.abspath(experiment_dir),
+        "dataset": os.path.abspath(sharded_dataset_dir),
+        "num_forecasts": errors.num_forecasts,
+        "first_start_date": str(times[init_time_indices[0]]),
+        "last_start_date": str(times[init_time_indices[-1]]),
+        "lead_hours": (lead_times / np.timedelta64(1, "h")).tolist(),
+        "variables": errors.summary(variable_names, scale=std),
+        "num_workers": num_workers,
+        "threads_per_worker": num_threads,
+        "seconds": duration,
+        "forecasts_per_second": errors.num_forecasts / duration,
+        "num_sampled_forecasts": int(sampled.sum()),
+    }
+    save_to_json_file(data_dict=summary, save_path=os.path.join(output_dir, FileNames.HINDCAST_SUMMARY))
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs rollouts from many start dates and summarises the errors per lead time."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument("sharded_dataset", help="A dataset written by data.ingestion.")
+    parser.add_argument("output_directory", help="Where to write the summary and the sampled forecasts.")
+    start_dates = parser.add_mutually_exclusive_group()
+    start_dates.add_argument(
+        "--start-dates", nargs="+", default=None, help="The start dates, e.g. 2010-01-01T06."
+    )
+    start_dates.add_argument("--start-dates-file", default=None, help="A file with one start date per line.")
+    parser.add_argument("--horizon", type=int, default=20, help="The number of timesteps of every rollout.")
+    parser.add_argument("--stride", type=int, default=1, help="Only uses every n-th start date.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument(
+        "--sample-every",
+        type=int,
+        default=None,
+        help="Writes the forecasts of every n-th start date to a zarr store.",
+    )
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument(
+        "--data-path",
+        default=None,
+        help="The directory of the training dataset, defaults to data/datasets/<dataset_name>.",
+    )
+    args = parser.parse_args()
+
+    start_dates = args.start_dates
+    if args.start_dates_file:
+        with open(args.start_dates_file) as infile:
+            start_dates = [line.strip() for line in infile if line.strip()]
+
+    summary = run_hindcast(
+        experiment_dir=args.experiment_directory,
+        sharded_dataset_dir=args.sharded_dataset,
+        output_dir=args.output_directory,
+        start_dates=start_dates,
+        horizon=args.horizon,
+        stride=args.stride,
+        num_workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        batch_size=args.batch_size,
+        sample_every=args.sample_every,
+        checkpoint_path=args.checkpoint,
+        data_path=args.data_path,
+    )
+
+    leads = summary["lead_hours"]
+    shown_leads = sorted({0, len(leads) // 2, len(leads) - 1})
+    print(f"{'variable':<20} {'metric':<6} " + " ".join(f"{f'+{leads[i]:g}h':>10}" for i in shown_leads))
+    for name, metrics in summary["variables"].items():
+        for metric in ["rmse", "bias", "acc"]:
+            print(
+                f"{name:<20} {metric:<6} " + " ".join(f"{metrics[metric][i]:>10.4f}" for i in shown_leads)
+            )
+    print(
+        f"{summary['num_forecasts']} forecasts in {summary['seconds']:.1f}s "
+        f"({summary['forecasts_per_second']:.1f} forecasts/s), summary saved to "
+        f"{os.path.join(args.output_directory, FileNames.HINDCAST_SUMMARY)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
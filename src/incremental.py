@@ -0,0 +1,411 @@
+"""Incremental forecasts for a stream of observations that reuse the work of the previous cycle.
+
+With a product graph, `forward` runs the product graph model over all timesteps of the observation window,
+although all but the newest one were already part of the previous window. The temporal edges of the product
+graph only go from one timestep to the next, so after l graph layers the state of a timestep only depends on
+the l timesteps before it. Once a state is far enough from the oldest timestep of the window that it does
+not see the start of the window, it does not change when the window moves on, and it is cached under the
+valid time of its timestep. A new cycle only computes the states that depend on the new timestep or are too
+close to the start of the window. The encoder, the processor and the decoder only see the newest timestep
+and always run.
+
+Models without a product graph, or with layers that mix all nodes of the graph like a graph-wise layer
+norm, fall back to `forward` on the full window.
+
+Example
+-------
+python -m src.incremental "<path-to-experinment-directory>" --split test --cycles 50
+"""
+
+import argparse
+import bisect
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+import torch
+import torch.nn as nn
+
+from src.freeze import (
+    FrozenGATConv,
+    FrozenGCNConv,
+    FrozenLayerNorm,
+    FrozenMeanConv,
+    _freeze_stage,
+)
+from src.models import WeatherPrediction
+
+
+def _local_margin(conv: nn.Module) -> int:
+    """The number of timesteps before the target's timestep that have to be inside the window, so that the
+    graph of its incoming edges is the same as in the middle of a long sequence."""
+    # The normalised GCN edge weights also depend on the in-degrees of the sources
+    if isinstance(conv, FrozenGCNConv):
+        return 2
+    return 1
+
+
+class _ProductGraphStage:
+    """The layers of the product graph model, evaluated for any subset of the timesteps of the window.
+
+    States are indexed by the layer, where 0 is the input, and by the position of their timestep in the
+    window. The state of a timestep is interior after a layer if it does not depend on the start of the
+    window, which is the case from the position `margins[layer]` on.
+    """
+
+    def __init__(self, model: WeatherPrediction):
+        self.num_grid_nodes = model._num_grid_nodes
+        self.obs_window = model.obs_window
+
+        stage = _freeze_stage(
+            model.product_graph_model, model.product_graph, self.num_grid_nodes * self.obs_window
+        ).eval()
+        self.layers = list(stage.layers)
+
+        self.margins = [0]
+        # Per graph layer the ids, the source and the target positions and nodes of its edges
+        self.edges: Dict[int, Dict[str, Any]] = {}
+        for i, layer in enumerate(self.layers):
+            if isinstance(layer, (FrozenGCNConv, FrozenGATConv, FrozenMeanConv)):
+                self.edges[i] = self._group_edges(layer)
+                self.margins.append(max(self.margins[-1] + 1, _local_margin(layer)))
+            elif isinstance(layer, (nn.Linear, nn.PReLU)) or (
+                isinstance(layer, FrozenLayerNorm) and not layer.graph_mode
+            ):
+                self.margins.append(self.margins[-1])
+            else:
+                raise NotImplementedError(
+                    f"{type(layer).__name__} mixes the timesteps of the product graph."
+                )
+
+        # The edge indices of the graph layers for the sets of target positions that were evaluated before
+        self._subgraphs: Dict[Tuple[int, Tuple[int, ...]], Tuple[List[int], Tuple[torch.Tensor, ...]]] = {}
+
+    @property
+    def num_layers(self) -> int:
+        return len(self.layers)
+
+    def _group_edges(self, conv: nn.Module) -> Dict[str, Any]:
+        source_position = torch.div(conv.source, self.num_grid_nodes, rounding_mode="floor")
+        target_position = torch.div(conv.target, self.num_grid_nodes, rounding_mode="floor")
+
+        edge_ids = [
+            torch.nonzero(target_position == position).flatten() for position in range(self.obs_window)
+        ]
+        return {
+            "edge_ids": edge_ids,
+            "source_positions": [
+                set(source_position[ids].tolist()) | {position} for position, ids in enumerate(edge_ids)
+            ],
+            "source_position": source_position,
+            "source_node": conv.source % self.num_grid_nodes,
+            "target_position": target_position,
+            "target_node": conv.target % self.num_grid_nodes,
+        }
+
+    def input_positions(self, layer_index: int, positions: Set[int]) -> Set[int]:
+        """The positions whose states before the layer are needed to compute the states of `positions`."""
+        if layer_index not in self.edges:
+            return set(positions)
+
+        source_positions = self.edges[layer_index]["source_positions"]
+        return set().union(*(source_positions[position] for position in positions))
+
+    def _subgraph(self, layer_index: int, positions: Tuple[int, ...]):
+        key = (layer_index, positions)
+        if key not in self._subgraphs:
+            edges = self.edges[layer_index]
+            layer = self.layers[layer_index]
+            input_positions = sorted(self.input_positions(layer_index, set(positions)))
+
+            ids = torch.cat([edges["edge_ids"][position] for position in positions])
+            input_slot = torch.full((self.obs_window,), -1, dtype=torch.long, device=ids.device)
+            input_slot[input_positions] = torch.arange(len(input_positions), device=ids.device)
+            output_slot = torch.full((self.obs_window,), -1, dtype=torch.long, device=ids.device)
+            output_slot[list(positions)] = torch.arange(len(positions), device=ids.device)
+
+            N = self.num_grid_nodes
+            source = input_slot[edges["source_position"][ids]] * N + edges["source_node"][ids]
+            target = output_slot[edges["target_position"][ids]] * N + edges["target_node"][ids]
+
+            if isinstance(layer, FrozenGCNConv):
+                tensors = (source, target, layer.edge_weight[ids])
+            elif isinstance(layer, FrozenGATConv):
+                target_input = input_slot[edges["target_position"][ids]] * N + edges["target_node"][ids]
+                tensors = (source, target, target_input)
+            else:
+                target_nodes = torch.cat(
+                    [torch.arange(N, device=ids.device) + position * N for position in positions]
+                )
+                tensors = (source, target, layer.inverse_degree[target_nodes])
+
+            self._subgraphs[key] = (input_positions, tensors)
+
+        return self._subgraphs[key]
+
+    def apply_layer(
+        self, layer_index: int, positions: List[int], states: Dict[int, torch.Tensor]
+    ) -> Dict[int, torch.Tensor]:
+        """Computes the states after the layer for the positions from the states before it."""
+        layer = self.layers[layer_index]
+        num_targets = len(positions) * self.num_grid_nodes
+
+        if layer_index in self.edges:
+            input_positions, tensors = self._subgraph(layer_index, tuple(positions))
+            X = torch.cat([states[position] for position in input_positions])
+            out = layer.forward_edges(X, *tensors, num_targets)
+        else:
+            out = layer(torch.cat([states[position] for position in positions]))
+
+        return dict(zip(positions, out.split(self.num_grid_nodes)))
+
+
+class IncrementalForecaster:
+    """Forecasts the next timestep from the latest `obs_window` observations of a stream, reusing the
+    states of the product graph model from earlier cycles. The forecasts are the same as those of `forward`
+    on the same window, up to the floating point order of the aggregations.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model, which is put into evaluation mode.
+    """
+
+    def __init__(self, model: WeatherPrediction):
+        self.model = model.eval()
+        self.obs_window = model.obs_window
+        self.fallback_reason: Optional[str] = None
+        self.stage: Optional[_ProductGraphStage] = None
+
+        if not model.use_product_graph:
+            self.fallback_reason = "The model has no product graph, all timesteps go into the encoder at once."
+        else:
+            try:
+                self.stage = _ProductGraphStage(model)
+            except NotImplementedError as error:
+                self.fallback_reason = str(error)
+
+        self.valid_times: List[Hashable] = []
+        self.observations: Dict[Hashable, torch.Tensor] = {}
+        # The interior states of the product graph model per valid time and layer
+        self.cache: Dict[Hashable, Dict[int, torch.Tensor]] = {}
+        self.last_cycle: Dict[str, int] = {}
+
+    @property
+    def is_incremental(self) -> bool:
+        return self.stage is not None
+
+    def reset(self):
+        self.valid_times, self.observations, self.cache = [], {}, {}
+
+    def observe(self, valid_time: Hashable, grid_state: torch.Tensor):
+        """Adds the observation of a valid time, or replaces it if the valid time was observed before.
+
+        Parameters
+        ----------
+        valid_time : Hashable
+            Any sortable key of the timestep, e.g. a numpy datetime64 or an integer.
+        grid_state : torch.Tensor
+            The features of the grid nodes of the shape [num_grid_nodes, num_features].
+        """
+        if grid_state.shape != (self.model._num_grid_nodes, self.model.num_features):
+            raise ValueError(
+                f"Expected an observation of the shape {(self.model._num_grid_nodes, self.model.num_features)}, "
+                f"got {tuple(grid_state.shape)}."
+            )
+
+        # The states of the later timesteps depend on this one
+        if self.valid_times and valid_time <= self.valid_times[-1]:
+            for later_time in self.valid_times[bisect.bisect_left(self.valid_times, valid_time) :]:
+                self.cache.pop(later_time, None)
+
+        if valid_time not in self.observations:
+            bisect.insort(self.valid_times, valid_time)
+        self.observations[valid_time] = grid_state.float().to(self.model.init_grid_features.device)
+
+        # Only the observations of the current window are kept
+        for old_time in self.valid_times[: -self.obs_window]:
+            self.observations.pop(old_time)
+            self.cache.pop(old_time, None)
+        self.valid_times = self.valid_times[-self.obs_window :]
+
+    def window(self) -> torch.Tensor:
+        """The observation window of the shape [1, num_grid_nodes, obs_window * num_features]."""
+        if len(self.valid_times) < self.obs_window:
+            raise ValueError(
+                f"A forecast needs {self.obs_window} observations, only {len(self.valid_times)} were observed."
+            )
+
+        X = torch.stack([self.observations[valid_time] for valid_time in self.valid_times], dim=1)
+        return X.reshape(1, X.shape[0], -1)
+
+    @torch.no_grad()
+    def forecast(self) -> torch.Tensor:
+        """Forecasts the timestep after the latest observation.
+
+        Returns
+        -------
+        torch.Tensor
+            The prediction of the shape [num_grid_nodes, num_features].
+        """
+        if not self.is_incremental:
+            return self.model(X=self.window(), attention_threshold=0.0)
+
+        self.window()
+        stage = self.stage
+        num_layers = stage.num_layers
+        newest = self.obs_window - 1
+
+        # Finds the states that are needed and not cached, from the output of the newest timestep down
+        required: Dict[int, Set[int]] = {num_layers: {newest}}
+        to_compute: Dict[int, Set[int]] = {}
+        for layer in range(num_layers, 0, -1):
+            to_compute[layer] = {
+                position for position in required[layer] if not self._is_cached(position, layer)
+            }
+            required[layer - 1] = stage.input_positions(layer - 1, to_compute[layer])
+
+        states = {position: self.observations[self.valid_times[position]] for position in required[0]}
+        for layer in range(1, num_layers + 1):
+            layer_states = {
+                position: self.cache[self.valid_times[position]][layer]
+                for position in required[layer] - to_compute[layer]
+            }
+            if to_compute[layer]:
+                computed = stage.apply_layer(layer - 1, sorted(to_compute[layer]), states)
+                for position, state in computed.items():
+                    if position >= stage.margins[layer]:
+                        self.cache.setdefault(self.valid_times[position], {})[layer] = state
+                layer_states.update(computed)
+            states = layer_states
+
+        self.last_cycle = {
+            "computed_states": sum(len(positions) for positions in to_compute.values()),
+            "full_states": num_layers * self.obs_window,
+        }
+        return self.model._encode_process_decode(states[newest], attention_threshold=0.0)
+
+    def _is_cached(self, position: int, layer: int) -> bool:
+        return position >= self.stage.margins[layer] and layer in self.cache.get(
+            self.valid_times[position], {}
+        )
+
+
+def measure_cycles(
+    model: WeatherPrediction, dataset, num_cycles: int
+) -> Dict[str, Any]:
+    """Runs forecast cycles on the newest timesteps of consecutive samples of a split and compares the
+    latency of the incremental forecasts with `forward` on the same windows.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model.
+    dataset
+        The split, with samples of the form (X, y).
+    num_cycles : int
+        The number of forecast cycles after the first window, at most the number of samples minus one.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The median latency of both, the speedup, the share of the product graph states that were computed
+        per cycle and the maximum absolute difference between the forecasts.
+    """
+    forecaster = IncrementalForecaster(model)
+    num_cycles = min(num_cycles, len(dataset) - 1)
+
+    def _observations(index: int) -> torch.Tensor:
+        X = dataset[index][0].float()
+        return X.reshape(model._num_grid_nodes, model.obs_window, model.num_features)
+
+    first_window = _observations(0)
+    for position in range(model.obs_window):
+        forecaster.observe(position, first_window[:, position])
+    forecaster.forecast()
+
+    incremental_durations, full_durations, computed_shares = [], [], []
+    max_difference = 0.0
+    for cycle in range(1, num_cycles + 1):
+        forecaster.observe(model.obs_window - 1 + cycle, _observations(cycle)[:, -1])
+
+        start = time.perf_counter()
+        prediction = forecaster.forecast()
+        incremental_durations.append(time.perf_counter() - start)
+
+        window = forecaster.window()
+        start = time.perf_counter()
+        with torch.no_grad():
+            expected = model(X=window, attention_threshold=0.0)
+        full_durations.append(time.perf_counter() - start)
+
+        max_difference = max(max_difference, (prediction - expected).abs().max().item())
+        if forecaster.is_incremental:
+            computed_shares.append(
+                forecaster.last_cycle["computed_states"] / forecaster.last_cycle["full_states"]
+            )
+
+    incremental_latency = statistics.median(incremental_durations)
+    full_latency = statistics.median(full_durations)
+    return {
+        "num_cycles": num_cycles,
+        "incremental": forecaster.is_incremental,
+        "fallback_reason": forecaster.fallback_reason,
+        "incremental_latency": incremental_latency,
+        "full_latency": full_latency,
+        "speedup": full_latency / incremental_latency,
+        "computed_state_share": statistics.mean(computed_shares) if computed_shares else 1.0,
+        "max_abs_difference": max_difference,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the latency of incremental forecast cycles against full forward passes."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument("--split", choices=["train", "val", "test"], default="test")
+    parser.add_argument("--cycles", type=int, default=50)
+    parser.add_argument("--output", default=None, help="Saves the results as JSON.")
+    args = parser.parse_args()
+
+    from src.data.dataloader import load_train_and_test_datasets
+    from src.predict import load_trained_model
+
+    model, experiment_config, _ = load_trained_model(
+        args.experiment_directory, device=torch.device("cpu"), checkpoint_path=args.checkpoint
+    )
+    splits = load_train_and_test_datasets(
+        data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+        data_config=experiment_config.data,
+    )
+    dataset = splits[["train", "val", "test"].index(args.split)]
+
+    results = measure_cycles(model, dataset, num_cycles=args.cycles)
+
+    if not results["incremental"]:
+        print(f"Falling back to full forward passes: {results['fallback_reason']}")
+    print(
+        f"Per cycle: incremental {results['incremental_latency'] * 1000:.2f} ms, "
+        f"full {results['full_latency'] * 1000:.2f} ms, speedup {results['speedup']:.2f}x "
+        f"over {results['num_cycles']} cycles"
+    )
+    print(
+        f"Computed {results['computed_state_share']:.1%} of the product graph states per cycle, "
+        f"max abs difference to forward {results['max_abs_difference']:.2e}"
+    )
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f"Incremental forecast results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,33 @@
 """Main entrypoint to run training for Weather Prediciton"""
-import sys
+import argparse
 import os
 from src.constants import FileNames, FolderNames
 from src.config import ExperimentConfig
 from src.utils import load_from_json_file
-from torch.utils.data import DataLoader
 import torch
 from src.models import WeatherPrediction
 import numpy as np
 from torch.optim import Adam
 from src.train import train
-from src.data.dataloader import load_train_and_test_datasets
+from src.data.dataloader import (
+    create_dataloader,
+    create_evaluation_subset,
+    load_train_and_test_datasets,
+)
+from src.async_eval import AsyncEvaluator
 from src.data.data_configs import DatasetMetadata
+from src.checkpoint import find_latest_checkpoint, get_checkpoint_dir, load_checkpoint
+from src.distributed import (
+    ShardedEvalSampler,
+    barrier,
+    get_world_size,
+    is_distributed,
+    is_main_process,
+    launch,
+)
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from typing import Optional, Tuple
 import random
 
 CURRENT_WORKING_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -23,10 +39,8 @@ def set_random_seeds(seed: int = 42):
     torch.manual_seed(42)
 
 
-def load_model_from_experiment_config(
-    experiment_config: ExperimentConfig, device, dataset_metadata: DatasetMetadata
-) -> WeatherPrediction:
-
+def get_grid_coordinates(dataset_metadata: DatasetMetadata) -> Tuple[np.ndarray, np.ndarray]:
+    """The latitudes and longitudes of the grid of a dataset in degrees."""
     lats = np.linspace(
         start=-90,
         stop=90,
@@ -40,77 +54,181 @@ def load_model_from_experiment_config(
         endpoint=False,
     )
 
+    return lats, longs
+
+
+def load_model_from_experiment_config(
+    experiment_config: ExperimentConfig,
+    device,
+    dataset_metadata: DatasetMetadata,
+    graph_cache_dir: Optional[str] = None,
+    print_summary: bool = False,
+) -> WeatherPrediction:
+
+    lats, longs = get_grid_coordinates(dataset_metadata)
+
     model = WeatherPrediction(
         cordinates=(lats, longs),
         graph_config=experiment_config.graph,
         pipeline_config=experiment_config.pipeline,
         data_config=experiment_config.data,
         device=device,
+        graph_cache_dir=graph_cache_dir,
+        print_summary=print_summary,
     )
 
     return model
 
 
-def run_experiment(experiment_config: ExperimentConfig, results_save_dir: str):
+def run_experiment(
+    experiment_config: ExperimentConfig,
+    results_save_dir: str,
+    resume_from: Optional[str] = None,
+):
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     set_random_seeds(seed=experiment_config.random_seed)
 
+    data_path = os.path.join("data", "datasets", experiment_config.data.dataset_name)
     train_dataset, val_dataset, test_dataset, dataset_metadata = (
         load_train_and_test_datasets(
-            data_path=os.path.join(
-                "data", "datasets", experiment_config.data.dataset_name
-            ),
+            data_path=data_path,
             data_config=experiment_config.data,
+            use_shared_cache=experiment_config.shared_dataset_cache,
         )
     )
+    val_dataset, test_dataset = (
+        create_evaluation_subset(
+            dataset,
+            subset_size=experiment_config.eval_subset_size,
+            seed=experiment_config.random_seed,
+        )
+        for dataset in (val_dataset, test_dataset)
+    )
+
+    train_sampler, val_sampler, test_sampler = None, None, None
+    if is_distributed():
+        # Every rank trains on a disjoint shard of the same size, so that all ranks take the same
+        # number of optimiser steps, and evaluates on a disjoint shard of the evaluation splits
+        train_sampler = DistributedSampler(
+            train_dataset,
+            shuffle=True,
+            seed=experiment_config.random_seed or 0,
+            drop_last=True,
+        )
+        val_sampler = ShardedEvalSampler(val_dataset)
+        test_sampler = ShardedEvalSampler(test_dataset)
 
-    train_dataloader = DataLoader(
-        train_dataset, batch_size=experiment_config.batch_size, shuffle=True
+    train_dataloader = create_dataloader(
+        train_dataset,
+        experiment_config=experiment_config,
+        device=device,
+        shuffle=True,
+        sampler=train_sampler,
     )
-    val_dataloader = DataLoader(
-        val_dataset, batch_size=experiment_config.batch_size, shuffle=False
+    val_dataloader = create_dataloader(
+        val_dataset,
+        experiment_config=experiment_config,
+        device=device,
+        shuffle=False,
+        sampler=val_sampler,
     )
-    test_dataloader = DataLoader(
-        test_dataset, batch_size=experiment_config.batch_size, shuffle=False
+    test_dataloader = create_dataloader(
+        test_dataset,
+        experiment_config=experiment_config,
+        device=device,
+        shuffle=False,
+        sampler=test_sampler,
     )
 
+    graph_cache_dir = experiment_config.graph_cache_dir
+    if graph_cache_dir is None and is_distributed():
+        graph_cache_dir = os.path.join(results_save_dir, FolderNames.GRAPH_CACHE)
+
+    # Rank 0 builds the static graphs and stores them in the cache, the other ranks load them from there
+    if not is_main_process():
+        barrier()
+
     model: WeatherPrediction = load_model_from_experiment_config(
         experiment_config=experiment_config,
         device=device,
         dataset_metadata=dataset_metadata,
+        graph_cache_dir=graph_cache_dir,
+        print_summary=experiment_config.print_model_summary and is_main_process(),
     )
 
+    if is_main_process():
+        barrier()
+
     model = model.to(device)
 
+    if is_distributed():
+        print(f"Rank {torch.distributed.get_rank()} of {get_world_size()} is ready")
+        model = DistributedDataParallel(model)
+
     optimizer = Adam(params=model.parameters(), lr=experiment_config.learning_rate)
 
-    train_losses, val_losses, test_losses = train(
-        model=model,
-        train_dataloader=train_dataloader,
-        val_dataloader=val_dataloader,
-        test_dataloader=test_dataloader,
-        optimiser=optimizer,
-        num_epochs=experiment_config.num_epochs,
-        device=device,
-        config=experiment_config,
-        results_save_dir=results_save_dir,
-        print_losses=True,
-        wandb_log=experiment_config.wandb_log,
-    )
+    resume_checkpoint = None
+    if resume_from is not None:
+        print(f"Loading checkpoint {resume_from}")
+        resume_checkpoint = load_checkpoint(checkpoint_path=resume_from, device=device)
 
-    results = {
-        "train_losses": train_losses,
-        "val_losses": val_losses,
-        "test_losses": test_losses,
-    }
+    # With multiple ranks only rank 0 evaluates asynchronously, on the full evaluation splits
+    evaluator = None
+    if experiment_config.async_eval and is_main_process():
+        evaluator = AsyncEvaluator(
+            model=model,
+            experiment_config=experiment_config,
+            data_path=data_path,
+            device=device,
+        )
+
+    try:
+        training_results = train(
+            model=model,
+            train_dataloader=train_dataloader,
+            val_dataloader=val_dataloader,
+            test_dataloader=test_dataloader,
+            optimiser=optimizer,
+            num_epochs=experiment_config.num_epochs,
+            device=device,
+            config=experiment_config,
+            results_save_dir=results_save_dir,
+            print_losses=True,
+            wandb_log=experiment_config.wandb_log,
+            resume_checkpoint=resume_checkpoint,
+            evaluator=evaluator,
+        )
+    finally:
+        if evaluator is not None:
+            evaluator.close()
 
-    return results
+    return training_results
 
 
 def main():
-    experiment_directory = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Runs training for Weather Prediction.")
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file.",
+    )
+    parser.add_argument(
+        "--nproc-per-node",
+        type=int,
+        default=1,
+        help="The number of data-parallel training processes to start on this node.",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="latest",
+        default=None,
+        help="Resume training from a checkpoint. Without a path the latest checkpoint of the experiment is used.",
+    )
+    args = parser.parse_args()
+
+    experiment_directory = args.experiment_directory
 
     experiment_config_path = os.path.join(
         experiment_directory, FileNames.EXPERIMENT_CONFIG
@@ -123,8 +241,16 @@ def main():
 
     experiment_config = ExperimentConfig(**load_from_json_file(experiment_config_path))
 
-    run_experiment(
-        experiment_config=experiment_config, results_save_dir=results_save_dir
+    resume_from = args.resume
+    if resume_from == "latest":
+        resume_from = find_latest_checkpoint(get_checkpoint_dir(results_save_dir))
+        if resume_from is None:
+            print("No checkpoint found to resume from, starting training from scratch.")
+
+    launch(
+        run_experiment,
+        args=(experiment_config, results_save_dir, resume_from),
+        nproc_per_node=args.nproc_per_node,
     )
 
 
@@ -0,0 +1,299 @@
+"""Non-blocking logging of training metrics to local files and, optionally, Weights & Biases.
+
+Metrics are handed to a background thread that writes them to every configured backend, so a slow disk or
+an unreachable wandb server never holds back the training loop. The local backends work without network
+access, and a JSONL log can be synced to wandb later.
+
+Example
+-------
+python -m src.metrics sync "<path-to-experinment-directory>"
+"""
+
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import warnings
+from typing import Any, Dict, List, Optional
+
+from src.config import ExperimentConfig, MetricsBackend
+from src.constants import FileNames
+from src.utils import load_from_json_file
+
+
+class MetricsWriter:
+    """A backend of the metrics logger. `write` is always called from the background thread."""
+
+    def write(self, records: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JSONLWriter(MetricsWriter):
+    """Writes every record as one JSON line, e.g. `{"step": 3, "time": 1718000000.0, "train_loss": 0.5}`.
+    An existing file is overwritten, unless `append` is set to continue the metrics of a resumed run."""
+
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        self.append = append
+        self._file = None
+
+    def write(self, records: List[Dict[str, Any]]):
+        if self._file is None:
+            self._file = open(self.path, "a" if self.append else "w")
+
+        for record in records:
+            line = {"step": record["step"], "time": record["time"], **record["metrics"]}
+            self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class SQLiteWriter(MetricsWriter):
+    """Stores every metric as one row of `metrics(step, time, name, value)`. Values that are not numbers
+    are stored as NULL. Existing metrics are removed, unless `append` is set to continue the metrics of a
+    resumed run."""
+
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        self.append = append
+        self._connection = None
+
+    def write(self, records: List[Dict[str, Any]]):
+        if self._connection is None:
+            # The connection is created and used on the background thread only
+            self._connection = sqlite3.connect(self.path)
+            if not self.append:
+                self._connection.execute("DROP TABLE IF EXISTS metrics")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metrics (step INTEGER, time REAL, name TEXT, value REAL)"
+            )
+
+        self._connection.executemany(
+            "INSERT INTO metrics VALUES (?, ?, ?, ?)",
+            [
+                (
+                    record["step"],
+                    record["time"],
+                    name,
+                    value if isinstance(value, (int, float)) else None,
+                )
+                for record in records
+                for name, value in record["metrics"].items()
+            ],
+        )
+        self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+
+class WandbWriter(MetricsWriter):
+    """Logs to Weights & Biases. The run is only started on the first write, so that logging in and
+    connecting happen on the background thread as well. Without a key in the config, wandb uses the
+    `WANDB_API_KEY` environment variable or a previous login."""
+
+    def __init__(self, experiment_config: ExperimentConfig):
+        self.experiment_config = experiment_config
+        self._run = None
+
+    def _init_run(self):
+        import wandb
+
+        if self.experiment_config.wandb_key:
+            wandb.login(key=self.experiment_config.wandb_key)
+        self._run = wandb.init(
+            entity=self.experiment_config.wandb_entity,
+            project=self.experiment_config.wandb_project,
+            config=dict(self.experiment_config),
+            name=self.experiment_config.wandb_name,
+        )
+
+    def write(self, records: List[Dict[str, Any]]):
+        if self._run is None:
+            self._init_run()
+
+        for record in records:
+            self._run.log(record["metrics"], step=record["step"])
+
+    def close(self):
+        if self._run is not None:
+            self._run.finish()
+
+
+class MetricsLogger:
+    """Logs metrics to all writers from a background thread.
+
+    `log` only puts the metrics into a bounded queue and returns right away. If the queue is full, e.g.
+    because a backend hangs, the metrics are dropped instead of blocking. A writer that fails is disabled
+    with a warning, the other writers continue.
+
+    Parameters
+    ----------
+    writers : List[MetricsWriter]
+        The backends to write to.
+    max_queue_size : int
+        The maximum number of records waiting to be written.
+    start_step : int
+        The first step, e.g. the step after the last logged one of a resumed run.
+    """
+
+    def __init__(
+        self, writers: List[MetricsWriter], max_queue_size: int = 10_000, start_step: int = 0
+    ):
+        self.writers = writers
+        self._step = start_step
+        self._num_dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            records = [self._queue.get()]
+            # Everything that piled up while writing is written in one batch
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in records
+            records = [record for record in records if record is not None]
+            if records:
+                self._write(records)
+
+            for _ in range(len(records) + stop):
+                self._queue.task_done()
+
+            if stop:
+                # The writers are closed on the thread that opened them
+                self._close_writers()
+                return
+
+    def _write(self, records: List[Dict[str, Any]]):
+        for writer in list(self.writers):
+            try:
+                writer.write(records)
+            except Exception as e:
+                warnings.warn(f"Disabling the {type(writer).__name__} metrics backend after an error: {e!r}")
+                self.writers.remove(writer)
+
+    def _close_writers(self):
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                warnings.warn(f"Closing the {type(writer).__name__} metrics backend failed: {e!r}")
+
+    def log(self, metrics: Dict[str, Any], step: Optional[int] = None):
+        """Queues the metrics for writing. Without a step, the step is incremented with every call."""
+        if step is None:
+            step = self._step
+        self._step = step + 1
+
+        try:
+            self._queue.put_nowait({"step": step, "time": time.time(), "metrics": dict(metrics)})
+        except queue.Full:
+            self._num_dropped += 1
+
+    @property
+    def step(self) -> int:
+        """The step of the next metrics logged without a step."""
+        return self._step
+
+    def flush(self):
+        """Blocks until all queued metrics are written."""
+        self._queue.join()
+
+    def close(self, timeout: float = 60.0):
+        """Writes the remaining metrics and closes all writers. Gives up after `timeout` seconds if a
+        backend hangs."""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+        if self._thread.is_alive():
+            warnings.warn("The metrics could not be written completely before the timeout.")
+
+        if self._num_dropped:
+            warnings.warn(f"{self._num_dropped} metric records were dropped since the queue was full.")
+
+
+def create_metrics_logger(
+    experiment_config: ExperimentConfig,
+    results_save_dir: str,
+    wandb_log: bool = False,
+    start_step: int = 0,
+    append: bool = False,
+) -> MetricsLogger:
+    """Creates the logger with the backends of the metrics config. With `wandb_log`, wandb is added as a
+    backend as well. The local backends overwrite the metrics of an earlier run, unless `append` is set. A
+    resumed run appends to the metrics of the interrupted run and continues at `start_step`."""
+    backends = list(experiment_config.metrics.backends)
+    if wandb_log and MetricsBackend.WANDB not in backends:
+        backends.append(MetricsBackend.WANDB)
+
+    writers = []
+    for backend in backends:
+        if backend == MetricsBackend.JSONL:
+            writers.append(
+                JSONLWriter(os.path.join(results_save_dir, FileNames.METRICS_JSONL), append=append)
+            )
+        elif backend == MetricsBackend.SQLITE:
+            writers.append(
+                SQLiteWriter(os.path.join(results_save_dir, FileNames.METRICS_SQLITE), append=append)
+            )
+        elif backend == MetricsBackend.WANDB:
+            writers.append(WandbWriter(experiment_config))
+
+    return MetricsLogger(
+        writers, max_queue_size=experiment_config.metrics.max_queue_size, start_step=start_step
+    )
+
+
+def sync_to_wandb(experiment_dir: str):
+    """Uploads the JSONL metrics of an experiment to wandb, e.g. after training on a node without network
+    access."""
+    experiment_config = ExperimentConfig(
+        **load_from_json_file(os.path.join(experiment_dir, FileNames.EXPERIMENT_CONFIG))
+    )
+    with open(os.path.join(experiment_dir, FileNames.METRICS_JSONL), "r") as infile:
+        records = []
+        for line in infile:
+            metrics = json.loads(line)
+            records.append({"step": metrics.pop("step"), "time": metrics.pop("time"), "metrics": metrics})
+
+    writer = WandbWriter(experiment_config)
+    writer.write(records)
+    writer.close()
+    print(f"Synced {len(records)} metric records to wandb")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manages the logged metrics of an experiment.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sync_parser = subparsers.add_parser("sync", help="Uploads the JSONL metrics to wandb.")
+    sync_parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json and the metrics.jsonl file.",
+    )
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        sync_to_wandb(args.experiment_directory)
+
+
+if __name__ == "__main__":
+    main()
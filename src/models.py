@@ -1,14 +1,18 @@
 """Contains all the torch model definitions."""
 
-from typing import Tuple
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
 
 import torch.nn as nn
 import torch
-from torch_geometric.nn import GCNConv, SimpleConv, GATConv, LayerNorm
+from torch_geometric.nn import GCNConv, SimpleConv, GATConv
+from torch_geometric.nn import LayerNorm as PyGLayerNorm
+from torch_geometric.typing import OptTensor
+from torch.utils.checkpoint import checkpoint
 import numpy as np
-from sklearn.neighbors import kneighbors_graph
 from torch_geometric.utils import dense_to_sparse, softmax
-from torch_geometric.nn import summary
 
 from src.config import (
     ModelConfig,
@@ -21,18 +25,46 @@ from src.config import (
     ProductGraphConfig,
     ProductGraphType,
 )
-from src.create_graphs import (
-    create_decoding_graph,
-    create_processing_graph,
-    create_encoding_graph,
-)
+from src.profiling import region
+from src.utils import atomic_torch_save, get_mesh_lat_long
 
 
-from src.mesh.create_mesh import (
-    get_hierarchy_of_triangular_meshes_for_sphere,
-)
+# The version of the order in which observation windows are fed to the product graph. It is stored in the
+# state dict of product graph models, version 2 feeds them in time-major order.
+PRODUCT_GRAPH_LAYOUT_VERSION = 2
+
+
+def static_graphs_cache_key(
+    grid_lat: np.ndarray,
+    grid_lon: np.ndarray,
+    graph_config: GraphBuildingConfig,
+    product_graph_config: Optional[ProductGraphConfig],
+    obs_window: int,
+) -> str:
+    """The key of the static graphs in the graph cache. Models with the same key build the same graphs."""
+    graph_properties = {
+        "graph": graph_config.model_dump(mode="json"),
+        "grid_lat": np.asarray(grid_lat, dtype=np.float32).tolist(),
+        "grid_lon": np.asarray(grid_lon, dtype=np.float32).tolist(),
+    }
+    if product_graph_config is not None:
+        graph_properties["product_graph"] = {
+            "num_k": product_graph_config.num_k,
+            "type": product_graph_config.type,
+            "obs_window": obs_window,
+        }
 
-from src.utils import get_mesh_lat_long
+    return hashlib.sha1(
+        json.dumps(graph_properties, sort_keys=True).encode()
+    ).hexdigest()[:16]
+
+
+class LayerNorm(PyGLayerNorm):
+    """The LayerNorm of torch_geometric, which always normalises in float32, also under bfloat16 autocast."""
+
+    def forward(self, x: torch.Tensor, batch: OptTensor = None, batch_size: Optional[int] = None):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super().forward(x.float(), batch, batch_size)
 
 
 class MLP(nn.Module):
@@ -120,6 +152,8 @@ class GraphLayer(nn.Module):
 
         self.layer_type: GraphLayerType = graph_config.layer_type
         self.output_dim = None
+        # The ranges of self.layers whose activations are recomputed in the backward pass
+        self.checkpoint_segments = []
 
         if graph_config.layer_type == GraphLayerType.SimpleConv:
             self.output_dim = input_dim
@@ -192,7 +226,36 @@ class GraphLayer(nn.Module):
                 f"Layer type {graph_config.layer_type} not supported."
             )
 
+        if graph_config.checkpoint_every_n_layers:
+            if graph_config.layer_type not in [GraphLayerType.ConvGCN, GraphLayerType.GATConv]:
+                raise NotImplementedError(
+                    f"Activation checkpointing is not supported for {graph_config.layer_type}."
+                )
+
+            # Every segment starts at a graph convolution and contains its activation function
+            conv_indices = [
+                i for i, layer in enumerate(self.layers) if isinstance(layer, (GCNConv, GATConv))
+            ]
+            starts = conv_indices[:: graph_config.checkpoint_every_n_layers]
+            self.checkpoint_segments = list(zip(starts, starts[1:] + [len(self.layers)]))
+
+    def _forward_segment(self, X: torch.Tensor, edge_index: torch.Tensor, start: int, end: int):
+        for layer in self.layers[start:end]:
+            if isinstance(layer, (GCNConv, GATConv)):
+                X = layer(X, edge_index)
+            else:
+                X = layer(X)
+        return X
+
     def forward(self, X: torch.Tensor, edge_index: torch.Tensor, attention_threshold=0.0, **kwargs):
+        if self.checkpoint_segments and self.training and torch.is_grad_enabled():
+            # Only the inputs of the segments are kept, the rest is recomputed in the backward pass
+            for start, end in self.checkpoint_segments:
+                X = checkpoint(
+                    self._forward_segment, X, edge_index, start, end, use_reentrant=False
+                )
+            return X
+
         if self.layer_type == GraphLayerType.SimpleConv:
             return self.layers(x=X, edge_index=edge_index)
 
@@ -269,6 +332,8 @@ class WeatherPrediction(nn.Module):
         pipeline_config: PipelineConfig,
         data_config: DataConfig,
         device,
+        graph_cache_dir: Optional[str] = None,
+        print_summary: bool = False,
     ):
         super().__init__()
 
@@ -279,55 +344,45 @@ class WeatherPrediction(nn.Module):
         self.use_product_graph = pipeline_config.product_graph is not None
 
         self._init_grid_properties(grid_lat=cordinates[0], grid_lon=cordinates[1])
-        self._init_mesh_properties(graph_config)
         self.using_sparse_gat = pipeline_config.processor.gcn.layer_type == GraphLayerType.SparseGATConv
 
+        static_graphs = self._load_or_create_static_graphs(
+            cordinates=cordinates,
+            graph_config=graph_config,
+            pipeline_config=pipeline_config,
+            graph_cache_dir=graph_cache_dir,
+        )
+
+        self._num_mesh_nodes = static_graphs["num_mesh_nodes"]
         self._total_nodes = self._num_grid_nodes + self._num_mesh_nodes
 
         if self.use_product_graph:
-            self.product_graph = self._create_product_graph(
-                product_graph_config=pipeline_config.product_graph
-            ).to(self.device)
+            self.product_graph = static_graphs["product_graph"].to(self.device)
             self.product_graph_model = Model(
                 model_config=pipeline_config.product_graph.model,
                 input_dim=self.num_features,
             ).to(self.device)
-
-        self.encoding_graph, self.init_grid_features, self.init_mesh_features = (
-            create_encoding_graph(
-                grid_node_lats=self._grid_lat,
-                grid_node_longs=self._grid_lon,
-                mesh_node_lats=self._mesh_nodes_lat,
-                mesh_node_longs=self._mesh_nodes_lon,
-                mesh=self._finest_mesh,
-                graph_building_config=graph_config,
-                num_grid_nodes=self._num_grid_nodes,
+            self.register_buffer(
+                "product_graph_layout_version", torch.tensor(PRODUCT_GRAPH_LAYOUT_VERSION)
             )
-        )
 
-        self.init_grid_features, self.init_mesh_features = self.init_grid_features.to(
-            device
-        ), self.init_mesh_features.to(device)
+        self.encoding_graph = static_graphs["encoding_graph"]
+        self.init_grid_features, self.init_mesh_features = static_graphs[
+            "init_grid_features"
+        ].to(device), static_graphs["init_mesh_features"].to(device)
 
         # The shape of the initial static features that are added to each node
         self._init_feature_size = self.init_grid_features.shape[1]
 
-        self.processing_graph = create_processing_graph(
-            meshes=self._meshes, mesh_levels=graph_config.mesh_levels
-        )
-
-        self.decoding_graph = create_decoding_graph(
-            cordinates=cordinates,
-            mesh=self._finest_mesh,
-            graph_building_config=graph_config,
-            num_grid_nodes=self._num_grid_nodes,
-        )
+        self.processing_graph = static_graphs["processing_graph"]
+        self.decoding_graph = static_graphs["decoding_graph"]
 
         encoder_input_dim = (
             self.num_features + self._init_feature_size
             if self.use_product_graph
             else self.total_feature_size + self._init_feature_size
         )
+        self._encoder_input_dim = encoder_input_dim
         self.encoder = Model(
             model_config=pipeline_config.encoder, input_dim=encoder_input_dim
         ).to(device)
@@ -348,6 +403,30 @@ class WeatherPrediction(nn.Module):
             self.processing_graph.to(device),
         )
 
+        if print_summary:
+            self.print_summary()
+
+    def check_state_dict_layout(self, state_dict: Dict[str, torch.Tensor]):
+        """Raises a ValueError if the state dict of a product graph model was saved before the observation
+        windows were fed to the product graph in time-major order. Such models forecast differently with
+        the current input layout and have to be retrained."""
+        if not self.use_product_graph:
+            return
+
+        version = state_dict.get("product_graph_layout_version")
+        version = 1 if version is None else int(version)
+        if version != PRODUCT_GRAPH_LAYOUT_VERSION:
+            raise ValueError(
+                f"The checkpoint of this product graph model has input layout version {version}, but version "
+                f"{PRODUCT_GRAPH_LAYOUT_VERSION} is expected. Product graph models trained before the "
+                "observation windows were fed in time-major order have to be retrained."
+            )
+
+    def print_summary(self):
+        """Prints a summary of the layers of every stage. Every summary runs a forward pass of its stage on
+        random inputs, which is why it is only done on request."""
+        from torch_geometric.nn import summary
+
         if self.use_product_graph:
             print("Product Graph summary: ")
             print(
@@ -355,7 +434,7 @@ class WeatherPrediction(nn.Module):
                     self.product_graph_model,
                     torch.randn(
                         self._num_grid_nodes * self.obs_window, self.num_features
-                    ).to(device),
+                    ).to(self.device),
                     self.product_graph,
                 )
             )
@@ -366,8 +445,8 @@ class WeatherPrediction(nn.Module):
             summary(
                 self.encoder,
                 torch.randn(
-                    self._num_grid_nodes + self._num_mesh_nodes, encoder_input_dim
-                ).to(device),
+                    self._num_grid_nodes + self._num_mesh_nodes, self._encoder_input_dim
+                ).to(self.device),
                 self.encoding_graph,
             )
         )
@@ -377,7 +456,7 @@ class WeatherPrediction(nn.Module):
         print(
             summary(
                 self.processor,
-                torch.randn(self._num_mesh_nodes, self.encoder.output_dim).to(device),
+                torch.randn(self._num_mesh_nodes, self.encoder.output_dim).to(self.device),
                 self.processing_graph,
             )
         )
@@ -390,18 +469,126 @@ class WeatherPrediction(nn.Module):
                 torch.randn(
                     self._num_grid_nodes + self._num_mesh_nodes,
                     self.processor.output_dim,
-                ).to(device),
+                ).to(self.device),
                 self.decoding_graph,
             )
         )
         print()
 
+    def _create_static_graphs(
+        self,
+        cordinates: Tuple[np.array, np.array],
+        graph_config: GraphBuildingConfig,
+        pipeline_config: PipelineConfig,
+    ) -> Dict[str, Any]:
+        """Builds the meshes and all the graphs that stay fixed during training."""
+        # Building the graphs needs scipy and trimesh, which are not imported when the graphs are cached
+        from src.create_graphs import (
+            create_decoding_graph,
+            create_encoding_graph,
+            create_processing_graph,
+        )
+
+        self._init_mesh_properties(graph_config)
+
+        encoding_graph, init_grid_features, init_mesh_features = create_encoding_graph(
+            grid_node_lats=self._grid_lat,
+            grid_node_longs=self._grid_lon,
+            mesh_node_lats=self._mesh_nodes_lat,
+            mesh_node_longs=self._mesh_nodes_lon,
+            mesh=self._finest_mesh,
+            graph_building_config=graph_config,
+            num_grid_nodes=self._num_grid_nodes,
+        )
+
+        static_graphs = {
+            "num_mesh_nodes": len(self._finest_mesh.vertices),
+            "encoding_graph": encoding_graph,
+            "init_grid_features": init_grid_features,
+            "init_mesh_features": init_mesh_features,
+            "processing_graph": create_processing_graph(
+                meshes=self._meshes, mesh_levels=graph_config.mesh_levels
+            ),
+            "decoding_graph": create_decoding_graph(
+                cordinates=cordinates,
+                mesh=self._finest_mesh,
+                graph_building_config=graph_config,
+                num_grid_nodes=self._num_grid_nodes,
+            ),
+        }
+
+        if self.use_product_graph:
+            static_graphs["product_graph"] = self._create_product_graph(
+                product_graph_config=pipeline_config.product_graph
+            )
+
+        return static_graphs
+
+    def _load_or_create_static_graphs(
+        self,
+        cordinates: Tuple[np.array, np.array],
+        graph_config: GraphBuildingConfig,
+        pipeline_config: PipelineConfig,
+        graph_cache_dir: Optional[str],
+    ) -> Dict[str, Any]:
+        """Loads the static graphs from the cache directory if they were built for the same graph config and grid
+        before, otherwise builds them and stores them in the cache. Without a cache directory they are always built.
+        """
+        if graph_cache_dir is None:
+            return self._create_static_graphs(
+                cordinates=cordinates,
+                graph_config=graph_config,
+                pipeline_config=pipeline_config,
+            )
+
+        cache_path = os.path.join(
+            graph_cache_dir,
+            "graphs_{}.pt".format(
+                static_graphs_cache_key(
+                    grid_lat=self._grid_lat,
+                    grid_lon=self._grid_lon,
+                    graph_config=graph_config,
+                    product_graph_config=pipeline_config.product_graph,
+                    obs_window=self.obs_window,
+                )
+            ),
+        )
+        if os.path.exists(cache_path):
+            print(f"Loading static graphs from {cache_path}")
+            return torch.load(cache_path, weights_only=True)
+
+        static_graphs = self._create_static_graphs(
+            cordinates=cordinates,
+            graph_config=graph_config,
+            pipeline_config=pipeline_config,
+        )
+        os.makedirs(graph_cache_dir, exist_ok=True)
+        atomic_torch_save(static_graphs, cache_path)
+        print(f"Static graphs saved to {cache_path}")
+
+        return static_graphs
+
+    def num_edges_per_graph(self) -> Dict[str, int]:
+        """Returns the number of edges of every graph a forward pass runs message passing on. The count of
+        the processing graph shrinks while SparseGAT prunes it."""
+        num_edges = {
+            "encoding": self.encoding_graph.shape[1],
+            "processing": self.processing_graph.shape[1],
+            "decoding": self.decoding_graph.shape[1],
+        }
+        if self.use_product_graph:
+            num_edges["product"] = self.product_graph.shape[1]
+
+        return num_edges
+
     def _init_grid_properties(self, grid_lat: np.ndarray, grid_lon: np.ndarray):
         self._grid_lat = grid_lat.astype(np.float32)
         self._grid_lon = grid_lon.astype(np.float32)
         self._num_grid_nodes = grid_lat.shape[0] * grid_lon.shape[0]
 
     def _init_mesh_properties(self, graph_config: GraphBuildingConfig):
+        from src.mesh.create_mesh import get_hierarchy_of_triangular_meshes_for_sphere
+
         self._meshes = get_hierarchy_of_triangular_meshes_for_sphere(
             splits=max(graph_config.mesh_levels)
         )
@@ -428,6 +615,8 @@ class WeatherPrediction(nn.Module):
             return temporal_graph
 
         def _construct_adjacency_matrix(grid_lat, grid_lon, k):
+            from sklearn.neighbors import kneighbors_graph
+
             lat_lon_grid = np.array(
                 [[lat, lon] for lat in grid_lat for lon in grid_lon]
             )
@@ -510,40 +699,191 @@ class WeatherPrediction(nn.Module):
 
         X = X.squeeze()
         if self.use_product_graph:
-            X = X.view(self._num_grid_nodes * self.obs_window, self.num_features)
-            X = self.product_graph_model(X=X, edge_index=self.product_graph)
-            X = X[-self._num_grid_nodes :, :]
+            with region("product_graph"):
+                X = self._to_product_graph_nodes(X)
+                X = self.product_graph_model(X=X, edge_index=self.product_graph)
+                X = X[-self._num_grid_nodes :, :]
+
+        return self._encode_process_decode(X, attention_threshold=attention_threshold, **kwargs)
+
+    def _to_product_graph_nodes(self, X: torch.Tensor) -> torch.Tensor:
+        """Reorders observation windows of the shape [..., num_grid_nodes, obs_window * num_features] into the
+        nodes of the product graph, which are ordered by timestep and then by grid node."""
+        X = X.reshape(-1, self._num_grid_nodes, self.obs_window, self.num_features)
+        return X.transpose(1, 2).reshape(-1, self.num_features)
 
-        X = self._preprocess_input(grid_node_features=X)
+    def _encode_process_decode(self, X: torch.Tensor, attention_threshold, **kwargs) -> torch.Tensor:
+        """Runs the encoder, the processor and the decoder on the features of the grid nodes of one sample."""
+        with region("preprocess_input"):
+            X = self._preprocess_input(grid_node_features=X)
 
-        encoded_features = self.encoder.forward(X=X, edge_index=self.encoding_graph)
+        with region("encoder"):
+            encoded_features = self.encoder.forward(X=X, edge_index=self.encoding_graph)
 
         grid_node_features = encoded_features[: self._num_grid_nodes, :]
         mesh_node_features = encoded_features[self._num_grid_nodes :, :]
 
         # Processing the mesh node features
-        if self.using_sparse_gat:
-            processed_mesh_node_features, new_processor_edge_index = self.processor.forward(
-                X=mesh_node_features, edge_index=self.processing_graph, attention_threshold=attention_threshold, **kwargs
-            )
-            self.processing_graph = new_processor_edge_index
-        else:
-            processed_mesh_node_features = self.processor.forward(
-                X=mesh_node_features, edge_index=self.processing_graph, attention_threshold=attention_threshold
-            )
+        with region("processor"):
+            if self.using_sparse_gat:
+                processed_mesh_node_features, new_processor_edge_index = self.processor.forward(
+                    X=mesh_node_features, edge_index=self.processing_graph, attention_threshold=attention_threshold, **kwargs
+                )
+                self.processing_graph = new_processor_edge_index
+            else:
+                processed_mesh_node_features = self.processor.forward(
+                    X=mesh_node_features, edge_index=self.processing_graph, attention_threshold=attention_threshold
+                )
 
         # Concatenating the grid feature again with the processed mesh features
         processed_features = torch.cat(
             (grid_node_features, processed_mesh_node_features), dim=0
         )
 
-        decoded_grid_node_features = self.decoder.forward(
-            X=processed_features,
-            edge_index=self.decoding_graph,
-        )
+        with region("decoder"):
+            decoded_grid_node_features = self.decoder.forward(
+                X=processed_features,
+                edge_index=self.decoding_graph,
+            )
 
         decoded_grid_node_features = decoded_grid_node_features[
             : self._num_grid_nodes, :
         ]
 
-        return decoded_grid_node_features
+        # Under bfloat16 autocast the forecasts are still returned in float32, e.g. for the loss
+        return decoded_grid_node_features.float()
+
+    def _batched_edge_index(self, edge_index: torch.Tensor, num_nodes: int, batch_size: int) -> torch.Tensor:
+        """The edges of `batch_size` disjoint copies of a graph with `num_nodes` nodes."""
+        offsets = torch.arange(batch_size, device=edge_index.device).view(-1, 1, 1) * num_nodes
+        return (edge_index.unsqueeze(0) + offsets).permute(1, 0, 2).reshape(2, -1)
+
+    def _supports_disjoint_batching(self) -> bool:
+        # A graph-wise layer norm would normalise over all samples of the batch together
+        return not any(
+            isinstance(module, LayerNorm) and module.mode == "graph" for module in self.modules()
+        )
+
+    def forward_batch(self, X: torch.Tensor, attention_threshold=0.0) -> torch.Tensor:
+        """Runs the model on a batch of samples at once. The graphs of all samples are combined into one
+        graph with disjoint copies of every graph, so that every stage is a single pass over the batch.
+        Unlike `forward`, this never prunes the processing graph of SparseGAT.
+
+        Parameters
+        ----------
+        X : torch.Tensor
+          The input data of the shape [batch, num_grid_nodes, obs_window * num_features] or
+          [batch, num_grid_nodes, obs_window, num_features].
+
+        Returns
+        -------
+        torch.Tensor
+          The predictions of the shape [batch, num_grid_nodes, num_features].
+        """
+        batch_size = X.shape[0]
+        if not self._supports_disjoint_batching():
+            return torch.stack(
+                [
+                    self.forward(X=X[i : i + 1], attention_threshold=attention_threshold)
+                    for i in range(batch_size)
+                ]
+            )
+
+        num_nodes = self._num_grid_nodes + self._num_mesh_nodes
+
+        if self.use_product_graph:
+            with region("product_graph"):
+                num_product_nodes = self._num_grid_nodes * self.obs_window
+                X = self.product_graph_model(
+                    X=self._to_product_graph_nodes(X),
+                    edge_index=self._batched_edge_index(
+                        self.product_graph, num_product_nodes, batch_size
+                    ),
+                )
+                X = X.view(batch_size, num_product_nodes, -1)[:, -self._num_grid_nodes :]
+        else:
+            X = X.reshape(batch_size, self._num_grid_nodes, -1)
+
+        with region("preprocess_input"):
+            grid_node_features = torch.cat(
+                (X, self.init_grid_features.expand(batch_size, -1, -1)), dim=-1
+            )
+            mesh_node_features = torch.cat(
+                (
+                    torch.zeros(
+                        (batch_size, self._num_mesh_nodes, X.shape[-1]), device=X.device
+                    ),
+                    self.init_mesh_features.expand(batch_size, -1, -1),
+                ),
+                dim=-1,
+            )
+            X = torch.cat((grid_node_features, mesh_node_features), dim=1)
+
+        with region("encoder"):
+            encoded_features = self.encoder.forward(
+                X=X.view(batch_size * num_nodes, -1),
+                edge_index=self._batched_edge_index(self.encoding_graph, num_nodes, batch_size),
+            ).view(batch_size, num_nodes, -1)
+
+        with region("processor"):
+            processed_mesh_node_features = self.processor.forward(
+                X=encoded_features[:, self._num_grid_nodes :].reshape(
+                    batch_size * self._num_mesh_nodes, -1
+                ),
+                edge_index=self._batched_edge_index(
+                    self.processing_graph, self._num_mesh_nodes, batch_size
+                ),
+                attention_threshold=attention_threshold,
+            )
+            if self.using_sparse_gat:
+                processed_mesh_node_features, _ = processed_mesh_node_features
+
+        processed_features = torch.cat(
+            (
+                encoded_features[:, : self._num_grid_nodes],
+                processed_mesh_node_features.view(batch_size, self._num_mesh_nodes, -1),
+            ),
+            dim=1,
+        )
+
+        with region("decoder"):
+            decoded_features = self.decoder.forward(
+                X=processed_features.view(batch_size * num_nodes, -1),
+                edge_index=self._batched_edge_index(self.decoding_graph, num_nodes, batch_size),
+            ).view(batch_size, num_nodes, -1)
+
+        return decoded_features[:, : self._num_grid_nodes].float()
+
+    def rollout(self, X: torch.Tensor, num_steps: int) -> torch.Tensor:
+        """Forecasts `num_steps` timesteps autoregressively for a batch of samples. After every step the
+        oldest timestep of the observation window is dropped and the prediction is appended as the newest one.
+
+        Parameters
+        ----------
+        X : torch.Tensor
+          The observation windows of the shape [batch, num_grid_nodes, obs_window * num_features] or
+          [batch, num_grid_nodes, obs_window, num_features].
+        num_steps : int
+          The number of timesteps to forecast.
+
+        Returns
+        -------
+        torch.Tensor
+          The predictions of the shape [batch, num_steps, num_grid_nodes, num_features].
+        """
+        predictions = []
+        for _ in range(num_steps):
+            prediction = self.forward_batch(X=X, attention_threshold=0.0)
+            if prediction.shape[-1] != self.num_features:
+                raise ValueError(
+                    f"The model predicts {prediction.shape[-1]} features but gets {self.num_features} features "
+                    "as input, so its predictions can not be fed back."
+                )
+            predictions.append(prediction)
+
+            if X.dim() == 4:
+                X = torch.cat((X[:, :, 1:], prediction[:, :, None]), dim=2)
+            else:
+                X = torch.cat((X[..., self.num_features :], prediction), dim=-1)
+
+        return torch.stack(predictions, dim=1)
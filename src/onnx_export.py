@@ -0,0 +1,206 @@
+"""Exports a trained model as a single ONNX graph for ONNX Runtime.
+
+The export traces the frozen inference module of `src.freeze`, so the encoding, processing, decoding and
+product graphs, the GCN edge weights and the static node features end up as initializers of the ONNX
+graph. The only input is the grid state of one sample and the only output the next grid state. The model
+is exported in evaluation mode, where SparseGAT does not prune its graph.
+
+Example
+-------
+python -m src.onnx_export "<path-to-experinment-directory>" --output weather_prediction.onnx --repeats 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict
+
+import numpy as np
+import torch
+
+from src.freeze import FrozenWeatherPrediction
+from src.models import WeatherPrediction
+
+
+ONNX_MODEL_FILE = "weather_prediction.onnx"
+
+INPUT_NAME = "grid_state"
+OUTPUT_NAME = "next_grid_state"
+
+# Scatter with a max reduction, used by the attention softmax, needs opset 18
+DEFAULT_OPSET_VERSION = 18
+
+
+def _example_input(model: WeatherPrediction) -> torch.Tensor:
+    return torch.randn(
+        1, model._num_grid_nodes, model.obs_window * model.num_features, device=model.init_grid_features.device
+    )
+
+
+def export_onnx(
+    model: WeatherPrediction, output_path: str, opset_version: int = DEFAULT_OPSET_VERSION
+) -> str:
+    """Exports the model as one ONNX graph with the static graphs as initializers.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model.
+    output_path : str
+        Where to save the ONNX model.
+    opset_version : int
+        The ONNX opset to export to.
+
+    Returns
+    -------
+    str
+        The path of the saved model.
+    """
+    import onnx
+
+    frozen = FrozenWeatherPrediction(model).eval()
+
+    with torch.no_grad():
+        torch.onnx.export(
+            frozen,
+            (_example_input(model),),
+            output_path,
+            input_names=[INPUT_NAME],
+            output_names=[OUTPUT_NAME],
+            opset_version=opset_version,
+            external_data=False,
+        )
+
+    onnx.checker.check_model(output_path)
+    return output_path
+
+
+def create_session(onnx_path: str, num_threads: int = None):
+    """Creates an ONNX Runtime session on CPU with all graph optimisations enabled."""
+    import onnxruntime
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        session_options.intra_op_num_threads = num_threads
+
+    return onnxruntime.InferenceSession(
+        onnx_path, sess_options=session_options, providers=["CPUExecutionProvider"]
+    )
+
+
+def check_parity(
+    model: WeatherPrediction, session, num_samples: int = 3, atol: float = 1e-4
+) -> Dict[str, Any]:
+    """Compares the forecasts of ONNX Runtime with the ones of the PyTorch model on random inputs.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The maximum absolute and relative difference over all samples and whether the absolute difference is
+        within `atol`.
+    """
+    max_abs_difference, max_rel_difference = 0.0, 0.0
+    for _ in range(num_samples):
+        X = _example_input(model)
+        with torch.no_grad():
+            expected = model(X=X, attention_threshold=0.0).cpu().numpy()
+        actual = session.run([OUTPUT_NAME], {INPUT_NAME: X.cpu().numpy()})[0]
+
+        difference = np.abs(actual - expected)
+        max_abs_difference = max(max_abs_difference, float(difference.max()))
+        max_rel_difference = max(
+            max_rel_difference, float((difference / np.maximum(np.abs(expected), 1e-6)).max())
+        )
+
+    return {
+        "max_abs_difference": max_abs_difference,
+        "max_rel_difference": max_rel_difference,
+        "within_tolerance": max_abs_difference <= atol,
+    }
+
+
+def benchmark_session(session, X: np.ndarray, repeats: int = 50, warmup: int = 5) -> Dict[str, float]:
+    """Times `repeats` forecasts of ONNX Runtime on the same input. Returns the mean, the median, the p90
+    and the minimum latency in seconds."""
+    for _ in range(warmup):
+        session.run([OUTPUT_NAME], {INPUT_NAME: X})
+
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        session.run([OUTPUT_NAME], {INPUT_NAME: X})
+        durations.append(time.perf_counter() - start)
+
+    return {
+        "mean": statistics.mean(durations),
+        "median": statistics.median(durations),
+        "p90": float(np.percentile(durations, 90)),
+        "min": min(durations),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exports a trained model to ONNX, checks its parity and benchmarks ONNX Runtime."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help=f"Where to save the ONNX model, defaults to {ONNX_MODEL_FILE} in the experiment directory.",
+    )
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument("--opset-version", type=int, default=DEFAULT_OPSET_VERSION)
+    parser.add_argument("--atol", type=float, default=1e-4, help="The tolerance of the parity check.")
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    from src.predict import load_trained_model
+
+    model, _, _ = load_trained_model(
+        args.experiment_directory, device=torch.device("cpu"), checkpoint_path=args.checkpoint
+    )
+
+    output_path = args.output or os.path.join(args.experiment_directory, ONNX_MODEL_FILE)
+    export_onnx(model, output_path, opset_version=args.opset_version)
+    print(f"ONNX model saved to {output_path} ({os.path.getsize(output_path) / 2**20:.1f} MB)")
+
+    session = create_session(output_path, num_threads=args.num_threads)
+    parity = check_parity(model, session, atol=args.atol)
+    print(
+        f"Parity with PyTorch: max abs difference {parity['max_abs_difference']:.2e}, "
+        f"max rel difference {parity['max_rel_difference']:.2e}"
+    )
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    X = _example_input(model)
+    latency = benchmark_session(session, X.numpy(), repeats=args.repeats)
+
+    with torch.no_grad():
+        torch_durations = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            model(X=X, attention_threshold=0.0)
+            torch_durations.append(time.perf_counter() - start)
+
+    print(
+        f"ONNX Runtime latency: median {latency['median'] * 1000:.2f} ms, p90 {latency['p90'] * 1000:.2f} ms, "
+        f"min {latency['min'] * 1000:.2f} ms"
+    )
+    print(f"PyTorch eager latency: median {statistics.median(torch_durations) * 1000:.2f} ms")
+
+    if not parity["within_tolerance"]:
+        print(f"The ONNX model differs from PyTorch by more than {args.atol}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
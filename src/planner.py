@@ -0,0 +1,493 @@
+"""Estimates the size and the cost of an experiment from its config, without building any graph or tensor.
+
+The node and edge counts of every graph follow from the icosahedral mesh refinement, a uniform density
+estimate of the radius query and the construction of the product graph. From them, the parameters, the
+FLOPs of a forward and backward pass and the activation memory of every stage are counted layer by layer.
+All numbers are estimates for a single sample, which is what one forward pass of the model processes.
+
+Example
+-------
+python -m src.planner "<path-to-experinment-directory>"
+"""
+
+import argparse
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from src.config import (
+    ExperimentConfig,
+    GraphBlock,
+    GraphLayerType,
+    Grid2MeshEdgeCreation,
+    MLPBlock,
+    Mesh2GridEdgeCreation,
+    ModelConfig,
+    ProductGraphType,
+)
+from src.constants import FileNames
+from src.data.data_configs import DatasetMetadata, get_dataset_metadata
+from src.utils import load_from_json_file
+
+
+BYTES_PER_FLOAT = 4
+BYTES_PER_INDEX = 8
+
+# Unit positions, the latitude and the cos and sin of the longitude, see `get_bipartite_graph_spatial_features`
+NUM_STATIC_NODE_FEATURES = 6
+
+# The longest edge of the refined icosahedron for every level, times 2**level. It converges for finer levels.
+_SCALED_MAX_MESH_EDGE_LENGTHS = [1.0515, 1.2361, 1.2997, 1.3172, 1.3217, 1.3228, 1.3231]
+
+# FLOPs per element of the elementwise layers
+_PRELU_FLOPS = 2
+_LAYER_NORM_FLOPS = 8
+# FLOPs per edge and head of the attention coefficients: adding both sides, leaky ReLU and the softmax
+_ATTENTION_FLOPS = 7
+
+
+def num_mesh_nodes(level: int) -> int:
+    """The number of vertices of the icosahedron refined `level` times."""
+    return 10 * 4**level + 2
+
+
+def num_mesh_faces(level: int) -> int:
+    return 20 * 4**level
+
+
+def num_mesh_edges(level: int) -> int:
+    """The number of undirected edges of the icosahedron refined `level` times."""
+    return 30 * 4**level
+
+
+def max_mesh_edge_length(level: int) -> float:
+    """The length of the longest edge of the mesh of the given level on the unit sphere."""
+    scaled_length = _SCALED_MAX_MESH_EDGE_LENGTHS[
+        min(level, len(_SCALED_MAX_MESH_EDGE_LENGTHS) - 1)
+    ]
+    return scaled_length / 2**level
+
+
+def estimate_graph_sizes(
+    experiment_config: ExperimentConfig, dataset_metadata: DatasetMetadata
+) -> Dict[str, Dict[str, int]]:
+    """Estimates the number of nodes and edges of every graph of the model.
+
+    The processing graph and the decoding graph are exact. The mesh levels of the multi-mesh have disjoint
+    edges, which are stored in both directions, and every grid node is connected to the 3 corners of the
+    mesh triangle that contains it. For the encoding graph, every grid node is connected to the mesh nodes
+    within the radius r. A spherical cap with the chord length r covers r**2 / 4 of the unit sphere, so with
+    approximately uniformly distributed mesh nodes every grid node gets num_mesh_nodes * r**2 / 4 edges.
+
+    Parameters
+    ----------
+    experiment_config : ExperimentConfig
+        The config of the experiment.
+    dataset_metadata : DatasetMetadata
+        The metadata of the dataset, which defines the grid.
+
+    Returns
+    -------
+    Dict[str, Dict[str, int]]
+        The number of nodes and edges of the encoding, processing, decoding and, if used, product graph.
+    """
+    graph_config = experiment_config.graph
+    num_grid_nodes = dataset_metadata.num_latitudes * dataset_metadata.num_longitudes
+    finest_level = max(graph_config.mesh_levels)
+    mesh_nodes = num_mesh_nodes(finest_level)
+
+    if graph_config.grid2mesh_edge_creation == Grid2MeshEdgeCreation.RADIUS:
+        radius = max_mesh_edge_length(finest_level) * graph_config.grid2mesh_radius_query
+        encoding_edges = round(num_grid_nodes * mesh_nodes * min(radius**2 / 4, 1.0))
+    else:
+        raise NotImplementedError(
+            f"There is no estimate for {graph_config.grid2mesh_edge_creation} Grid2Mesh edges."
+        )
+
+    if graph_config.mesh2grid_edge_creation == Mesh2GridEdgeCreation.CONTAINED:
+        decoding_edges = 3 * num_grid_nodes
+    else:
+        raise NotImplementedError(
+            f"There is no estimate for {graph_config.mesh2grid_edge_creation} Mesh2Grid edges."
+        )
+
+    graphs = {
+        "encoding": {"num_nodes": num_grid_nodes + mesh_nodes, "num_edges": encoding_edges},
+        "processing": {
+            "num_nodes": mesh_nodes,
+            "num_edges": 2 * sum(num_mesh_edges(level) for level in set(graph_config.mesh_levels)),
+        },
+        "decoding": {"num_nodes": num_grid_nodes + mesh_nodes, "num_edges": decoding_edges},
+    }
+
+    product_graph = experiment_config.pipeline.product_graph
+    if product_graph is not None:
+        T = experiment_config.data.obs_window_used
+        # The spatial graph has num_k neighbours per node, the temporal graph is a chain with T - 1 edges
+        spatial_edges = num_grid_nodes * product_graph.num_k
+        if product_graph.type == ProductGraphType.KRONECKER:
+            product_edges = (T - 1) * spatial_edges
+        elif product_graph.type == ProductGraphType.CARTESIAN:
+            product_edges = T * spatial_edges + (T - 1) * num_grid_nodes
+        else:
+            product_edges = T * spatial_edges + (T - 1) * num_grid_nodes + (T - 1) * spatial_edges
+
+        graphs["product"] = {"num_nodes": num_grid_nodes * T, "num_edges": product_edges}
+
+    return graphs
+
+
+class _StageCost:
+    """Adds up the cost of the layers of one stage."""
+
+    def __init__(self):
+        self.num_parameters = 0
+        self.forward_flops = 0
+        # The elements of the tensors that are kept for the backward pass
+        self.activation_elements = 0
+        # The forward FLOPs that activation checkpointing repeats in the backward pass
+        self.recompute_flops = 0
+
+    def add(
+        self,
+        num_parameters: int = 0,
+        flops: int = 0,
+        activation_elements: int = 0,
+        recompute_flops: int = 0,
+    ):
+        self.num_parameters += num_parameters
+        self.forward_flops += flops
+        self.activation_elements += activation_elements
+        self.recompute_flops += recompute_flops
+
+    def linear(self, num_rows: int, in_dim: int, out_dim: int, bias: bool = True):
+        self.add(
+            num_parameters=in_dim * out_dim + (out_dim if bias else 0),
+            flops=2 * num_rows * in_dim * out_dim,
+            activation_elements=num_rows * out_dim,
+        )
+
+    def elementwise(self, num_elements: int, flops_per_element: int, num_parameters: int = 0):
+        self.add(
+            num_parameters=num_parameters,
+            flops=num_elements * flops_per_element,
+            activation_elements=num_elements,
+        )
+
+
+def _mlp_cost(cost: _StageCost, mlp_config: MLPBlock, input_dim: int, num_nodes: int) -> int:
+    dims = [input_dim] + list(mlp_config.mlp_hidden_dims or [])
+    for in_dim, out_dim in zip(dims[:-1], dims[1:]):
+        cost.linear(num_nodes, in_dim, out_dim)
+        cost.elementwise(num_nodes * out_dim, _PRELU_FLOPS, num_parameters=1)
+
+    cost.linear(num_nodes, dims[-1], mlp_config.output_dim)
+    if mlp_config.use_layer_norm:
+        cost.elementwise(
+            num_nodes * mlp_config.output_dim,
+            _LAYER_NORM_FLOPS,
+            num_parameters=2 * mlp_config.output_dim,
+        )
+
+    return mlp_config.output_dim
+
+
+def _gcn_conv_cost(cost: _StageCost, in_dim: int, out_dim: int, num_nodes: int, num_edges: int):
+    # The features are transformed first and then aggregated over the edges and the added self loops
+    num_messages = num_edges + num_nodes
+    cost.linear(num_nodes, in_dim, out_dim, bias=False)
+    cost.add(
+        num_parameters=out_dim,
+        flops=2 * num_messages * out_dim + num_nodes * out_dim,
+        activation_elements=num_messages * (out_dim + 1) + num_nodes * out_dim,
+    )
+
+
+def _gat_conv_cost(
+    cost: _StageCost, in_dim: int, out_dim: int, num_heads: int, num_nodes: int, num_edges: int
+):
+    num_messages = num_edges + num_nodes
+    cost.linear(num_nodes, in_dim, num_heads * out_dim, bias=False)
+    cost.add(
+        # The attention vectors of the source and the target nodes and the bias
+        num_parameters=2 * num_heads * out_dim + out_dim,
+        flops=4 * num_nodes * num_heads * out_dim
+        + num_messages * num_heads * (_ATTENTION_FLOPS + 3 * out_dim)
+        + num_nodes * num_heads * out_dim,
+        activation_elements=num_messages * num_heads * (out_dim + 4) + num_nodes * out_dim,
+    )
+
+
+def _graph_layer_cost(
+    cost: _StageCost, graph_config: GraphBlock, input_dim: int, num_nodes: int, num_edges: int
+) -> int:
+    if graph_config.layer_type == GraphLayerType.SimpleConv:
+        # Mean aggregation without parameters, the messages are only gathered
+        cost.add(flops=num_edges * input_dim + num_nodes * input_dim, activation_elements=num_nodes * input_dim)
+        return input_dim
+
+    if graph_config.layer_type == GraphLayerType.SparseGATConv:
+        dims = [input_dim, graph_config.output_dim]
+    else:
+        dims = [input_dim] + list(graph_config.hidden_dims) + [graph_config.output_dim]
+
+    # A single PReLU is shared between all layers
+    cost.add(num_parameters=1)
+    # The cost of every GNN layer with its activation function, the layer norm belongs to the last one
+    layer_costs = []
+    for i, (in_dim, out_dim) in enumerate(zip(dims[:-1], dims[1:])):
+        layer_cost = _StageCost()
+        if graph_config.layer_type == GraphLayerType.ConvGCN:
+            _gcn_conv_cost(layer_cost, in_dim, out_dim, num_nodes=num_nodes, num_edges=num_edges)
+        else:
+            _gat_conv_cost(
+                layer_cost,
+                in_dim,
+                out_dim,
+                num_heads=graph_config.gat_props.num_heads,
+                num_nodes=num_nodes,
+                num_edges=num_edges,
+            )
+
+        if i < len(dims) - 2:
+            layer_cost.elementwise(num_nodes * out_dim, _PRELU_FLOPS)
+        layer_costs.append(layer_cost)
+
+    if graph_config.use_layer_norm:
+        layer_costs[-1].elementwise(
+            num_nodes * graph_config.output_dim,
+            _LAYER_NORM_FLOPS,
+            num_parameters=2 * graph_config.output_dim,
+        )
+
+    for layer_cost in layer_costs:
+        cost.add(num_parameters=layer_cost.num_parameters, flops=layer_cost.forward_flops)
+
+    every_n_layers = graph_config.checkpoint_every_n_layers
+    if not every_n_layers:
+        cost.add(activation_elements=sum(layer_cost.activation_elements for layer_cost in layer_costs))
+        return graph_config.output_dim
+
+    # Only the inputs of the segments are kept. In the backward pass, the segments are recomputed one at a
+    # time, so the activations of the largest one exist on top of them.
+    starts = list(range(0, len(layer_costs), every_n_layers))
+    segment_activations = [
+        sum(layer_cost.activation_elements for layer_cost in layer_costs[start : start + every_n_layers])
+        for start in starts
+    ]
+    cost.add(
+        activation_elements=sum(num_nodes * dims[start] for start in starts) + max(segment_activations),
+        recompute_flops=sum(layer_cost.forward_flops for layer_cost in layer_costs),
+    )
+
+    return graph_config.output_dim
+
+
+def _model_cost(
+    model_config: ModelConfig, input_dim: int, num_nodes: int, num_edges: int
+) -> Tuple[Dict[str, Any], int]:
+    cost = _StageCost()
+    graph_input_dim = input_dim
+    if model_config.mlp:
+        graph_input_dim = _mlp_cost(cost, model_config.mlp, input_dim=input_dim, num_nodes=num_nodes)
+
+    output_dim = _graph_layer_cost(
+        cost,
+        model_config.gcn,
+        input_dim=graph_input_dim,
+        num_nodes=num_nodes,
+        num_edges=num_edges,
+    )
+
+    stage = {
+        "input_dim": input_dim,
+        "output_dim": output_dim,
+        "num_parameters": cost.num_parameters,
+        "forward_flops": cost.forward_flops,
+        # The backward pass computes the gradients of the inputs and of the weights
+        "backward_flops": 2 * cost.forward_flops + cost.recompute_flops,
+        "activation_bytes": (cost.activation_elements + num_nodes * input_dim) * BYTES_PER_FLOAT,
+    }
+    return stage, output_dim
+
+
+def plan_experiment(
+    experiment_config: ExperimentConfig, dataset_metadata: DatasetMetadata
+) -> Dict[str, Any]:
+    """Estimates the graph sizes, the parameters, the FLOPs and the memory of an experiment.
+
+    Parameters
+    ----------
+    experiment_config : ExperimentConfig
+        The config of the experiment.
+    dataset_metadata : DatasetMetadata
+        The metadata of the dataset, which defines the grid.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The graph sizes, the cost of every stage and the totals. The peak training memory is the sum of
+        the static graphs, the parameters with their gradients and the Adam state, and the activations of
+        all stages, which are kept until the backward pass.
+    """
+    data_config = experiment_config.data
+    pipeline_config = experiment_config.pipeline
+    graphs = estimate_graph_sizes(experiment_config, dataset_metadata)
+    num_grid_nodes = dataset_metadata.num_latitudes * dataset_metadata.num_longitudes
+
+    stages = {}
+    if pipeline_config.product_graph is not None:
+        stages["product_graph"], _ = _model_cost(
+            pipeline_config.product_graph.model,
+            input_dim=data_config.num_features_used,
+            num_nodes=graphs["product"]["num_nodes"],
+            num_edges=graphs["product"]["num_edges"],
+        )
+        encoder_input_dim = data_config.num_features_used + NUM_STATIC_NODE_FEATURES
+    else:
+        encoder_input_dim = (
+            data_config.num_features_used * data_config.obs_window_used + NUM_STATIC_NODE_FEATURES
+        )
+
+    stages["encoder"], encoder_output_dim = _model_cost(
+        pipeline_config.encoder,
+        input_dim=encoder_input_dim,
+        num_nodes=graphs["encoding"]["num_nodes"],
+        num_edges=graphs["encoding"]["num_edges"],
+    )
+    stages["processor"], processor_output_dim = _model_cost(
+        pipeline_config.processor,
+        input_dim=encoder_output_dim,
+        num_nodes=graphs["processing"]["num_nodes"],
+        num_edges=graphs["processing"]["num_edges"],
+    )
+    stages["decoder"], _ = _model_cost(
+        pipeline_config.decoder,
+        input_dim=processor_output_dim,
+        num_nodes=graphs["decoding"]["num_nodes"],
+        num_edges=graphs["decoding"]["num_edges"],
+    )
+
+    num_parameters = sum(stage["num_parameters"] for stage in stages.values())
+    activation_bytes = sum(stage["activation_bytes"] for stage in stages.values())
+    graph_bytes = sum(
+        2 * graph["num_edges"] * BYTES_PER_INDEX for graph in graphs.values()
+    ) + (num_grid_nodes + graphs["processing"]["num_nodes"]) * NUM_STATIC_NODE_FEATURES * BYTES_PER_FLOAT
+    # The weights, their gradients and the two moments of Adam
+    parameter_bytes = 4 * num_parameters * BYTES_PER_FLOAT
+
+    plan = {
+        "num_grid_nodes": num_grid_nodes,
+        "num_mesh_nodes": graphs["processing"]["num_nodes"],
+        "graphs": graphs,
+        "stages": stages,
+        "num_parameters": num_parameters,
+        "forward_flops": sum(stage["forward_flops"] for stage in stages.values()),
+        "backward_flops": sum(stage["backward_flops"] for stage in stages.values()),
+        "graph_bytes": graph_bytes,
+        "parameter_bytes": parameter_bytes,
+        "activation_bytes": activation_bytes,
+        "peak_training_bytes": graph_bytes + parameter_bytes + activation_bytes,
+    }
+
+    if pipeline_config.product_graph is not None:
+        # The product graph is built from dense matrices over all nodes, a few of which exist at once
+        num_product_nodes = graphs["product"]["num_nodes"]
+        plan["product_graph_construction_bytes"] = (
+            3 * num_product_nodes**2 * 8 + num_product_nodes**2 * BYTES_PER_FLOAT + num_grid_nodes**2 * 8
+        )
+
+    return plan
+
+
+def _format_number(value: float, unit: str = "") -> str:
+    for suffix in ["", "K", "M", "G", "T"]:
+        if abs(value) < 1000:
+            return f"{value:.3g}{suffix}{unit}"
+        value /= 1000
+    return f"{value:.3g}P{unit}"
+
+
+def _format_bytes(value: float) -> str:
+    for suffix in ["B", "KB", "MB", "GB"]:
+        if abs(value) < 1024:
+            return f"{value:.3g} {suffix}"
+        value /= 1024
+    return f"{value:.3g} TB"
+
+
+def format_plan(plan: Dict[str, Any]) -> str:
+    lines = [f"Grid nodes: {plan['num_grid_nodes']}, mesh nodes: {plan['num_mesh_nodes']}", ""]
+
+    lines.append(f"{'graph':<12} {'nodes':>10} {'edges':>10}")
+    for name, graph in plan["graphs"].items():
+        lines.append(
+            f"{name:<12} {_format_number(graph['num_nodes']):>10} {_format_number(graph['num_edges']):>10}"
+        )
+
+    lines.append("")
+    lines.append(
+        f"{'stage':<14} {'params':>10} {'fwd FLOPs':>10} {'bwd FLOPs':>10} {'activations':>12}"
+    )
+    for name, stage in plan["stages"].items():
+        lines.append(
+            f"{name:<14} {_format_number(stage['num_parameters']):>10} "
+            f"{_format_number(stage['forward_flops']):>10} {_format_number(stage['backward_flops']):>10} "
+            f"{_format_bytes(stage['activation_bytes']):>12}"
+        )
+
+    lines.append("")
+    lines.append(f"Parameters: {_format_number(plan['num_parameters'])}")
+    lines.append(
+        f"FLOPs per sample: {_format_number(plan['forward_flops'])} forward, "
+        f"{_format_number(plan['backward_flops'])} backward"
+    )
+    lines.append(
+        f"Peak training memory: {_format_bytes(plan['peak_training_bytes'])} "
+        f"(graphs {_format_bytes(plan['graph_bytes'])}, parameters and optimiser "
+        f"{_format_bytes(plan['parameter_bytes'])}, activations {_format_bytes(plan['activation_bytes'])})"
+    )
+    if "product_graph_construction_bytes" in plan:
+        lines.append(
+            f"Product graph construction: {_format_bytes(plan['product_graph_construction_bytes'])}"
+        )
+
+    return "\n".join(lines)
+
+
+def plan_experiment_directory(experiment_dir: str, data_path: Optional[str] = None) -> Dict[str, Any]:
+    """Plans the experiment defined by the config.json file in the experiment directory."""
+    experiment_config = ExperimentConfig(
+        **load_from_json_file(os.path.join(experiment_dir, FileNames.EXPERIMENT_CONFIG))
+    )
+    if data_path is None:
+        data_path = os.path.join("data", "datasets", experiment_config.data.dataset_name)
+
+    return plan_experiment(
+        experiment_config,
+        get_dataset_metadata(experiment_config.data.dataset_name, data_path=data_path),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimates the graph sizes, FLOPs and memory of an experiment without building it."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file.",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Prints the plan as JSON instead of a table."
+    )
+    args = parser.parse_args()
+
+    plan = plan_experiment_directory(args.experiment_directory)
+    if args.json:
+        print(json.dumps(plan, indent=2))
+    else:
+        print(format_plan(plan))
+
+
+if __name__ == "__main__":
+    main()
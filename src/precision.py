@@ -0,0 +1,22 @@
+"""Mixed precision for training and inference.
+
+With `bf16` the forward passes run under `torch.autocast` with bfloat16, so the matmuls of the linear
+layers and the message passing of the encoder, processor and decoder run in bfloat16. The numerically
+sensitive parts stay in float32: the layer norms (see `LayerNorm` in `src.models`), the forecasts the model
+returns and the loss, which is computed outside of autocast. The attention softmax of GAT is float32 as
+well, since the attention logits are products with the float32 attention parameters.
+"""
+
+import contextlib
+
+import torch
+
+from src.config import Precision
+
+
+def autocast(precision: Precision, device):
+    """The autocast context of the precision on the device, a no-op for fp32."""
+    if precision == Precision.BF16:
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+    return contextlib.nullcontext()
@@ -0,0 +1,495 @@
+"""Runs a trained model over a dataset split or a list of initial times and streams the forecasts to zarr.
+
+The forecasts are computed in batches and every batch is appended to the store right away, so the memory
+use only depends on the batch size. The store has one `forecast` variable with the dimensions
+(time, lead, variable, latitude, longitude). With a normalisation manifest, e.g. the one written by
+`data.ingestion`, the forecasts are de-normalised.
+
+Example
+-------
+python -m src.predict "<path-to-experinment-directory>" forecasts.zarr --split test --batch-size 8
+python -m src.predict "<path-to-experinment-directory>" forecasts.zarr --sharded-dataset data/datasets/era5_64x32_2005_2010 --init-times 2010-01-01T00 2010-01-01T06 --lead-steps 4
+"""
+
+import argparse
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from src.config import ExperimentConfig, Precision
+from src.constants import FileNames, FolderNames
+from src.data.data_configs import DatasetMetadata, get_dataset_metadata
+from src.data.dataloader import select_input_window
+from src.main import load_model_from_experiment_config
+from src.models import WeatherPrediction
+from src.precision import autocast
+from src.utils import load_from_json_file
+
+
+SPLITS = ["train", "val", "test"]
+
+
+def load_trained_model(
+    experiment_dir: str,
+    device,
+    checkpoint_path: Optional[str] = None,
+    data_path: Optional[str] = None,
+    quantize: bool = False,
+) -> Tuple[WeatherPrediction, ExperimentConfig, DatasetMetadata]:
+    """Loads the model of an experiment with the weights of its best model or of the given checkpoint.
+
+    Parameters
+    ----------
+    experiment_dir : str
+        The experiment directory that contains the config.json file.
+    device
+        The device to load the model on.
+    checkpoint_path : Optional[str]
+        A saved model or a full training checkpoint. Defaults to the best model of the experiment.
+    data_path : Optional[str]
+        The directory of the dataset the model was trained on.
+    quantize : bool
+        Whether to quantize the linear layers to int8 for CPU inference, see `src.quantization`.
+
+    Returns
+    -------
+    Tuple[WeatherPrediction, ExperimentConfig, DatasetMetadata]
+        The model in evaluation mode, the experiment config and the metadata of the training dataset.
+    """
+    experiment_config = ExperimentConfig(
+        **load_from_json_file(os.path.join(experiment_dir, FileNames.EXPERIMENT_CONFIG))
+    )
+    if data_path is None:
+        data_path = os.path.join("data", "datasets", experiment_config.data.dataset_name)
+    dataset_metadata = get_dataset_metadata(experiment_config.data.dataset_name, data_path=data_path)
+
+    model = load_model_from_experiment_config(
+        experiment_config=experiment_config,
+        device=device,
+        dataset_metadata=dataset_metadata,
+        graph_cache_dir=experiment_config.graph_cache_dir
+        or os.path.join(experiment_dir, FolderNames.GRAPH_CACHE),
+    )
+
+    checkpoint = torch.load(
+        checkpoint_path or os.path.join(experiment_dir, FileNames.SAVED_MODEL),
+        map_location=device,
+        weights_only=False,
+    )
+    if "model" in checkpoint and "optimiser" in checkpoint:
+        # A full training checkpoint also has the processing graph pruned by SparseGAT
+        if checkpoint.get("processing_graph") is not None:
+            model.processing_graph = checkpoint["processing_graph"].to(device)
+        checkpoint = checkpoint["model"]
+
+    model.check_state_dict_layout(checkpoint)
+    model.load_state_dict(checkpoint)
+    model.eval()
+
+    if quantize:
+        if torch.device(device).type != "cpu":
+            raise ValueError("Quantized models only run on CPU.")
+
+        from src.quantization import quantize_model
+
+        model = quantize_model(model)
+
+    return model, experiment_config, dataset_metadata
+
+
+def _split_batches(
+    data_path: str,
+    split: str,
+    data_config,
+    dataset_metadata: DatasetMetadata,
+    batch_size: int,
+) -> Iterator[Tuple[np.ndarray, torch.Tensor]]:
+    """Yields the sample indices and the inputs of a split of a training dataset in batches. The stored
+    inputs are memory-mapped, so only the current batch is read into memory."""
+    X = torch.load(
+        os.path.join(data_path, FileNames.TRAIN_X if split == "train" else FileNames.TEST_X),
+        mmap=True,
+    )
+
+    # The validation set is the first half of the test file, like in training
+    start, end = 0, X.shape[0]
+    if split == "val":
+        end = X.shape[0] // 2
+    elif split == "test":
+        start = X.shape[0] // 2
+
+    for batch_start in range(start, end, batch_size):
+        batch_end = min(batch_start + batch_size, end)
+        yield (
+            np.arange(batch_start - start, batch_end - start),
+            select_input_window(
+                X[batch_start:batch_end].float(),
+                data_config=data_config,
+                dataset_metadata=dataset_metadata,
+            ).contiguous(),
+        )
+
+
+def _feature_names(manifest: Dict[str, Any], dataset) -> List[str]:
+    names = []
+    for variable in manifest["variables"]:
+        if "level" in dataset[variable].dims:
+            names.extend(f"{variable}_{level}" for level in dataset[variable].level.values)
+        else:
+            names.append(variable)
+    return names
+
+
+def _stack_features(dataset, manifest: Dict[str, Any]):
+    """Stacks the variables, and every level of variables with levels, of a sharded dataset into one lazy
+    array of the dimensions (time, longitude, latitude, variable)."""
+    import pandas as pd
+    import xarray as xr
+
+    arrays = []
+    for variable in manifest["variables"]:
+        if "level" in dataset[variable].dims:
+            arrays.extend(
+                dataset[variable].sel(level=level, drop=True) for level in dataset[variable].level.values
+            )
+        else:
+            arrays.append(dataset[variable])
+
+    return (
+        xr.concat(arrays, dim=pd.Index(_feature_names(manifest, dataset), name="variable"))
+        .transpose("time", "longitude", "latitude", "variable")
+    )
+
+
+def read_grid_states(features, time_indices: np.ndarray, num_features: int) -> np.ndarray:
+    """Reads the timesteps at the given indices, an array of any shape, from the stacked features of a
+    sharded dataset. Every timestep is only read once. Returns the grid states of the shape
+    [*time_indices.shape, grid, features], with the grid nodes ordered longitude-major like the training data."""
+    needed_indices, positions = np.unique(time_indices, return_inverse=True)
+    values = features.isel(time=needed_indices).values[..., :num_features]
+    # [time, longitude, latitude, features] -> [time, grid, features]
+    values = values.reshape(len(needed_indices), -1, num_features)
+
+    return values[positions.reshape(time_indices.shape)]
+
+
+def _sharded_batches(
+    features,
+    init_time_indices: np.ndarray,
+    data_config,
+    batch_size: int,
+) -> Iterator[Tuple[np.ndarray, torch.Tensor]]:
+    """Yields the initial times and the observation windows that end at them in batches. Only the
+    timesteps of the current batch are read from the shards."""
+    obs_window = data_config.obs_window_used
+    num_features = data_config.num_features_used
+
+    for batch_start in range(0, len(init_time_indices), batch_size):
+        batch_indices = init_time_indices[batch_start : batch_start + batch_size]
+        window_indices = batch_indices[:, None] + np.arange(1 - obs_window, 1)[None, :]
+
+        # [batch, obs_window, grid, features] -> [batch, grid, obs_window, features]
+        windows = read_grid_states(features, window_indices, num_features).transpose(0, 2, 1, 3)
+
+        X = torch.from_numpy(np.ascontiguousarray(windows, dtype=np.float32))
+        if data_config.want_feats_flattened:
+            X = X.reshape(X.shape[0], X.shape[1], -1)
+
+        yield features.time.values[batch_indices], X
+
+
+def _normalisation_arrays(
+    manifest: Dict[str, Any], num_features: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The mean and the standard deviation of every feature in the order the features are stacked."""
+    mean, std = [], []
+    for variable in manifest["variables"]:
+        mean.extend(np.atleast_1d(manifest["normalisation"]["mean"][variable]).tolist())
+        std.extend(np.atleast_1d(manifest["normalisation"]["std"][variable]).tolist())
+
+    if len(mean) < num_features:
+        raise ValueError(
+            f"The model uses {num_features} features, the normalisation manifest only has {len(mean)}."
+        )
+
+    return np.asarray(mean[:num_features]), np.asarray(std[:num_features])
+
+
+class ZarrForecastWriter:
+    """Appends batches of forecasts along the time dimension of a zarr store.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the zarr store, an existing store is overwritten.
+    coords : Dict[str, np.ndarray]
+        The coordinates of the lead, variable, latitude and longitude dimensions.
+    num_longitudes, num_latitudes : int
+        The size of the grid, whose nodes are ordered like in the training data.
+    attrs : Dict[str, Any]
+        Attributes of the forecast variable.
+    """
+
+    DIMS = ("time", "lead", "variable", "latitude", "longitude")
+
+    def __init__(
+        self,
+        store_path: str,
+        coords: Dict[str, np.ndarray],
+        num_longitudes: int,
+        num_latitudes: int,
+        attrs: Dict[str, Any],
+    ):
+        self.store_path = store_path
+        self.coords = coords
+        self.num_longitudes = num_longitudes
+        self.num_latitudes = num_latitudes
+        self.attrs = attrs
+        self.num_written = 0
+
+    def write(self, times: np.ndarray, forecasts: np.ndarray):
+        """Appends forecasts of the shape [batch, lead, grid, variable] for the given times."""
+        import xarray as xr
+
+        batch_size, num_leads, _, num_variables = forecasts.shape
+        # The grid nodes are ordered longitude-major like the training data
+        forecasts = forecasts.reshape(
+            batch_size, num_leads, self.num_longitudes, self.num_latitudes, num_variables
+        ).transpose(0, 1, 4, 3, 2)
+
+        dataset = xr.Dataset(
+            {"forecast": (self.DIMS, forecasts, self.attrs)},
+            coords={"time": times, **self.coords},
+        )
+        if self.num_written == 0:
+            dataset.to_zarr(
+                self.store_path,
+                mode="w",
+                encoding={"forecast": {"chunks": (batch_size,) + forecasts.shape[1:]}},
+            )
+        else:
+            # The coordinates without a time dimension are already in the store
+            dataset.drop_vars(list(self.coords)).to_zarr(self.store_path, append_dim="time")
+
+        self.num_written += batch_size
+
+
+def predict(
+    experiment_dir: str,
+    output_path: str,
+    split: Optional[str] = None,
+    sharded_dataset_dir: Optional[str] = None,
+    init_times: Optional[List[str]] = None,
+    batch_size: int = 8,
+    lead_steps: int = 1,
+    checkpoint_path: Optional[str] = None,
+    normalisation_path: Optional[str] = None,
+    data_path: Optional[str] = None,
+    quantize: bool = False,
+) -> int:
+    """Forecasts every sample of a dataset split, or every initial time of a sharded dataset, and writes
+    the forecasts to a zarr store, or to a netCDF file if the output path ends with `.nc`.
+
+    Parameters
+    ----------
+    experiment_dir : str
+        The experiment directory that contains the config.json file and the best model.
+    output_path : str
+        The zarr store or netCDF file to write.
+    split : Optional[str]
+        The split of the training dataset to forecast, one of train, val and test.
+    sharded_dataset_dir : Optional[str]
+        A dataset written by `data.ingestion` to forecast from instead of a split.
+    init_times : Optional[List[str]]
+        The initial times to forecast from in the sharded dataset. Defaults to all times that have a full
+        observation window.
+    batch_size : int
+        The number of forecasts computed at once.
+    lead_steps : int
+        The number of timesteps every forecast is rolled out for.
+    checkpoint_path : Optional[str]
+        The weights to use instead of the best model.
+    normalisation_path : Optional[str]
+        A manifest with the normalisation statistics, defaults to the one of the sharded dataset.
+    data_path : Optional[str]
+        The directory of the training dataset.
+    quantize : bool
+        Whether to run the model with int8 linear layers, which forces it onto the CPU.
+
+    Returns
+    -------
+    int
+        The number of forecasts written.
+    """
+    if (split is None) == (sharded_dataset_dir is None):
+        raise ValueError("Either a split or a sharded dataset has to be given.")
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not quantize else "cpu")
+    model, experiment_config, dataset_metadata = load_trained_model(
+        experiment_dir,
+        device=device,
+        checkpoint_path=checkpoint_path,
+        data_path=data_path,
+        quantize=quantize,
+    )
+    data_config = experiment_config.data
+    num_features = model.num_features
+    # The int8 layers of a quantized model do not run under autocast
+    precision = Precision.FP32 if quantize else experiment_config.precision
+
+    manifest = None
+    if normalisation_path is not None:
+        manifest = load_from_json_file(normalisation_path)
+
+    if sharded_dataset_dir is not None:
+        import pandas as pd
+
+        from data.ingestion import load_manifest, open_sharded_dataset
+
+        manifest = manifest or load_manifest(sharded_dataset_dir)
+        dataset = open_sharded_dataset(sharded_dataset_dir)
+        features = _stack_features(dataset, load_manifest(sharded_dataset_dir))
+        if features.sizes["variable"] < num_features:
+            raise ValueError(
+                f"The model uses {num_features} features, the dataset only has {features.sizes['variable']}."
+            )
+
+        if init_times is None:
+            init_time_indices = np.arange(data_config.obs_window_used - 1, features.sizes["time"])
+        else:
+            init_time_indices = dataset.indexes["time"].get_indexer(pd.to_datetime(init_times))
+            if (init_time_indices < data_config.obs_window_used - 1).any():
+                raise ValueError(
+                    "Every initial time has to be in the dataset and have a full observation window before it."
+                )
+
+        time_step = features.time.values[1] - features.time.values[0]
+        coords = {
+            "lead": np.arange(1, lead_steps + 1) * time_step,
+            "variable": features["variable"].values[:num_features],
+            "latitude": features.latitude.values,
+            "longitude": features.longitude.values,
+        }
+        batches = _sharded_batches(features, init_time_indices, data_config, batch_size)
+        num_forecasts = len(init_time_indices)
+
+    else:
+        if data_path is None:
+            data_path = os.path.join("data", "datasets", data_config.dataset_name)
+        if manifest is not None:
+            variable_names = [
+                f"{variable}_{i}" if np.ndim(manifest["normalisation"]["mean"][variable]) else variable
+                for variable in manifest["variables"]
+                for i in range(np.size(manifest["normalisation"]["mean"][variable]))
+            ][:num_features]
+        else:
+            variable_names = [f"feature_{i}" for i in range(num_features)]
+
+        coords = {
+            "lead": np.arange(1, lead_steps + 1),
+            "variable": np.asarray(variable_names),
+            "latitude": np.linspace(-90, 90, num=dataset_metadata.num_latitudes, endpoint=True),
+            "longitude": np.linspace(0, 360, num=dataset_metadata.num_longitudes, endpoint=False),
+        }
+        batches = _split_batches(data_path, split, data_config, dataset_metadata, batch_size)
+        num_forecasts = None
+
+    mean, std = None, None
+    if manifest is not None:
+        mean, std = _normalisation_arrays(manifest, num_features)
+
+    # netCDF can not be appended to, so the forecasts are streamed to zarr and converted at the end
+    write_netcdf = output_path.endswith(".nc")
+    store_path = f"{output_path}.zarr.tmp" if write_netcdf else output_path
+
+    writer = ZarrForecastWriter(
+        store_path,
+        coords=coords,
+        num_longitudes=dataset_metadata.num_longitudes,
+        num_latitudes=dataset_metadata.num_latitudes,
+        attrs={
+            "experiment": os.path.abspath(experiment_dir),
+            "normalised": int(mean is None),
+        },
+    )
+
+    with torch.no_grad(), autocast(precision, device):
+        for times, X in batches:
+            forecasts = model.rollout(X=X.to(device), num_steps=lead_steps).cpu().numpy()
+            if mean is not None:
+                forecasts = forecasts * std + mean
+
+            writer.write(times, forecasts.astype(np.float32))
+            progress = f"{writer.num_written}/{num_forecasts}" if num_forecasts else writer.num_written
+            print(f"Forecasts written: {progress}", end="\r")
+
+    print()
+
+    if write_netcdf:
+        import xarray as xr
+
+        with xr.open_zarr(store_path) as forecasts:
+            forecasts.to_netcdf(output_path)
+        shutil.rmtree(store_path)
+
+    print(f"{writer.num_written} forecasts saved to {output_path}")
+    return writer.num_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes the forecasts of a trained Weather Prediction model.")
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument("output_path", help="The zarr store, or a .nc file, to write the forecasts to.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--split", choices=SPLITS, help="The split of the training dataset to forecast.")
+    source.add_argument(
+        "--sharded-dataset",
+        help="A dataset written by data.ingestion to forecast from.",
+    )
+    parser.add_argument(
+        "--init-times",
+        nargs="+",
+        default=None,
+        help="The initial times to forecast from in the sharded dataset, e.g. 2010-01-01T06.",
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lead-steps", type=int, default=1)
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument(
+        "--quantize", action="store_true", help="Runs the model on CPU with int8 linear layers."
+    )
+    parser.add_argument(
+        "--normalisation",
+        default=None,
+        help="A manifest with the normalisation statistics to de-normalise the forecasts with.",
+    )
+    parser.add_argument(
+        "--data-path",
+        default=None,
+        help="The directory of the training dataset, defaults to data/datasets/<dataset_name>.",
+    )
+    args = parser.parse_args()
+
+    predict(
+        experiment_dir=args.experiment_directory,
+        output_path=args.output_path,
+        split=args.split,
+        sharded_dataset_dir=args.sharded_dataset,
+        init_times=args.init_times,
+        batch_size=args.batch_size,
+        lead_steps=args.lead_steps,
+        checkpoint_path=args.checkpoint,
+        normalisation_path=args.normalisation,
+        data_path=args.data_path,
+        quantize=args.quantize,
+    )
+
+
+if __name__ == "__main__":
+    main()
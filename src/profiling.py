@@ -0,0 +1,222 @@
+"""Named timing regions to find out where the time of a training step goes.
+
+Regions are recorded into a global profiler that is only active while profiling is enabled. When it is
+disabled, `region` returns a shared no-op context manager, so the instrumentation can stay in the hot loop.
+
+Example
+-------
+with region("encoder"):
+    encoded_features = self.encoder.forward(X=X, edge_index=self.encoding_graph)
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+from src.config import ProfilingConfig
+from src.constants import FileNames
+
+
+_NULL_REGION = contextlib.nullcontext()
+
+_PROFILER: Optional["StageProfiler"] = None
+
+
+class _Region:
+    __slots__ = ("_profiler", "_name", "_start", "_record_function")
+
+    def __init__(self, profiler: "StageProfiler", name: str):
+        self._profiler = profiler
+        self._name = name
+        self._record_function = None
+
+    def __enter__(self):
+        if self._profiler.record_function:
+            self._record_function = torch.profiler.record_function(self._name)
+            self._record_function.__enter__()
+
+        self._profiler.synchronize()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler.synchronize()
+        end = time.perf_counter()
+
+        if self._record_function is not None:
+            self._record_function.__exit__(*exc_info)
+
+        self._profiler.record(self._name, start=self._start, end=end)
+        return False
+
+
+class StageProfiler:
+    """Collects the durations of named regions and aggregates them per epoch.
+
+    Every region is recorded under `<phase>/<name>`, where the phase is e.g. `train` or `eval`, so that the
+    same model stages are reported separately for training and evaluation.
+
+    Parameters
+    ----------
+    record_function : bool
+        Whether to also open a `torch.profiler.record_function` for every region, so that the regions show
+        up in traces of the torch profiler.
+    chrome_trace : bool
+        Whether to keep the individual regions for the export in the Chrome trace format.
+    max_trace_events : int
+        The maximum number of regions kept for the trace, later regions are only aggregated.
+    """
+
+    def __init__(
+        self,
+        record_function: bool = False,
+        chrome_trace: bool = True,
+        max_trace_events: int = 1_000_000,
+    ):
+        self.record_function = record_function
+        self.chrome_trace = chrome_trace
+        self.max_trace_events = max_trace_events
+        self.phase = "train"
+
+        # Without synchronising, regions would only measure the time to launch the CUDA kernels
+        self._synchronize_cuda = torch.cuda.is_available()
+
+        self._origin = time.perf_counter()
+        self._durations: Dict[str, List[float]] = defaultdict(list)
+        self._trace_events: List[Dict[str, Any]] = []
+        self._thread_ids: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+        self.epoch_summaries: List[Dict[str, Any]] = []
+
+    def synchronize(self):
+        if self._synchronize_cuda:
+            torch.cuda.synchronize()
+
+    def record(self, name: str, start: float, end: float):
+        key = f"{self.phase}/{name}"
+        with self._lock:
+            self._durations[key].append(end - start)
+
+            if self.chrome_trace and len(self._trace_events) < self.max_trace_events:
+                thread_id = self._thread_ids.setdefault(
+                    threading.get_ident(), len(self._thread_ids)
+                )
+                self._trace_events.append(
+                    {
+                        "name": name,
+                        "cat": self.phase,
+                        "ph": "X",
+                        "ts": (start - self._origin) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": thread_id,
+                    }
+                )
+
+    def end_epoch(self, epoch: int) -> Dict[str, Any]:
+        """Aggregates the regions recorded since the last epoch into the wall time, the call count and
+        percentiles of every region, in seconds."""
+        with self._lock:
+            durations, self._durations = self._durations, defaultdict(list)
+
+        stages = {}
+        for key, values in sorted(durations.items()):
+            values = np.asarray(values)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stages[key] = {
+                "total": float(values.sum()),
+                "count": int(values.size),
+                "mean": float(values.mean()),
+                "p50": float(p50),
+                "p90": float(p90),
+                "p99": float(p99),
+                "max": float(values.max()),
+            }
+
+        summary = {"epoch": epoch, "stages": stages}
+        self.epoch_summaries.append(summary)
+        return summary
+
+    def export(self, save_dir: str, suffix: str = ""):
+        """Writes the per-epoch summaries to `profile<suffix>.json` and the regions to
+        `profile_trace<suffix>.json`, which can be opened in chrome://tracing or Perfetto."""
+
+        def _path(file_name: str) -> str:
+            stem, extension = os.path.splitext(file_name)
+            return os.path.join(save_dir, f"{stem}{suffix}{extension}")
+
+        with open(_path(FileNames.PROFILE), "w") as outfile:
+            json.dump({"epochs": self.epoch_summaries}, outfile)
+
+        if self.chrome_trace:
+            with open(_path(FileNames.PROFILE_TRACE), "w") as outfile:
+                json.dump(
+                    {"traceEvents": self._trace_events, "displayTimeUnit": "ms"},
+                    outfile,
+                )
+
+
+def enable_profiling(profiling_config: ProfilingConfig) -> StageProfiler:
+    global _PROFILER
+    _PROFILER = StageProfiler(
+        record_function=profiling_config.record_function,
+        chrome_trace=profiling_config.chrome_trace,
+        max_trace_events=profiling_config.max_trace_events,
+    )
+    return _PROFILER
+
+
+def disable_profiling():
+    global _PROFILER
+    _PROFILER = None
+
+
+def get_profiler() -> Optional[StageProfiler]:
+    return _PROFILER
+
+
+def region(name: str):
+    """Returns a context manager that records the time spent in it under `name` if profiling is enabled."""
+    if _PROFILER is None:
+        return _NULL_REGION
+    return _Region(_PROFILER, name)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Records all regions inside under the given phase, e.g. `eval`."""
+    if _PROFILER is None:
+        yield
+        return
+
+    previous, _PROFILER.phase = _PROFILER.phase, name
+    try:
+        yield
+    finally:
+        _PROFILER.phase = previous
+
+
+def profile_iterable(iterable: Iterable, name: str) -> Iterable:
+    """Records the time spent waiting for every item of the iterable, e.g. the batches of a DataLoader."""
+    if _PROFILER is None:
+        return iterable
+    return _profiled_iterator(iterable, name)
+
+
+def _profiled_iterator(iterable: Iterable, name: str) -> Iterator:
+    iterator = iter(iterable)
+    while True:
+        with region(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
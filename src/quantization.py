@@ -0,0 +1,205 @@
+"""Post-training dynamic int8 quantization of a trained model for CPU inference.
+
+The weights of the linear layers, those of the MLP blocks and the projections inside GCNConv and GATConv,
+are quantized to int8 ahead of time and their activations on the fly, so no calibration data is needed.
+The message passing aggregations and the attention stay in float.
+
+Example
+-------
+python -m src.quantization "<path-to-experinment-directory>" --split test --max-samples 100
+"""
+
+import argparse
+import copy
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, Optional
+
+import torch
+import torch.nn as nn
+from torch_geometric.nn import GATConv, GCNConv
+
+from src.models import WeatherPrediction
+
+
+def _to_torch_linear(lin: nn.Module) -> nn.Linear:
+    """Copies a torch_geometric Linear into a torch Linear, which is what dynamic quantization replaces."""
+    linear = nn.Linear(
+        lin.in_channels, lin.out_channels, bias=lin.bias is not None, device=lin.weight.device
+    )
+    with torch.no_grad():
+        linear.weight.copy_(lin.weight)
+        if lin.bias is not None:
+            linear.bias.copy_(lin.bias)
+
+    return linear
+
+
+def quantize_model(model: WeatherPrediction) -> WeatherPrediction:
+    """Returns a copy of the model with dynamic int8 quantization applied to all its linear layers. The
+    copy runs on CPU and has the same interface as the model, including `forward_batch` and `rollout`.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The trained model, on CPU.
+
+    Returns
+    -------
+    WeatherPrediction
+        The quantized copy in evaluation mode.
+    """
+    quantized = copy.deepcopy(model).eval()
+
+    for module in quantized.modules():
+        # The convolutions project with torch_geometric's own Linear, which has the same call signature
+        if isinstance(module, (GCNConv, GATConv)) and module.lin is not None:
+            module.lin = _to_torch_linear(module.lin)
+
+    return torch.ao.quantization.quantize_dynamic(
+        quantized, qconfig_spec={nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def _median_latency(model: WeatherPrediction, X: torch.Tensor, repeats: int) -> float:
+    durations = []
+    with torch.no_grad():
+        model(X=X, attention_threshold=0.0)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(X=X, attention_threshold=0.0)
+            durations.append(time.perf_counter() - start)
+
+    return statistics.median(durations)
+
+
+def evaluate_quantization(
+    model: WeatherPrediction,
+    quantized: WeatherPrediction,
+    dataset,
+    max_samples: Optional[int] = None,
+    latency_repeats: int = 20,
+) -> Dict[str, Any]:
+    """Compares the quantized model with the float model on a dataset split.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The float model.
+    quantized : WeatherPrediction
+        The quantized model.
+    dataset
+        The split to evaluate on, with samples of the form (X, y).
+    max_samples : Optional[int]
+        Only evaluates on the first samples of the split.
+    latency_repeats : int
+        The number of timed forward passes of each model.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Per variable, the RMSE of both models against the targets, the RMSE between the two models
+        (the drift) and the relative change of the RMSE. Also the median latency of both models and the
+        speedup.
+    """
+    num_samples = len(dataset) if max_samples is None else min(max_samples, len(dataset))
+    num_features = model.num_features
+
+    float_squared_error = torch.zeros(num_features, dtype=torch.float64)
+    quantized_squared_error = torch.zeros(num_features, dtype=torch.float64)
+    drift_squared_error = torch.zeros(num_features, dtype=torch.float64)
+    num_values = 0
+
+    with torch.no_grad():
+        for i in range(num_samples):
+            X, y = dataset[i]
+            X = X.unsqueeze(0).float()
+            y = y.reshape(y.shape[0], -1)[:, :num_features].double()
+
+            float_prediction = model(X=X, attention_threshold=0.0).double()
+            quantized_prediction = quantized(X=X, attention_threshold=0.0).double()
+
+            float_squared_error += ((float_prediction - y) ** 2).sum(dim=0)
+            quantized_squared_error += ((quantized_prediction - y) ** 2).sum(dim=0)
+            drift_squared_error += ((quantized_prediction - float_prediction) ** 2).sum(dim=0)
+            num_values += y.shape[0]
+
+    float_rmse = (float_squared_error / num_values).sqrt()
+    quantized_rmse = (quantized_squared_error / num_values).sqrt()
+    drift = (drift_squared_error / num_values).sqrt()
+
+    X = dataset[0][0].unsqueeze(0).float()
+    float_latency = _median_latency(model, X, latency_repeats)
+    quantized_latency = _median_latency(quantized, X, latency_repeats)
+
+    return {
+        "num_samples": num_samples,
+        "variables": {
+            f"feature_{i}": {
+                "float_rmse": float_rmse[i].item(),
+                "quantized_rmse": quantized_rmse[i].item(),
+                "drift_rmse": drift[i].item(),
+                "relative_rmse_change": (quantized_rmse[i] / float_rmse[i] - 1).item(),
+            }
+            for i in range(num_features)
+        },
+        "float_latency": float_latency,
+        "quantized_latency": quantized_latency,
+        "speedup": float_latency / quantized_latency,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluates the accuracy drift and the speedup of int8 dynamic quantization."
+    )
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument("--split", choices=["train", "val", "test"], default="test")
+    parser.add_argument("--max-samples", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=20, help="The number of timed forward passes.")
+    parser.add_argument("--output", default=None, help="Saves the report as JSON.")
+    args = parser.parse_args()
+
+    from src.data.dataloader import load_train_and_test_datasets
+    from src.predict import load_trained_model
+
+    model, experiment_config, _ = load_trained_model(
+        args.experiment_directory, device=torch.device("cpu"), checkpoint_path=args.checkpoint
+    )
+    quantized = quantize_model(model)
+
+    splits = load_train_and_test_datasets(
+        data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+        data_config=experiment_config.data,
+    )
+    dataset = splits[["train", "val", "test"].index(args.split)]
+
+    report = evaluate_quantization(
+        model, quantized, dataset, max_samples=args.max_samples, latency_repeats=args.repeats
+    )
+
+    print(f"{'variable':<12} {'float RMSE':>11} {'int8 RMSE':>11} {'drift RMSE':>11} {'change':>8}")
+    for name, result in report["variables"].items():
+        print(
+            f"{name:<12} {result['float_rmse']:>11.5f} {result['quantized_rmse']:>11.5f} "
+            f"{result['drift_rmse']:>11.5f} {result['relative_rmse_change']:>8.2%}"
+        )
+    print(
+        f"Latency: float {report['float_latency'] * 1000:.2f} ms, int8 {report['quantized_latency'] * 1000:.2f} ms, "
+        f"speedup {report['speedup']:.2f}x on {report['num_samples']} {args.split} samples"
+    )
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+        print(f"Quantization report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""A local HTTP service that keeps a trained model loaded and serves forecasts on demand.
+
+The model and its static graphs are loaded once. Concurrent forecast requests are queued and collected into
+micro-batches, which wait at most `max_wait_ms` for more requests before they run through the batched
+forward of the model. The model runs on a worker thread, so new requests are accepted while a batch is
+forecasted.
+
+Endpoints
+---------
+POST /forecast  {"initial_state": [...], "horizon": 4} -> {"forecast": [...]}
+    The initial state has the input shape of one sample, [num_grid_nodes, obs_window * num_features] or
+    [num_grid_nodes, obs_window, num_features], and the forecast the shape [horizon, num_grid_nodes,
+    num_features].
+GET /metrics    The queue depth, the batch sizes and the latency percentiles.
+GET /health     Whether the service is up.
+
+Example
+-------
+python -m src.serve "<path-to-experinment-directory>" --port 8080 --max-batch-size 16 --max-wait-ms 20
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from src.config import Precision
+from src.models import WeatherPrediction
+from src.precision import autocast
+
+
+_STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class RequestError(Exception):
+    """An error caused by the request, answered with the given HTTP status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _ForecastRequest:
+    def __init__(self, X: torch.Tensor, horizon: int, future: asyncio.Future):
+        self.X = X
+        self.horizon = horizon
+        self.future = future
+        self.received = time.perf_counter()
+
+
+class ForecastServer:
+    """Micro-batches forecast requests for a loaded model.
+
+    Parameters
+    ----------
+    model : WeatherPrediction
+        The model in evaluation mode.
+    max_batch_size : int
+        The maximum number of requests forecasted together.
+    max_wait_ms : float
+        How long the first request of a batch waits for more requests, i.e. the latency added for batching.
+    max_queue_size : int
+        Requests are rejected with status 503 if this many are already waiting.
+    max_horizon : int
+        The maximum number of steps a forecast can be rolled out for.
+    num_latencies : int
+        The number of recent requests the latency percentiles are computed over.
+    precision : Precision
+        The precision the forecasts are computed in.
+    """
+
+    def __init__(
+        self,
+        model: WeatherPrediction,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 20.0,
+        max_queue_size: int = 256,
+        max_horizon: int = 40,
+        num_latencies: int = 1000,
+        precision: Precision = Precision.FP32,
+    ):
+        self.model = model
+        self.precision = precision
+        self.device = model.init_grid_features.device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.max_horizon = max_horizon
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+
+        self._num_requests = 0
+        self._num_rejected = 0
+        self._num_batches = 0
+        self._batch_sizes: Deque[int] = deque(maxlen=num_latencies)
+        self._queue_latencies: Deque[float] = deque(maxlen=num_latencies)
+        self._forecast_latencies: Deque[float] = deque(maxlen=num_latencies)
+        self._total_latencies: Deque[float] = deque(maxlen=num_latencies)
+        self._started = time.time()
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+
+    def _parse_initial_state(self, initial_state: Any) -> torch.Tensor:
+        try:
+            X = torch.as_tensor(np.asarray(initial_state, dtype=np.float32))
+        except (TypeError, ValueError):
+            raise RequestError(400, "The initial state has to be a numeric array.")
+
+        num_grid_nodes = self.model._num_grid_nodes
+        expected_size = num_grid_nodes * self.model.obs_window * self.model.num_features
+        if X.numel() != expected_size or X.shape[0] != num_grid_nodes:
+            raise RequestError(
+                400,
+                f"The initial state has the shape {list(X.shape)}, expected "
+                f"[{num_grid_nodes}, {self.model.obs_window * self.model.num_features}] or "
+                f"[{num_grid_nodes}, {self.model.obs_window}, {self.model.num_features}].",
+            )
+
+        # The batched forward takes both layouts, the flattened one is used to stack requests
+        return X.reshape(num_grid_nodes, -1)
+
+    async def forecast(self, initial_state: Any, horizon: int) -> torch.Tensor:
+        """Queues a forecast and waits for its batch. Returns the forecast of the shape
+        [horizon, num_grid_nodes, num_features]."""
+        if not isinstance(horizon, int) or not 1 <= horizon <= self.max_horizon:
+            raise RequestError(400, f"The horizon has to be an integer from 1 to {self.max_horizon}.")
+
+        request = _ForecastRequest(
+            X=self._parse_initial_state(initial_state),
+            horizon=horizon,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        try:
+            self._queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self._num_rejected += 1
+            raise RequestError(503, "Too many forecast requests are waiting, try again later.")
+
+        self._num_requests += 1
+        return await request.future
+
+    async def _next_batch(self) -> List[_ForecastRequest]:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    def _run_batch(self, X: torch.Tensor, horizon: int) -> torch.Tensor:
+        with torch.no_grad(), autocast(self.precision, self.device):
+            return self.model.rollout(X=X.to(self.device), num_steps=horizon).cpu()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            started = time.perf_counter()
+
+            # Requests with the same horizon are rolled out together
+            horizons: Dict[int, List[_ForecastRequest]] = {}
+            for request in batch:
+                horizons.setdefault(request.horizon, []).append(request)
+
+            for horizon, requests in horizons.items():
+                try:
+                    forecasts = await loop.run_in_executor(
+                        None, self._run_batch, torch.stack([request.X for request in requests]), horizon
+                    )
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+
+                for request, forecast in zip(requests, forecasts):
+                    if not request.future.done():
+                        request.future.set_result(forecast)
+
+            finished = time.perf_counter()
+            self._num_batches += 1
+            self._batch_sizes.append(len(batch))
+            for request in batch:
+                self._queue_latencies.append(started - request.received)
+                self._forecast_latencies.append(finished - started)
+                self._total_latencies.append(finished - request.received)
+
+    def metrics(self) -> Dict[str, Any]:
+        """The queue depth, the number of requests and batches, and the percentiles of the time requests
+        spent waiting in the queue, being forecasted and in total, in seconds."""
+
+        def _percentiles(values: Deque[float]) -> Dict[str, Optional[float]]:
+            if not values:
+                return {"p50": None, "p90": None, "p99": None, "max": None}
+            p50, p90, p99 = np.percentile(np.asarray(values), [50, 90, 99])
+            return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(max(values))}
+
+        return {
+            "uptime": time.time() - self._started,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "num_requests": self._num_requests,
+            "num_rejected": self._num_rejected,
+            "num_batches": self._num_batches,
+            "mean_batch_size": float(np.mean(self._batch_sizes)) if self._batch_sizes else None,
+            "queue_latency": _percentiles(self._queue_latencies),
+            "forecast_latency": _percentiles(self._forecast_latencies),
+            "total_latency": _percentiles(self._total_latencies),
+        }
+
+    async def handle_request(self, method: str, path: str, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        """Answers one HTTP request with a status and a JSON body."""
+        if path == "/health":
+            return 200, {"status": "ok"}
+
+        if path == "/metrics":
+            return 200, self.metrics()
+
+        if path != "/forecast":
+            raise RequestError(404, f"Unknown path {path}.")
+        if method != "POST":
+            raise RequestError(405, "Forecasts have to be requested with POST.")
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise RequestError(400, "The request body has to be JSON.")
+        if not isinstance(payload, dict) or "initial_state" not in payload:
+            raise RequestError(400, "The request needs an initial_state.")
+
+        forecast = await self.forecast(payload["initial_state"], payload.get("horizon", 1))
+        return 200, {"forecast": forecast.tolist()}
+
+
+async def _read_http_request(reader: asyncio.StreamReader, max_body_bytes: int) -> Tuple[str, str, bytes]:
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    if not request_line:
+        raise ConnectionError("The connection was closed.")
+    try:
+        method, path, _ = request_line.split(" ", 2)
+    except ValueError:
+        raise RequestError(400, "Malformed request line.")
+
+    content_length = 0
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            try:
+                content_length = int(value.strip())
+            except ValueError:
+                raise RequestError(400, "The Content-Length header has to be an integer.")
+            if content_length < 0:
+                raise RequestError(400, "The Content-Length header cannot be negative.")
+
+    if content_length > max_body_bytes:
+        raise RequestError(413, f"The request body is larger than {max_body_bytes} bytes.")
+
+    body = await reader.readexactly(content_length) if content_length else b""
+    return method.upper(), path.split("?", 1)[0], body
+
+
+async def _write_http_response(writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any]):
+    body = json.dumps(payload).encode()
+    writer.write(
+        (
+            f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, '')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode()
+        + body
+    )
+    await writer.drain()
+
+
+async def serve(
+    server: ForecastServer, host: str = "127.0.0.1", port: int = 8080, max_body_bytes: int = 256 * 2**20
+):
+    """Serves forecasts over HTTP until cancelled. Every connection handles one request."""
+    await server.start()
+
+    async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, body = await _read_http_request(reader, max_body_bytes)
+            status, payload = await server.handle_request(method, path, body)
+        except RequestError as e:
+            status, payload = e.status, {"error": str(e)}
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        except Exception as e:
+            status, payload = 500, {"error": repr(e)}
+
+        try:
+            await _write_http_response(writer, status, payload)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    http_server = await asyncio.start_server(_handle_connection, host=host, port=port)
+    print(f"Serving forecasts on http://{host}:{port}")
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves forecasts of a trained Weather Prediction model.")
+    parser.add_argument(
+        "experiment_directory",
+        help="The experiment directory that contains the config.json file and the best model.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--checkpoint", default=None, help="The weights to use instead of the best model.")
+    parser.add_argument(
+        "--quantize", action="store_true", help="Runs the model on CPU with int8 linear layers."
+    )
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=20.0,
+        help="How long a request waits for others to be batched with.",
+    )
+    parser.add_argument("--max-queue-size", type=int, default=256)
+    parser.add_argument("--max-horizon", type=int, default=40)
+    args = parser.parse_args()
+
+    from src.predict import load_trained_model
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.quantize else "cpu")
+    model, experiment_config, _ = load_trained_model(
+        args.experiment_directory,
+        device=device,
+        checkpoint_path=args.checkpoint,
+        quantize=args.quantize,
+    )
+    server = ForecastServer(
+        model,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_queue_size=args.max_queue_size,
+        max_horizon=args.max_horizon,
+        # The int8 layers of a quantized model do not run under autocast
+        precision=Precision.FP32 if args.quantize else experiment_config.precision,
+    )
+
+    try:
+        asyncio.run(serve(server, host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Runs a sweep of experiments in parallel on a process pool, sharing built graphs and loaded datasets.
+
+The sweep is defined by a `sweep.json` file (see `SweepConfig`) in the sweep directory, e.g.
+
+{
+    "base_experiment": "experiments/baseline",
+    "overrides": {"num_epochs": 50, "wandb_log": false},
+    "grid": {
+        "graph.mesh_levels": [[2, 4], [3, 5]],
+        "graph.grid2mesh_radius_query": [0.5, 0.6]
+    },
+    "num_parallel_runs": 4
+}
+
+Example
+-------
+python -m src.sweep "<path-to-sweep-directory>"
+"""
+
+import argparse
+import copy
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, List
+
+import numpy as np
+import torch
+
+from src.config import ExperimentConfig, SweepConfig
+from src.constants import FileNames, FolderNames
+from src.data.data_configs import DatasetMetadata, get_dataset_metadata
+from src.distributed import threads_per_rank
+from src.main import get_grid_coordinates, load_model_from_experiment_config, run_experiment
+from src.models import static_graphs_cache_key
+from src.planner import format_plan, plan_experiment
+from src.utils import load_from_json_file, save_to_json_file
+
+
+def apply_overrides(config_dict: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns a copy of the config dict with the overrides applied. The keys of the overrides are dotted
+    paths into the config, e.g. `graph.mesh_levels`."""
+    config_dict = copy.deepcopy(config_dict)
+    for dotted_key, value in overrides.items():
+        *parents, key = dotted_key.split(".")
+        node = config_dict
+        for parent in parents:
+            if node.get(parent) is None:
+                node[parent] = {}
+            node = node[parent]
+        node[key] = copy.deepcopy(value)
+
+    return config_dict
+
+
+def expand_sweep(sweep_config: SweepConfig) -> List[Dict[str, Any]]:
+    """Returns the overrides of every run of the sweep, i.e. every run of the list combined with every
+    combination of the grid. The overrides shared by all runs are not included."""
+    grid_keys = list(sweep_config.grid)
+    grid_points = [
+        dict(zip(grid_keys, values))
+        for values in itertools.product(*(sweep_config.grid[key] for key in grid_keys))
+    ]
+
+    return [
+        {**run, **grid_point}
+        for run in (sweep_config.runs or [{}])
+        for grid_point in grid_points
+    ]
+
+
+def _graph_group_key(experiment_config: ExperimentConfig, dataset_metadata: DatasetMetadata) -> str:
+    """Runs with the same key build the same static graphs."""
+    grid_lat, grid_lon = get_grid_coordinates(dataset_metadata)
+    return static_graphs_cache_key(
+        grid_lat=grid_lat,
+        grid_lon=grid_lon,
+        graph_config=experiment_config.graph,
+        product_graph_config=experiment_config.pipeline.product_graph,
+        obs_window=experiment_config.data.obs_window_used,
+    )
+
+
+def _init_sweep_worker(num_threads: int):
+    # Every run gets its share of the cores instead of all runs competing for all of them
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    torch.set_num_threads(num_threads)
+
+
+def _build_static_graphs(config_dict: Dict[str, Any]):
+    """Builds the static graphs of a run once and stores them in its graph cache."""
+    experiment_config = ExperimentConfig(**config_dict)
+    data_path = os.path.join("data", "datasets", experiment_config.data.dataset_name)
+    load_model_from_experiment_config(
+        experiment_config=experiment_config,
+        device=torch.device("cpu"),
+        dataset_metadata=get_dataset_metadata(
+            experiment_config.data.dataset_name, data_path=data_path
+        ),
+        graph_cache_dir=experiment_config.graph_cache_dir,
+    )
+
+
+def _run_sweep_entry(config_dict: Dict[str, Any], results_save_dir: str) -> Dict[str, Any]:
+    os.makedirs(results_save_dir, exist_ok=True)
+    save_to_json_file(
+        data_dict=config_dict,
+        save_path=os.path.join(results_save_dir, FileNames.EXPERIMENT_CONFIG),
+    )
+
+    start = time.perf_counter()
+    training_results = run_experiment(
+        experiment_config=ExperimentConfig(**config_dict),
+        results_save_dir=results_save_dir,
+    )
+    wall_time = time.perf_counter() - start
+
+    # The first evaluation is the performance before training
+    best_eval = int(np.argmin(training_results["val_losses"]))
+    return {
+        "best_epoch": training_results["eval_epochs"][best_eval],
+        "best_val_loss": training_results["val_losses"][best_eval],
+        "test_loss": training_results["test_losses"][best_eval],
+        "final_train_loss": training_results["train_losses"][-1],
+        "epochs_trained": len(training_results["train_losses"]) - 1,
+        "wall_time": wall_time,
+    }
+
+
+def _write_results_table(results: List[Dict[str, Any]], sweep_dir: str):
+    columns = []
+    for result in results:
+        columns.extend(column for column in result if column not in columns)
+
+    with open(os.path.join(sweep_dir, FileNames.SWEEP_RESULTS_TABLE), "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=columns)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(
+                {
+                    key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                    for key, value in result.items()
+                }
+            )
+
+    save_to_json_file(
+        data_dict=results, save_path=os.path.join(sweep_dir, FileNames.SWEEP_RESULTS)
+    )
+
+
+def run_sweep(sweep_dir: str, dry_run: bool = False) -> List[Dict[str, Any]]:
+    """Runs all experiments of the sweep defined in `<sweep_dir>/sweep.json` and writes a table with the
+    overrides and the results of every run to `<sweep_dir>/sweep_results.csv`.
+
+    Runs are executed on a process pool, each with a limited number of threads. The static graphs of
+    all runs with the same graph config are built once and cached in the sweep directory, and the
+    datasets are shared between the runs through shared memory. Each run is stored like an experiment
+    in `<sweep_dir>/runs/<run_name>`. Runs whose estimated peak memory exceeds `max_planned_memory_gb`
+    are skipped.
+
+    Parameters
+    ----------
+    sweep_dir : str
+        The sweep directory that contains the sweep.json file.
+    dry_run : bool
+        Only prints the estimated cost of every run without running any of them.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The overrides and the results of every run.
+    """
+    sweep_config = SweepConfig(
+        **load_from_json_file(os.path.join(sweep_dir, FileNames.SWEEP_CONFIG))
+    )
+    base_config_dict = load_from_json_file(
+        os.path.join(sweep_config.base_experiment, FileNames.EXPERIMENT_CONFIG)
+    )
+    graph_cache_dir = os.path.join(sweep_dir, FolderNames.GRAPH_CACHE)
+
+    runs = []
+    for i, overrides in enumerate(expand_sweep(sweep_config)):
+        run_name = f"run_{i:03d}"
+        config_dict = apply_overrides(
+            base_config_dict, {**sweep_config.overrides, **overrides}
+        )
+        if config_dict.get("graph_cache_dir") is None:
+            config_dict["graph_cache_dir"] = graph_cache_dir
+        config_dict["shared_dataset_cache"] = True
+        if config_dict.get("wandb_name") is None:
+            config_dict["wandb_name"] = f"{os.path.basename(os.path.normpath(sweep_dir))}_{run_name}"
+
+        # Validate all configs before starting any run
+        experiment_config = ExperimentConfig(**config_dict)
+        dataset_metadata = get_dataset_metadata(
+            experiment_config.data.dataset_name,
+            data_path=os.path.join("data", "datasets", experiment_config.data.dataset_name),
+        )
+        plan = plan_experiment(experiment_config, dataset_metadata)
+        runs.append(
+            {
+                "run": run_name,
+                "overrides": overrides,
+                "config": config_dict,
+                "graph_group": _graph_group_key(experiment_config, dataset_metadata),
+                "planned_memory_gb": plan["peak_training_bytes"] / 1024**3,
+            }
+        )
+
+        if dry_run:
+            print(f"{run_name}: {overrides}")
+            print(format_plan(plan))
+            print()
+
+    if dry_run:
+        return []
+
+    results = {}
+    if sweep_config.max_planned_memory_gb is not None:
+        for run in runs:
+            if run["planned_memory_gb"] > sweep_config.max_planned_memory_gb:
+                results[run["run"]] = {
+                    "status": f"skipped: planned memory of {run['planned_memory_gb']:.3g} GB"
+                }
+                print(f"{run['run']}: {results[run['run']]}")
+
+    groups = defaultdict(list)
+    for run in runs:
+        if run["run"] not in results:
+            groups[run["graph_group"]].append(run)
+
+    num_parallel_runs = max(
+        1, min(sweep_config.num_parallel_runs, sum(len(group_runs) for group_runs in groups.values()))
+    )
+    num_threads = sweep_config.threads_per_run or threads_per_rank(num_parallel_runs)
+    print(
+        f"Running {sum(len(group_runs) for group_runs in groups.values())} runs with {len(groups)} different graphs, "
+        f"{num_parallel_runs} at a time with {num_threads} threads each"
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=num_parallel_runs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_sweep_worker,
+        initargs=(num_threads,),
+    ) as pool:
+        # The graphs of every group are built first, the runs of a group start once they are cached
+        build_futures = {
+            pool.submit(_build_static_graphs, group_runs[0]["config"]): group_key
+            for group_key, group_runs in groups.items()
+        }
+        run_futures = {}
+        pending = set(build_futures)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in build_futures:
+                    group_runs = groups[build_futures[future]]
+                    if future.exception() is not None:
+                        for run in group_runs:
+                            results[run["run"]] = {
+                                "status": f"failed: {future.exception()!r}"
+                            }
+                        continue
+
+                    for run in group_runs:
+                        run_future = pool.submit(
+                            _run_sweep_entry,
+                            run["config"],
+                            os.path.join(sweep_dir, FolderNames.SWEEP_RUNS, run["run"]),
+                        )
+                        run_futures[run_future] = run["run"]
+                        pending.add(run_future)
+
+                else:
+                    run_name = run_futures[future]
+                    if future.exception() is not None:
+                        results[run_name] = {"status": f"failed: {future.exception()!r}"}
+                    else:
+                        results[run_name] = {"status": "finished", **future.result()}
+                    print(f"{run_name}: {results[run_name]}")
+
+    table = [
+        {"run": run["run"], **run["overrides"], **results[run["run"]]} for run in runs
+    ]
+    _write_results_table(table, sweep_dir=sweep_dir)
+    print(f"Sweep results saved to {os.path.join(sweep_dir, FileNames.SWEEP_RESULTS_TABLE)}")
+
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a sweep of Weather Prediction experiments.")
+    parser.add_argument(
+        "sweep_directory",
+        help="The sweep directory that contains the sweep.json file.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only prints the estimated graph sizes, FLOPs and memory of every run.",
+    )
+    args = parser.parse_args()
+
+    run_sweep(args.sweep_directory, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Throughput and memory metrics of the training and evaluation loops for capacity planning."""
+
+import resource
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict
+
+import torch
+
+from src.distributed import all_reduce_max, all_reduce_sum
+
+
+def peak_rss_mb() -> float:
+    """The peak resident set size of this process since it started, in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak_rss / 1024**2 if sys.platform == "darwin" else peak_rss / 1024
+
+
+class ThroughputMeter:
+    """Counts the samples and the edges that message passing ran on during a loop over a dataset.
+
+    Updating only adds up numbers that are known on the host, i.e. it never waits for the device, so it
+    can be called for every batch. The rates are computed once the loop is done.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._num_samples = 0
+        self._num_steps = 0
+        self._num_edges: Dict[str, int] = defaultdict(int)
+
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def update(self, num_samples: int, num_edges_per_graph: Dict[str, int]):
+        """Records one forward pass over `num_samples` samples on graphs with the given numbers of edges."""
+        self._num_samples += num_samples
+        self._num_steps += 1
+        for graph, num_edges in num_edges_per_graph.items():
+            self._num_edges[graph] += num_edges
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the wall time, the samples and edges per second and the peak memory of the loop. With
+        multiple ranks the counts are summed over all ranks and the slowest rank determines the wall time."""
+        wall_time = time.perf_counter() - self._start
+
+        graphs = sorted(self._num_edges)
+        counts = all_reduce_sum(
+            [self._num_samples, self._num_steps] + [self._num_edges[graph] for graph in graphs]
+        )
+        wall_time, peak_rss = all_reduce_max([wall_time, peak_rss_mb()])
+        num_samples, num_steps, edge_counts = counts[0], counts[1], counts[2:]
+
+        summary = {
+            "wall_time": wall_time,
+            "num_samples": int(num_samples),
+            "num_steps": int(num_steps),
+            "samples_per_second": num_samples / wall_time if wall_time > 0 else 0.0,
+            "edges_per_second": {
+                graph: num_edges / wall_time if wall_time > 0 else 0.0
+                for graph, num_edges in zip(graphs, edge_counts)
+            },
+            "peak_rss_mb": peak_rss,
+        }
+        if torch.cuda.is_available():
+            summary["peak_cuda_memory_mb"] = torch.cuda.max_memory_allocated() / 1024**2
+
+        return summary
+
+
+def flatten_metrics(metrics: Dict[str, Any], prefix: str) -> Dict[str, float]:
+    """Flattens the summary of a ThroughputMeter into `<prefix>_<metric>` keys for the metrics logger."""
+    flat_metrics = {}
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            for graph, graph_value in value.items():
+                flat_metrics[f"{prefix}_{key}/{graph}"] = graph_value
+        else:
+            flat_metrics[f"{prefix}_{key}"] = value
+
+    return flat_metrics
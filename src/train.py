@@ -5,11 +5,41 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 from torch.optim import Optimizer
 from tqdm import tqdm
-import wandb
-from src.config import ExperimentConfig
+from src.config import ExperimentConfig, Precision
 from src.constants import FileNames
 from src.utils import save_to_json_file
+from src.data.prefetch import PrefetchLoader
+from src.async_eval import AsyncEvaluator, EvalResult
+from src.throughput import ThroughputMeter, flatten_metrics
+from src.metrics import create_metrics_logger
+from src.verification import StreamingMetrics, climatology_from_dataset, create_grid_metrics
+from src.precision import autocast
+from src.profiling import (
+    disable_profiling,
+    enable_profiling,
+    phase,
+    profile_iterable,
+    region,
+)
+from src.distributed import (
+    average_over_ranks,
+    broadcast_from_main,
+    get_rank,
+    is_distributed,
+    is_main_process,
+    set_sampler_epoch,
+    unwrap_model,
+)
+from src.checkpoint import (
+    CheckpointManager,
+    build_training_checkpoint,
+    get_checkpoint_dir,
+    restore_training_state,
+)
+from typing import Any, Dict, List, Optional
 import os
+import time
+import numpy as np
 
 def update_attention_threshold(epoch, max_epochs=30, start_epoch=5, final_threshold=0.1356):
     if epoch < start_epoch:
@@ -22,6 +52,21 @@ def update_attention_threshold(epoch, max_epochs=30, start_epoch=5, final_thresh
 
     return min(final_threshold, (epoch - start_epoch) * final_threshold / (max_epochs - start_epoch))
 
+def _prepare_batch(batch, device):
+    X, y = batch
+    # Removing the batch dimension
+    y = y.squeeze(0)
+
+    if len(y.shape) == 3:
+        # Removing the extra timestep dimension from y
+        y = y.squeeze(-2)
+
+    # This is a no-op if the batch was already moved to the device while prefetching
+    X, y = X.to(device), y.to(device)
+
+    return X, y
+
+
 def train_epoch(
     model: WeatherPrediction,
     train_dataloader: DataLoader,
@@ -29,21 +74,18 @@ def train_epoch(
     loss_fn,
     device,
     threshold,
-    epoch
+    epoch,
+    throughput: Optional[ThroughputMeter] = None,
+    precision: Precision = Precision.FP32,
 ):
     model.train()
+    base_model = unwrap_model(model)
     total_loss = 0
-    print(threshold)
-
-    for i, batch in enumerate(train_dataloader):
-        X, y = batch
-        # Removing the batch dimension
-        y = y.squeeze(0)
+    if is_main_process():
+        print(threshold)
 
-        if len(y.shape) == 3:
-            # Removing the extra timestep dimension from y
-            y = y.squeeze(-2)
-        X, y = X.to(device), y.to(device)
+    for i, batch in enumerate(profile_iterable(train_dataloader, "dataloading")):
+        X, y = _prepare_batch(batch=batch, device=device)
         optimiser.zero_grad()
 
         kwargs = {
@@ -51,37 +93,66 @@ def train_epoch(
             "epoch": epoch,
             "batch_num": i,
         }
-        outs = model(X=X, attention_threshold=threshold, **kwargs)
-        batch_loss = loss_fn(outs, y)
-        batch_loss.backward()
-        optimiser.step()
+        with region("forward"), autocast(precision, device):
+            outs = model(X=X, attention_threshold=threshold, **kwargs)
+        with region("loss"):
+            batch_loss = loss_fn(outs, y)
+        with region("backward"):
+            batch_loss.backward()
+        with region("optimiser_step"):
+            optimiser.step()
         total_loss += batch_loss.detach().item()
 
-    avg_loss = total_loss / len(train_dataloader)
+        if throughput is not None:
+            throughput.update(
+                num_samples=X.shape[0],
+                num_edges_per_graph=base_model.num_edges_per_graph(),
+            )
+
+    # Every rank trained on its own shard, the loss is averaged over the batches of all ranks
+    avg_loss = average_over_ranks(total=total_loss, count=len(train_dataloader))
 
     return avg_loss
 
 
-def test(model: WeatherPrediction, test_dataloader: DataLoader, loss_fn, device):
+def test(
+    model: WeatherPrediction,
+    test_dataloader: DataLoader,
+    loss_fn,
+    device,
+    throughput: Optional[ThroughputMeter] = None,
+    precision: Precision = Precision.FP32,
+    metrics: Optional[StreamingMetrics] = None,
+):
+    # The evaluation shards of the ranks can differ in size, so the forward passes must not
+    # synchronise through the DistributedDataParallel wrapper
+    model = unwrap_model(model)
     model.eval()
 
     total_loss = 0
 
-    with torch.no_grad():
-        for batch in test_dataloader:
-            X, y = batch
-            # Removing the batch dimension
-            y = y.squeeze(0)
-
-            if len(y.shape) == 3:
-                # Removing the extra timestep dimension from y
-                y = y.squeeze(-2)
-            X, y = X.to(device), y.to(device)
-            outs = model(X=X, attention_threshold=0.0)
-            batch_loss = loss_fn(outs, y)
+    with torch.no_grad(), phase("eval"):
+        for batch in profile_iterable(test_dataloader, "dataloading"):
+            X, y = _prepare_batch(batch=batch, device=device)
+            with region("forward"), autocast(precision, device):
+                outs = model(X=X, attention_threshold=0.0)
+            with region("loss"):
+                batch_loss = loss_fn(outs, y)
             total_loss += batch_loss.detach().item()
 
-    avg_loss = total_loss / len(test_dataloader)
+            if metrics is not None:
+                with region("metrics"):
+                    metrics.update(outs, y)
+
+            if throughput is not None:
+                throughput.update(
+                    num_samples=X.shape[0],
+                    num_edges_per_graph=model.num_edges_per_graph(),
+                )
+
+    avg_loss = average_over_ranks(total=total_loss, count=len(test_dataloader))
+    if metrics is not None:
+        metrics.all_reduce()
 
     return avg_loss
 
@@ -98,135 +169,377 @@ def train(
     results_save_dir: str,
     print_losses: bool = True,
     wandb_log: bool = True,
+    resume_checkpoint: Optional[Dict[str, Any]] = None,
+    evaluator: Optional[AsyncEvaluator] = None,
 ):
     # Define the loss function
     loss_fn = nn.MSELoss()
 
-    train_losses = []
-    val_losses = []
-    test_losses = []
-
-    # Initialize Weights & Biases logging
-    if wandb_log:
-        wandb.login(key=config.wandb_key)
-        wandb.init(
-            entity="graphml-group4",
-            project="weather-prediction",
-            config=dict(config),
-            name=config.wandb_name,
+    # With multiple ranks only rank 0 logs, prints and writes results and checkpoints
+    is_main = is_main_process()
+    print_losses = print_losses and is_main
+
+    # The metrics are written in the background, to wandb only if it is enabled
+    metrics_logger = (
+        create_metrics_logger(
+            config,
+            results_save_dir=results_save_dir,
+            wandb_log=wandb_log,
+            # The steps continue after the ones of the interrupted run, whose metrics are appended to
+            start_step=resume_checkpoint.get("metrics_step", 0) if resume_checkpoint is not None else 0,
+            append=resume_checkpoint is not None,
         )
-
-    # Early stopping variables
-    best_val_loss = float("inf")
-    patience_counter = 0
-    
-    # Getting initial performance before training
-    intial_train_loss = test(
-        model=model, test_dataloader=train_dataloader, loss_fn=loss_fn, device=device
+        if is_main
+        else None
     )
 
-    intial_val_loss = test(
-        model=model, test_dataloader=val_dataloader, loss_fn=loss_fn, device=device
-    )
+    try:
+        profiler = enable_profiling(config.profiling) if config.profiling.enabled else None
 
-    intial_test_loss = test(
-        model=model, test_dataloader=test_dataloader, loss_fn=loss_fn, device=device
-    )
-    
-    train_losses.append(intial_train_loss)
-    val_losses.append(intial_val_loss)
-    test_losses.append(intial_test_loss)
-        
-    if wandb_log:
-        wandb.log(
-            {
-                "train_loss": intial_train_loss,
-                "val_loss": intial_val_loss,
-                "test_loss": intial_test_loss,
-            }
+        checkpoint_manager = (
+            CheckpointManager(
+                checkpoint_dir=get_checkpoint_dir(results_save_dir),
+                num_to_keep=config.checkpoints_to_keep,
             )
-
-    # Running training
-    for epoch in range(num_epochs):
-        print()
-        epoch_threshold = update_attention_threshold(epoch)
-        print(f"Epoch {epoch} with attention threshold {epoch_threshold}")
-
-        epoch_train_loss = train_epoch(
-            model=model,
-            optimiser=optimiser,
-            train_dataloader=train_dataloader,
-            loss_fn=loss_fn,
-            device=device,
-            threshold=epoch_threshold,
-            epoch=epoch,
+            if is_main
+            else None
         )
 
-        epoch_val_loss = test(
-            model=model, test_dataloader=val_dataloader, loss_fn=loss_fn, device=device
-        )
-
-        epoch_test_loss = test(
-            model=model, test_dataloader=test_dataloader, loss_fn=loss_fn, device=device
-        )
+        if resume_checkpoint is not None:
+            restore_training_state(
+                checkpoint=resume_checkpoint,
+                model=unwrap_model(model),
+                optimiser=optimiser,
+                device=device,
+            )
+            training_results = resume_checkpoint["training_results"]
+            # Checkpoints from before the evaluation cadence was configurable evaluated after every epoch
+            training_results.setdefault(
+                "eval_epochs", list(range(len(training_results["val_losses"])))
+            )
+            for key in ("train_metrics", "eval_metrics", "epoch_wall_times", "test_variable_metrics"):
+                training_results.setdefault(key, [])
+            best_val_loss = resume_checkpoint["best_val_loss"]
+            patience_counter = resume_checkpoint["patience_counter"]
+            start_epoch = resume_checkpoint["epoch"] + 1
+            print(f"Resuming training from epoch {start_epoch}")
 
-        if print_losses:
-            print(f"Train loss after epoch {epoch+1}: {epoch_train_loss}")
-            print(f"Validation loss after epoch {epoch+1}: {epoch_val_loss}")
-            print(f"Test loss after epoch {epoch+1}: {epoch_test_loss}")
+        else:
+            training_results = {
+                "train_losses": [],
+                "val_losses": [],
+                "test_losses": [],
+                # The number of epochs trained before each evaluation, 0 is the performance before training
+                "eval_epochs": [],
+                "train_data_wait_times": [],
+                # Throughput and memory of every training epoch and every evaluation
+                "train_metrics": [],
+                "eval_metrics": [],
+                "epoch_wall_times": [],
+                # The latitude-weighted RMSE, bias and ACC of every variable on the test set
+                "test_variable_metrics": [],
+            }
 
-        train_losses.append(epoch_train_loss)
-        val_losses.append(epoch_val_loss)
-        test_losses.append(epoch_test_loss)
+            # Early stopping variables
+            best_val_loss = float("inf")
+            patience_counter = 0
+            start_epoch = 0
+
+        train_losses = training_results["train_losses"]
+        val_losses = training_results["val_losses"]
+        test_losses = training_results["test_losses"]
+        eval_epochs = training_results["eval_epochs"]
+        train_data_wait_times = training_results["train_data_wait_times"]
+        train_metrics = training_results["train_metrics"]
+        eval_metrics = training_results["eval_metrics"]
+        epoch_wall_times = training_results["epoch_wall_times"]
+        test_variable_metrics = training_results["test_variable_metrics"]
+
+        # The anomalies of the ACC are relative to the mean of the training targets
+        num_features = config.data.num_features_used
+        climatology = climatology_from_dataset(
+            train_dataloader.dataset,
+            num_grid_nodes=len(unwrap_model(model)._grid_lat) * len(unwrap_model(model)._grid_lon),
+            num_features=num_features,
+        )
 
-        if wandb_log:
-            wandb.log(
-                {
+        def process_eval_results(eval_results: List[EvalResult]):
+            nonlocal best_val_loss, patience_counter
+
+            for result in eval_results:
+                val_losses.append(result.val_loss)
+                test_losses.append(result.test_loss)
+                eval_epochs.append(result.epoch)
+                eval_metrics.append(result.throughput)
+                variable_metrics = (
+                    result.test_metrics.summary() if result.test_metrics is not None else None
+                )
+                test_variable_metrics.append(variable_metrics)
+
+                if print_losses:
+                    print(f"Validation loss after epoch {result.epoch}: {result.val_loss}")
+                    print(f"Test loss after epoch {result.epoch}: {result.test_loss}")
+
+                if metrics_logger is not None:
+                    metrics_logger.log(
+                        {
+                            "val_loss": result.val_loss,
+                            "test_loss": result.test_loss,
+                            "eval_epoch": result.epoch,
+                            **flatten_metrics(result.throughput, prefix="eval"),
+                            **{
+                                f"test_{metric}/{name}": values[0]
+                                for name, metrics in (variable_metrics or {}).items()
+                                for metric, values in metrics.items()
+                            },
+                        }
+                    )
+
+                # The performance before training does not count towards early stopping
+                if result.epoch > 0:
+                    epoch_delta = best_val_loss - result.val_loss
+
+                    # Early stopping logic
+                    if epoch_delta > config.early_stopping_delta:
+
+                        if is_main:
+                            print(
+                                f"Val loss reduced by {round(epoch_delta, 5)} which is greater than the early stopping delta. Saving best model... \n"
+                            )
+
+                            # Save the evaluated weights in the background
+                            checkpoint_manager.save(
+                                result.weights
+                                if result.weights is not None
+                                else unwrap_model(model).state_dict(),
+                                os.path.join(results_save_dir, FileNames.SAVED_MODEL),
+                            )
+                            # The error maps of the best model, of the shape [latitude, longitude, variable]
+                            if result.test_metrics is not None:
+                                np.savez(
+                                    os.path.join(results_save_dir, FileNames.TEST_ERROR_MAPS),
+                                    **{
+                                        name: error_map[0]
+                                        for name, error_map in result.test_metrics.error_maps().items()
+                                    },
+                                )
+
+                        best_val_loss = result.val_loss
+                        patience_counter = 0
+
+                    else:
+                        patience_counter += 1
+                        if is_main:
+                            print(f"Patience counter is now {patience_counter} \n")
+
+                if evaluator is not None:
+                    evaluator.release(result)
+
+        def evaluate(num_epochs_trained: int):
+            """Evaluates the current weights. With asynchronous evaluation they are only queued and the
+            results that are ready in the meantime are processed instead."""
+            if not config.async_eval:
+                throughput = ThroughputMeter()
+                test_metrics = create_grid_metrics(
+                    model, num_features=num_features, climatology=climatology, device=device
+                )
+                val_loss = test(
+                    model=model,
+                    test_dataloader=val_dataloader,
+                    loss_fn=loss_fn,
+                    device=device,
+                    throughput=throughput,
+                    precision=config.precision,
+                )
+                test_loss = test(
+                    model=model,
+                    test_dataloader=test_dataloader,
+                    loss_fn=loss_fn,
+                    device=device,
+                    throughput=throughput,
+                    precision=config.precision,
+                    metrics=test_metrics,
+                )
+                process_eval_results(
+                    [
+                        EvalResult(
+                            epoch=num_epochs_trained,
+                            val_loss=val_loss,
+                            test_loss=test_loss,
+                            throughput=throughput.summary(),
+                            test_metrics=test_metrics,
+                        )
+                    ]
+                )
+                return
+
+            # With multiple ranks only rank 0 evaluates asynchronously
+            if evaluator is None:
+                return
+
+            # If both snapshot buffers are still in use, wait for the oldest evaluation to finish
+            process_eval_results(evaluator.collect(wait=not evaluator.has_free_slot()))
+            evaluator.submit(model, epoch=num_epochs_trained)
+
+        if resume_checkpoint is None:
+            # Getting initial performance before training
+            intial_train_loss = None
+            if config.initial_train_eval:
+                intial_train_loss = test(
+                    model=model,
+                    test_dataloader=train_dataloader,
+                    loss_fn=loss_fn,
+                    device=device,
+                    precision=config.precision,
+                )
+                if metrics_logger is not None:
+                    metrics_logger.log({"train_loss": intial_train_loss})
+
+            train_losses.append(intial_train_loss)
+            evaluate(num_epochs_trained=0)
+
+            if profiler is not None:
+                profiler.end_epoch(epoch=0)
+
+        # Running training
+        for epoch in range(start_epoch, num_epochs):
+            epoch_threshold = update_attention_threshold(epoch)
+            if is_main:
+                print()
+                print(f"Epoch {epoch} with attention threshold {epoch_threshold}")
+
+            # Every rank gets a different shard of the shuffled training set each epoch
+            set_sampler_epoch(train_dataloader, epoch)
+
+            epoch_start = time.perf_counter()
+            throughput = ThroughputMeter()
+            epoch_train_loss = train_epoch(
+                model=model,
+                optimiser=optimiser,
+                train_dataloader=train_dataloader,
+                loss_fn=loss_fn,
+                device=device,
+                threshold=epoch_threshold,
+                epoch=epoch,
+                throughput=throughput,
+                precision=config.precision,
+            )
+            train_metrics.append(throughput.summary())
+
+            base_model = unwrap_model(model)
+            if is_distributed() and getattr(base_model, "using_sparse_gat", False):
+                # SparseGAT prunes the processing graph on the batches of each rank, rank 0 decides for all
+                base_model.processing_graph = broadcast_from_main(
+                    base_model.processing_graph.cpu()
+                ).to(device)
+
+            if isinstance(train_dataloader, PrefetchLoader):
+                train_data_wait_times.append(train_dataloader.last_epoch_wait_time)
+
+            train_losses.append(epoch_train_loss)
+
+            if print_losses:
+                print(f"Train loss after epoch {epoch+1}: {epoch_train_loss}")
+                print(
+                    f"Training throughput in epoch {epoch+1}: {train_metrics[-1]['samples_per_second']:.2f} samples/s, "
+                    f"peak RSS {train_metrics[-1]['peak_rss_mb']:.0f} MB"
+                )
+                if train_data_wait_times:
+                    print(
+                        f"Time spent waiting for training data in epoch {epoch+1}: {train_data_wait_times[-1]:.3f}s"
+                    )
+
+            if metrics_logger is not None:
+                epoch_log = {
                     "train_loss": epoch_train_loss,
-                    "val_loss": epoch_val_loss,
-                    "test_loss": epoch_test_loss,
+                    "epoch": epoch + 1,
+                    **flatten_metrics(train_metrics[-1], prefix="train"),
                 }
-            )
+                if train_data_wait_times:
+                    epoch_log["train_data_wait_time"] = train_data_wait_times[-1]
 
-        epoch_delta = best_val_loss - epoch_val_loss
+                metrics_logger.log(epoch_log)
 
-        # Early stopping logic
-        if epoch_delta > config.early_stopping_delta:
-
-            print(
-                f"Val loss reduced by {round(best_val_loss - epoch_val_loss, 5)} which is greater than the early stopping delta. Saving best model... \n"
+            is_checkpoint_epoch = (
+                (epoch + 1) % config.checkpoint_every_n_epochs == 0 or epoch + 1 == num_epochs
             )
 
-            best_val_loss = epoch_val_loss
-            # Save the best model
-            torch.save(
-                model.state_dict(),
-                os.path.join(results_save_dir, FileNames.SAVED_MODEL),
+            if (epoch + 1) % config.eval_every_n_epochs == 0 or epoch + 1 == num_epochs:
+                evaluate(num_epochs_trained=epoch + 1)
+            elif evaluator is not None:
+                process_eval_results(evaluator.collect())
+
+            if evaluator is not None and is_checkpoint_epoch:
+                # The checkpoint should contain the early stopping state of all evaluated epochs
+                process_eval_results(evaluator.collect(wait_all=True))
+
+            if profiler is not None:
+                profile_summary = profiler.end_epoch(epoch=epoch + 1)
+                if print_losses:
+                    print(
+                        "Time per stage in epoch {}: {}".format(
+                            epoch + 1,
+                            ", ".join(
+                                f"{stage} {stats['total']:.3f}s"
+                                for stage, stats in profile_summary["stages"].items()
+                            ),
+                        )
+                    )
+
+            # The losses are reduced over all ranks, rank 0 still decides so that all ranks stop together
+            early_stop = broadcast_from_main(
+                patience_counter >= config.early_stopping_patience
             )
 
-            patience_counter = 0
-
-        else:
-            patience_counter += 1
-            print(f"Patience counter is now {patience_counter} \n")
-
-        if patience_counter >= config.early_stopping_patience:
-            print(f"Early stopping triggered after epoch {epoch+1}. Stopping training.")
-            break
-
-    # Save final training results
-    training_results = {
-        "train_losses": train_losses,
-        "val_losses": val_losses,
-        "test_losses": test_losses,
-    }
-    save_to_json_file(
-        data_dict=training_results,
-        save_path=os.path.join(results_save_dir, FileNames.SAVED_RESULTS),
-    )
-    print(f"Training results saved to {results_save_dir}")
+            # The wall time of the whole epoch, including the evaluation. It is recorded before the checkpoint
+            # is built so that a resumed run has the wall times of all checkpointed epochs, the checkpoint is
+            # written in the background anyway
+            epoch_wall_times.append(time.perf_counter() - epoch_start)
+
+            if is_main and (is_checkpoint_epoch or early_stop):
+                checkpoint_manager.save_training_checkpoint(
+                    build_training_checkpoint(
+                        model=unwrap_model(model),
+                        optimiser=optimiser,
+                        epoch=epoch,
+                        best_val_loss=best_val_loss,
+                        patience_counter=patience_counter,
+                        training_results=training_results,
+                        metrics_step=metrics_logger.step,
+                    ),
+                    epoch=epoch,
+                )
+
+            if early_stop:
+                if is_main:
+                    print(f"Early stopping triggered after epoch {epoch+1}. Stopping training.")
+                break
+
+        if evaluator is not None:
+            # Evaluations still running when training stopped are recorded as well
+            process_eval_results(evaluator.collect(wait_all=True))
+
+        if is_main:
+            # Make sure the best model and all checkpoints are written before returning
+            checkpoint_manager.close()
+
+            # Save final training results
+            save_to_json_file(
+                data_dict=training_results,
+                save_path=os.path.join(results_save_dir, FileNames.SAVED_RESULTS),
+            )
+            print(f"Training results saved to {results_save_dir}")
 
-    if wandb_log:
-        wandb.finish()
+        if profiler is not None:
+            # Every rank writes its own profile
+            profiler.export(
+                results_save_dir,
+                suffix=f"_rank{get_rank()}" if is_distributed() else "",
+            )
+            disable_profiling()
+    finally:
+        # Pending metrics are written also when training fails
+        if metrics_logger is not None:
+            metrics_logger.close()
 
     return training_results
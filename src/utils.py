@@ -2,10 +2,13 @@
 
 import torch
 import json
-from typing import Dict, Any, Optional, Tuple
+import os
+from typing import TYPE_CHECKING, Dict, Any, Optional, Tuple
 import numpy as np
-from scipy.spatial import transform
-from src.mesh import TriangularMesh
+
+if TYPE_CHECKING:
+    # Importing the mesh pulls in scipy and trimesh, which are only needed to build the graphs
+    from src.mesh import TriangularMesh
 
 
 def save_to_json_file(data_dict: Dict[str, Any], save_path: str):
@@ -35,6 +38,22 @@ def load_from_json_file(data_path: str) -> Dict[str, Any]:
     return loaded_dict
 
 
+def atomic_torch_save(obj: Any, save_path: str):
+    """Saves an object with torch.save such that the file at save_path is either the old or the complete new
+    version, even if the process is interrupted while writing.
+
+    Args:
+        obj (Any): The object to save.
+        save_path (str): The path to save the object to.
+    """
+    tmp_path = f"{save_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as outfile:
+        torch.save(obj, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, save_path)
+
+
 def get_adjacency_matrix_from_edge_index(
     edge_index: torch.Tensor,
     num_sender_nodes: int,
@@ -384,6 +403,7 @@ def get_rotation_matrices_to_local_coordinates(
               to be aligned with one of the axis after the rotation.
 
     """
+    from scipy.spatial import transform
 
     if rotate_longitude and rotate_latitude:
 
@@ -423,7 +443,7 @@ def rotate_with_matrices(
     return np.einsum("bji,bi->bj", rotation_matrices, positions)
 
 
-def get_mesh_lat_long(finest_mesh: TriangularMesh):
+def get_mesh_lat_long(finest_mesh: "TriangularMesh"):
     mesh_phi, mesh_theta = cartesian_to_spherical(
         finest_mesh.vertices[:, 0],
         finest_mesh.vertices[:, 1],
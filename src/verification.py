@@ -0,0 +1,208 @@
+"""Streaming verification metrics of forecasts: latitude-weighted RMSE, bias and anomaly correlation (ACC)
+per variable and lead time, and maps of the errors of every grid cell.
+
+The metrics are accumulated as sums while the forecasts are produced, so no forecast has to be kept in
+memory, and the sums of several processes can be merged. The grid nodes are ordered longitude-major like
+the training data, and the weight of a grid cell is the cosine of its latitude, normalised to a mean of 1.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from src.distributed import is_distributed, unwrap_model
+
+
+def latitude_weights(latitudes: np.ndarray, num_longitudes: int) -> torch.Tensor:
+    """The weight of every grid node, proportional to the area of its cell, with a mean of 1."""
+    weights = np.cos(np.deg2rad(np.asarray(latitudes, dtype=np.float64))).clip(min=0)
+    weights = np.tile(weights / weights.mean(), num_longitudes)
+
+    return torch.from_numpy(weights)
+
+
+def climatology_from_dataset(
+    dataset, num_grid_nodes: int, num_features: int, chunk_size: int = 256
+) -> Optional[torch.Tensor]:
+    """The mean target of every grid node and variable over a dataset split with the targets in `y`, e.g.
+    the training split. Returns None if the targets of the dataset are not available as one tensor. The
+    targets are summed in chunks of `chunk_size` samples, so they are never copied as a whole."""
+    y = getattr(dataset, "y", None)
+    if not isinstance(y, torch.Tensor):
+        return None
+
+    # The first timestep of the prediction window is the one that is forecasted
+    y = y.reshape(y.shape[0], num_grid_nodes, -1, num_features)[:, :, 0]
+    total = torch.zeros(num_grid_nodes, num_features, dtype=torch.float64, device=y.device)
+    for chunk in y.split(chunk_size):
+        total += chunk.sum(dim=0, dtype=torch.float64)
+
+    return total / max(y.shape[0], 1)
+
+
+class StreamingMetrics:
+    """Accumulates the errors of forecasts per lead time and variable.
+
+    Parameters
+    ----------
+    latitudes : np.ndarray
+        The latitudes of the grid in degrees.
+    num_longitudes : int
+        The number of longitudes of the grid.
+    num_features : int
+        The number of variables of every forecast.
+    num_leads : int
+        The number of lead times of every forecast.
+    climatology : Optional[torch.Tensor]
+        The climatological mean of every grid node and variable of the shape [grid, variable], which the
+        anomalies of the ACC are computed from. Defaults to 0, the mean of normalised data.
+    device
+        The device the forecasts are on.
+    """
+
+    def __init__(
+        self,
+        latitudes: np.ndarray,
+        num_longitudes: int,
+        num_features: int,
+        num_leads: int = 1,
+        climatology: Optional[torch.Tensor] = None,
+        device=None,
+    ):
+        self.num_latitudes = len(latitudes)
+        self.num_longitudes = num_longitudes
+        num_grid_nodes = self.num_latitudes * num_longitudes
+
+        self.weights = latitude_weights(latitudes, num_longitudes).to(device).view(1, 1, -1, 1)
+        self.climatology = (
+            torch.zeros(num_grid_nodes, num_features, dtype=torch.float64, device=device)
+            if climatology is None
+            else climatology.to(device=device, dtype=torch.float64)
+        )
+
+        self.num_forecasts = 0
+        # Sums over the forecasts of the latitude-weighted means over the grid
+        self.sum_error = torch.zeros(num_leads, num_features, dtype=torch.float64, device=device)
+        self.sum_squared_error = torch.zeros_like(self.sum_error)
+        self.sum_acc = torch.zeros_like(self.sum_error)
+        # Sums over the forecasts for every grid node
+        self.error_map = torch.zeros(
+            num_leads, num_grid_nodes, num_features, dtype=torch.float64, device=device
+        )
+        self.squared_error_map = torch.zeros_like(self.error_map)
+
+    def update(self, predictions: torch.Tensor, targets: torch.Tensor):
+        """Adds forecasts and their targets of the shape [grid, variable], [batch, grid, variable] or
+        [batch, lead, grid, variable]."""
+        predictions, targets = _with_lead_dimension(predictions), _with_lead_dimension(targets)
+        predictions, targets = predictions.double(), targets.double()
+        errors = predictions - targets
+
+        self.num_forecasts += errors.shape[0]
+        self.sum_error += (errors * self.weights).mean(dim=2).sum(dim=0)
+        self.sum_squared_error += (errors**2 * self.weights).mean(dim=2).sum(dim=0)
+
+        # The ACC of every forecast is the weighted correlation of its anomalies with the ones of the target
+        predicted_anomalies = predictions - self.climatology
+        target_anomalies = targets - self.climatology
+        covariance = (predicted_anomalies * target_anomalies * self.weights).sum(dim=2)
+        variances = (predicted_anomalies**2 * self.weights).sum(dim=2) * (
+            target_anomalies**2 * self.weights
+        ).sum(dim=2)
+        self.sum_acc += (covariance / variances.clamp(min=1e-24).sqrt()).sum(dim=0)
+
+        self.error_map += errors.sum(dim=0)
+        self.squared_error_map += (errors**2).sum(dim=0)
+
+    def _sums(self) -> List[torch.Tensor]:
+        return [
+            self.sum_error,
+            self.sum_squared_error,
+            self.sum_acc,
+            self.error_map,
+            self.squared_error_map,
+        ]
+
+    def merge(self, other: "StreamingMetrics"):
+        self.num_forecasts += other.num_forecasts
+        for total, value in zip(self._sums(), other._sums()):
+            total += value.to(total.device)
+
+    def all_reduce(self):
+        """Sums the metrics of all ranks. Without a process group this does nothing."""
+        if not is_distributed():
+            return
+
+        num_forecasts = torch.tensor([self.num_forecasts], dtype=torch.float64)
+        dist.all_reduce(num_forecasts, op=dist.ReduceOp.SUM)
+        self.num_forecasts = int(num_forecasts.item())
+        for total in self._sums():
+            dist.all_reduce(total, op=dist.ReduceOp.SUM)
+
+    def summary(
+        self, variable_names: Optional[List[str]] = None, scale: Optional[np.ndarray] = None
+    ) -> Dict[str, Dict[str, List[float]]]:
+        """The latitude-weighted RMSE, bias and ACC of every variable as lists over the lead times. The
+        RMSE and the bias of normalised data are multiplied with `scale`, the standard deviation of every
+        variable."""
+        num_features = self.sum_error.shape[1]
+        variable_names = variable_names or [f"feature_{i}" for i in range(num_features)]
+        scale = torch.ones(num_features) if scale is None else torch.as_tensor(scale)
+        scale = scale.to(self.sum_error.device, dtype=torch.float64)
+
+        num_forecasts = max(self.num_forecasts, 1)
+        metrics = {
+            "rmse": (self.sum_squared_error / num_forecasts).sqrt() * scale,
+            "bias": self.sum_error / num_forecasts * scale,
+            "acc": self.sum_acc / num_forecasts,
+        }
+
+        return {
+            name: {metric: values[:, i].tolist() for metric, values in metrics.items()}
+            for i, name in enumerate(variable_names)
+        }
+
+    def error_maps(self, scale: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """The RMSE and the bias of every grid cell over all forecasts, of the shape
+        [lead, latitude, longitude, variable]."""
+        num_forecasts = max(self.num_forecasts, 1)
+        scale = np.ones(self.error_map.shape[-1]) if scale is None else np.asarray(scale)
+
+        maps = {
+            "rmse": (self.squared_error_map / num_forecasts).sqrt(),
+            "bias": self.error_map / num_forecasts,
+        }
+        return {
+            # The grid nodes are ordered longitude-major
+            name: values.cpu()
+            .numpy()
+            .reshape(values.shape[0], self.num_longitudes, self.num_latitudes, -1)
+            .transpose(0, 2, 1, 3)
+            * scale
+            for name, values in maps.items()
+        }
+
+
+def create_grid_metrics(
+    model, num_features: int, climatology: Optional[torch.Tensor] = None, device=None
+) -> StreamingMetrics:
+    """Creates the metrics of single-step forecasts on the grid of a model."""
+    model = unwrap_model(model)
+
+    return StreamingMetrics(
+        latitudes=model._grid_lat,
+        num_longitudes=len(model._grid_lon),
+        num_features=num_features,
+        climatology=climatology,
+        device=device,
+    )
+
+
+def _with_lead_dimension(X: torch.Tensor) -> torch.Tensor:
+    if X.dim() == 2:
+        return X[None, None]
+    if X.dim() == 3:
+        return X[:, None]
+    return X